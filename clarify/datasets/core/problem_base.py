@@ -95,9 +95,14 @@ class PCMLProblem(problem.Problem):
 
     target_selection = self.dataset_selection(mode=mode)
 
+    # Keys are unique to each datagen shard so parallel replicas don't
+    # overwrite each other's examples.
+    replica_id = shard_id if shard_id >= 0 else None
+
     target_selection.random_load_from_generator(generator=gen,
                                                 log_every=100,
-                                                prefix_tag_length=8)
+                                                prefix_tag_length=8,
+                                                replica_id=replica_id)
 
   def dataset(self,
               mode,
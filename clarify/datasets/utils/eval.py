@@ -163,6 +163,55 @@ def _auc_for_metrics_set(metrics_set):
   return total_area
 
 
+# Transient errors reading eval examples from CBT, after which the read is
+# retried with a new iterator.
+EVAL_RETRYABLE_ERRORS = (tf.errors.DeadlineExceededError,
+                         tf.errors.UnavailableError)
+
+
+class RetryingEvalIterator(object):
+  """Iterates an eval dataset, retrying transient read errors.
+
+  Eval datasets read from CBT with tf.contrib.cloud's BigtableClient, which
+  doesn't retry reads itself, and these rarely exceed their deadline. As an
+  iterator may not be resumable after a failed next(), the read is retried
+  with a new iterator of the dataset (which restarts it, it being
+  repeated) after a backoff, up to `max_retries` consecutive times. Other
+  errors are raised.
+
+  """
+
+  def __init__(self, dataset, max_retries=3, retry_delay_secs=1.0):
+    self.dataset = dataset
+    self.max_retries = max_retries
+    self.retry_delay_secs = retry_delay_secs
+    self.num_retries = 0
+    self._iterator = tfe.Iterator(dataset)
+
+  def next(self):
+
+    retry = 0
+
+    while True:
+
+      try:
+        return self._iterator.next()
+
+      except EVAL_RETRYABLE_ERRORS as e:
+
+        if retry >= self.max_retries:
+          raise
+
+        delay = self.retry_delay_secs * 2**retry
+        tf.logging.info("Retrying eval read after {}s, error: {}".format(
+            delay, e))
+        time.sleep(delay)
+
+        self._iterator = tfe.Iterator(self.dataset)
+        self.num_retries += 1
+        retry += 1
+
+
 def compute_metrics(problem_name,
                     model_name,
                     hparams_name,
@@ -197,7 +246,7 @@ def compute_metrics(problem_name,
   eval_dataset = problem_instance.dataset(mode=Modes.EVAL, data_dir=data_dir)
 
   eval_dataset = eval_dataset.repeat(None).batch(eval_batch_size)
-  eval_dataset_iterator = tfe.Iterator(eval_dataset)
+  eval_dataset_iterator = RetryingEvalIterator(eval_dataset)
 
   with tfe.restore_variables_on_create(ckpt_dir):
 
@@ -208,37 +257,28 @@ def compute_metrics(problem_name,
 
     for i in range(eval_steps):
 
-      try:
-
-        eval_examples = eval_dataset_iterator.next()
+      eval_examples = eval_dataset_iterator.next()
 
-        prediction = model_instance.infer(eval_examples)
+      prediction = model_instance.infer(eval_examples)
 
-        # We've concatenated the two embedding vectors followed
-        # by the label so we can obtain the label just by looking
-        # at the last value
-        prediction = np.array([thing[-1] for thing in prediction],
-                              dtype=np.float32)
+      # We've concatenated the two embedding vectors followed
+      # by the label so we can obtain the label just by looking
+      # at the last value
+      prediction = np.array([thing[-1] for thing in prediction],
+                            dtype=np.float32)
 
-        target = tf.squeeze(eval_examples["targets"]).numpy().astype(np.float32)
+      target = tf.squeeze(eval_examples["targets"]).numpy().astype(np.float32)
 
-        predictions = np.concatenate([predictions, prediction])
-        targets = np.concatenate([targets, target])
+      predictions = np.concatenate([predictions, prediction])
+      targets = np.concatenate([targets, target])
 
-        if i % 10 == 0:
-          msg = "Finished collecting predictions for eval step {}.".format(i)
-          tf.logging.info(msg)
-
-      except Exception as e:
-        # Seeing rare CBT deadline exceeded errors and don't know how to modfiy
-        # the deadline... More likely to run into error with more iterations,
-        # wasn't seeing it with 10 and almost always seeing it with 100.
-        # Could conceivably have to do with running out of examples in the eval
-        # set... but there should be over 20k and this would only go through
-        # 3200.
-        msg = "HACK: Squashing inference error."
+      if i % 10 == 0:
+        msg = "Finished collecting predictions for eval step {}.".format(i)
         tf.logging.info(msg)
 
+  tf.logging.info("Eval read retries: {}".format(
+      eval_dataset_iterator.num_retries))
+
   metrics_set = []
 
   for i in range(num_threshold_bins):
@@ -287,7 +327,7 @@ def compute_metrics_v2(problem_name,
   eval_dataset = problem_instance.dataset(mode=Modes.EVAL, data_dir=data_dir)
 
   eval_dataset = eval_dataset.repeat(None).batch(eval_batch_size)
-  eval_dataset_iterator = tfe.Iterator(eval_dataset)
+  eval_dataset_iterator = RetryingEvalIterator(eval_dataset)
 
   metrics = {}
 
@@ -305,27 +345,18 @@ def compute_metrics_v2(problem_name,
 
     for i in range(eval_steps):
 
-      try:
-
-        eval_examples = eval_dataset_iterator.next()
-
-        metrics_partial = model_instance.eager_eval(eval_examples)
-        metrics = _merge(metrics, metrics_partial)
+      eval_examples = eval_dataset_iterator.next()
 
-        if i % 10 == 0:
-          msg = "Finished collecting predictions for eval step {}.".format(i)
-          tf.logging.info(msg)
+      metrics_partial = model_instance.eager_eval(eval_examples)
+      metrics = _merge(metrics, metrics_partial)
 
-      except:
-        # Seeing rare CBT deadline exceeded errors and don't know how to modfiy
-        # the deadline... More likely to run into error with more iterations,
-        # wasn't seeing it with 10 and almost always seeing it with 100.
-        # Could conceivably have to do with running out of examples in the eval
-        # set... but there should be over 20k and this would only go through
-        # 3200.
-        msg = "HACK: Squashing inference error."
+      if i % 10 == 0:
+        msg = "Finished collecting predictions for eval step {}.".format(i)
         tf.logging.info(msg)
 
+  tf.logging.info("Eval read retries: {}".format(
+      eval_dataset_iterator.num_retries))
+
   for key, value in metrics.items():
     metrics[key] = value / eval_steps
 
@@ -25,11 +25,15 @@ a pubsub topic.
 
 """
 
+import collections
 import math
 import tensorflow as tf
 import json
 import datetime
 import re
+import time
+
+from concurrent import futures
 
 from scipy.signal import resample
 
@@ -42,7 +46,6 @@ from pcml.launcher.kube import Resources
 from pcml.utils import cbt_utils
 
 from tensor2tensor.data_generators import generator_utils
-from pcml.utils.audio_utils import mp4_to_1d_array
 
 from pcml.utils.fs_utils import get_pcml_root
 from pcml.launcher.util import _compress_and_stage
@@ -75,6 +78,7 @@ class ExtractVideos(PCMLJob):
                num_cpu=1,
                memory="6Gi",
                image="gcr.io/clarify/basic-runtime:0.0.4",
+               num_workers=None,
                *args,
                **kwargs):
     """Extract videos from files to Cloud BigTable.
@@ -89,6 +93,8 @@ class ExtractVideos(PCMLJob):
         load into Cloud BigTable.
       target_prefix(str): The row key prefix to use when data is
         written to Cloud BigTable.
+      num_workers(int): The number of processes with which each job
+        downloads, decodes and writes videos, by default `num_cpu`.
 
     """
 
@@ -110,6 +116,10 @@ class ExtractVideos(PCMLJob):
     cmd += "--table={} ".format(table)
     cmd += "--target_prefix={} ".format(target_prefix)
 
+    if num_workers is None:
+      num_workers = num_cpu
+    cmd += "--workers={} ".format(num_workers)
+
     command = ["/bin/sh", "-c"]
     command_args = [cmd]
 
@@ -129,6 +139,47 @@ class ExtractVideos(PCMLJob):
                                         **kwargs)
 
 
+def _download_video_file(remote_file_path, tmp_dir):
+  filename = "-".join(remote_file_path.split("/")[-3:])
+  return generator_utils.maybe_download(tmp_dir, filename, remote_file_path)
+
+
+def _prepare_audio(audio_array, resample_every=2):
+
+  # Re-sample every N steps (numpy slicing syntax)
+  audio_array = audio_array[0::resample_every]
+
+  return np.clip((audio_array + 0.5) * 255.0, a_min=0, a_max=255)
+
+
+def _prepare_audio_blocks(audio_blocks, resample_every=2):
+  """As _prepare_audio, for each of consecutive blocks of audio."""
+
+  offset = 0
+
+  for audio_block in audio_blocks:
+    # Re-sampling continues from where the previous block left off.
+    yield _prepare_audio(audio_block[-offset % resample_every:],
+                         resample_every=resample_every)
+    offset += len(audio_block)
+
+
+def _timed(iterable, stage_secs, stage):
+  """Yield from `iterable`, adding the time spent producing to a stage."""
+
+  iterator = iter(iterable)
+
+  while True:
+    start = time.time()
+    try:
+      item = next(iterator)
+    except StopIteration:
+      return
+    finally:
+      stage_secs[stage] += time.time() - start
+    yield item
+
+
 def video_file_to_cbt(remote_file_path,
                       selection,
                       tmp_dir,
@@ -138,36 +189,182 @@ def video_file_to_cbt(remote_file_path,
                       downsample_xy_dims=64,
                       greyscale=True,
                       resample_every=2,
-                      audio_block_size=1000):
-  """Extract from input path to target CBT selection."""
+                      audio_block_size=1000,
+                      writer=None,
+                      frames_per_row=1,
+                      scale_in_ffmpeg=True):
+  """Extract from input path to target CBT selection.
+
+  Frames are streamed from the decoder to the writer, and then the audio,
+  a block at a time from the file the decoder wrote it to, so memory use
+  doesn't grow with the length of the video and writing starts with the
+  first frame; the video's length is recorded in its metadata once all
+  frames have been decoded.
+
+  Args:
+    writer(cbt_utils.BatchedRowWriter): Optionally, a writer shared across
+      videos so writes overlap with decoding subsequent videos. If provided
+      the caller is responsible for closing it.
+    frames_per_row(int): The number of consecutive frames to pack into
+      each row, see RawVideoSelection.write_av.
+    scale_in_ffmpeg(bool): Whether frames are converted and downsampled by
+      the ffmpeg process that decodes them, rather than in process by cv2,
+      see video_utils.AVDecoder.
+
+  Returns:
+    A dict of the seconds spent in the "download", "decode", and "write"
+      stages.
+
+  """
 
   tf.logging.info("Loading CBT table {}".format(selection.table_name))
 
   tf.logging.info("Processing file: {}".format(remote_file_path))
 
-  filename = "-".join(remote_file_path.split("/")[-3:])
+  start = time.time()
 
-  local_file_path = generator_utils.maybe_download(tmp_dir, filename,
-                                                   remote_file_path)
+  local_file_path = _download_video_file(remote_file_path, tmp_dir)
 
-  audio_array = mp4_to_1d_array(local_file_path)
+  stage_secs = {"download": time.time() - start, "decode": 0.0}
 
-  # Re-sample every N steps (numpy slicing syntax)
-  audio_array = audio_array[0::resample_every]
+  # Frames and audio are decoded together, by default in one pass over the
+  # file by a single ffmpeg process, the audio being written once the
+  # frames have been.
+  with video_utils.AVDecoder(local_file_path,
+                             downsample_size=(downsample_xy_dims,
+                                              downsample_xy_dims),
+                             greyscale=greyscale,
+                             scale_in_ffmpeg=scale_in_ffmpeg,
+                             tmp_dir=tmp_dir) as decoder:
+
+    def _audio():
+      return _prepare_audio_blocks(decoder.audio_blocks(),
+                                   resample_every=resample_every)
+
+    selection.write_av_stream(audio=_audio,
+                              frames=_timed(decoder.frames(), stage_secs,
+                                            "decode"),
+                              shard_id=shard_id,
+                              video_id=video_id,
+                              audio_block_size=audio_block_size,
+                              writer=writer,
+                              frames_per_row=frames_per_row)
+
+  stage_secs["write"] = (time.time() - start - stage_secs["download"] -
+                         stage_secs["decode"])
+
+  return stage_secs
+
+
+def _extract_video_file(video_id,
+                        remote_file_path,
+                        selection_kwargs,
+                        max_in_flight_batches=4,
+                        **kwargs):
+  """Extract a video with a selection and writer of its own.
+
+  Picklable in and out, so that it can run in a worker process, where the
+  video is streamed to the table (see video_file_to_cbt) rather than being
+  returned. Its writes have completed once this returns.
+
+  Args:
+    selection_kwargs(dict): Args with which to construct the worker's
+      RawVideoSelection.
+    **kwargs: Further args of video_file_to_cbt.
+
+  Returns:
+    A dict of the seconds spent in each stage, as with video_file_to_cbt.
+
+  """
+
+  selection = cbt_utils.RawVideoSelection(**selection_kwargs)
+
+  with selection.batched_writer(max_in_flight=max_in_flight_batches) as writer:
+    stage_secs = video_file_to_cbt(remote_file_path=remote_file_path,
+                                   selection=selection,
+                                   video_id=video_id,
+                                   writer=writer,
+                                   **kwargs)
+    flush_start = time.time()
+
+  stage_secs["write"] += time.time() - flush_start
+
+  return stage_secs
+
+
+def _extracted_videos(file_paths,
+                      extract_fn,
+                      num_workers=1,
+                      max_pending=None,
+                      **kwargs):
+  """Extract (video_id, file path) pairs, yielding them in order.
+
+  With `num_workers` > 1 `extract_fn` runs in a process pool, with no more
+  than `max_pending` (by default twice `num_workers`) videos submitted
+  ahead of the one being yielded. As videos are written by the workers
+  only their (small) results are held.
+
+  Args:
+    file_paths(iterable): The (video_id, file path) pairs to extract.
+    extract_fn(callable): Called as extract_fn(video_id, file path,
+      **kwargs), e.g. _extract_video_file. Must be picklable to be run in
+      a pool.
+
+  Yields:
+    Tuples of video_id, file path, and the result of `extract_fn`.
+
+  """
+
+  if num_workers <= 1:
+    for video_id, remote_file_path in file_paths:
+      yield video_id, remote_file_path, extract_fn(video_id, remote_file_path,
+                                                   **kwargs)
+    return
 
-  audio_array = np.clip((audio_array + 0.5) * 255.0, a_min=0, a_max=255)
+  if max_pending is None:
+    max_pending = 2 * num_workers
 
-  # Read a frame iterable
-  video = video_utils.Video()
-  video.load_from_file(local_file_path,
-                       downsample_size=(downsample_xy_dims, downsample_xy_dims),
-                       greyscale=greyscale)
+  file_paths = iter(file_paths)
 
-  selection.write_av(audio=audio_array,
-                     frames=video,
-                     shard_id=shard_id,
-                     video_id=video_id,
-                     audio_block_size=audio_block_size)
+  with futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+    pending = collections.deque()
+
+    def _submit():
+      while len(pending) < max_pending:
+        try:
+          video_id, remote_file_path = next(file_paths)
+        except StopIteration:
+          return
+        pending.append((video_id, remote_file_path,
+                        executor.submit(extract_fn, video_id, remote_file_path,
+                                        **kwargs)))
+
+    _submit()
+
+    while pending:
+      video_id, remote_file_path, future = pending.popleft()
+      result = future.result()
+      _submit()
+      yield video_id, remote_file_path, result
+
+
+def _log_stage_throughput(stage_secs, num_videos, elapsed_secs):
+  """Log the videos per second of each stage and of the extraction overall.
+
+  Stage throughputs are per second spent in that stage, e.g. by one worker,
+  so they show which stage bounds the pipeline.
+
+  """
+
+  msg = "Extracted {} videos at {:.3f} videos/sec overall".format(
+      num_videos, num_videos / max(elapsed_secs, 1e-9))
+
+  for stage in ["download", "decode", "write"]:
+    msg += ", {} {:.3f}".format(stage,
+                                num_videos / max(stage_secs[stage], 1e-9))
+
+  tf.logging.info(msg + ".")
 
 
 def _expect_type(obj, t):
@@ -176,6 +373,123 @@ def _expect_type(obj, t):
     raise ValueError(msg)
 
 
+def _video_progress_record(remote_file_path, **settings):
+  """The progress record of a video extracted from a file with settings.
+
+  A video is only skipped when resuming if its record matches, so changing
+  either the manifest entry or the settings re-extracts it.
+
+  """
+  return {"source": remote_file_path, "settings": settings}
+
+
+def extract_shard(selection,
+                  file_paths,
+                  extract_videos,
+                  shard_id=0,
+                  num_shards=1,
+                  settings=None,
+                  resume=True,
+                  checkpoint_every=10,
+                  max_in_flight_batches=4):
+  """Extract a shard's videos to `selection`, checkpointing progress.
+
+  Videos recorded as extracted by a previous run from the same file and
+  with the same `settings` are skipped, the rest are extracted in order and
+  are recorded as such every `checkpoint_every` videos, once their writes
+  have completed. The shard meta is marked finished at the end.
+
+  Args:
+    selection(RawVideoSelection): The selection to which to extract.
+    file_paths(list): The shard's video file paths, the video id of each
+      being its position.
+    extract_videos(callable): Given the (video_id, file path) pairs to
+      extract and a BatchedRowWriter, writes each video with the writer
+      and yields (video_id, file path, stage secs) as each is written.
+    shard_id(int): The shard ID.
+    num_shards(int): The number of shards.
+    settings(dict): The settings with which videos are extracted.
+    resume(bool): Whether to skip videos already extracted.
+    checkpoint_every(int): The number of videos extracted between progress
+      checkpoints, each of which waits for in-flight writes.
+    max_in_flight_batches(int): The number of mutation batches that may be
+      in flight while subsequent videos are extracted.
+
+  Returns:
+    int: The number of videos extracted.
+
+  """
+
+  settings = settings or {}
+
+  done = set()
+  if resume:
+    progress = selection.lookup_video_progress(shard_id=shard_id)
+    done = set(
+        video_id for video_id, record in progress.items()
+        if video_id < len(file_paths) and
+        record == _video_progress_record(file_paths[video_id], **settings))
+
+  tf.logging.info("Skipping {} of {} videos already extracted.".format(
+      len(done), len(file_paths)))
+
+  shard_meta = cbt_utils.VideoShardMeta(shard_id=shard_id,
+                                        num_videos=len(file_paths),
+                                        status="started",
+                                        num_shards=num_shards)
+  selection.set_shard_meta(shard_meta)
+
+  todo = [(video_id, remote_file_path)
+          for video_id, remote_file_path in enumerate(file_paths)
+          if video_id not in done]
+
+  stage_secs = {"download": 0.0, "decode": 0.0, "write": 0.0}
+  start = time.time()
+  num_written = 0
+  pending = {}
+
+  with selection.batched_writer(max_in_flight=max_in_flight_batches) as writer:
+
+    for video_id, remote_file_path, video_secs in extract_videos(todo, writer):
+
+      for stage, secs in video_secs.items():
+        stage_secs[stage] += secs
+
+      checkpoint_start = time.time()
+
+      pending[video_id] = _video_progress_record(remote_file_path, **settings)
+      num_written += 1
+
+      # Videos are only recorded as done once their writes have completed.
+      checkpoint = len(pending) >= checkpoint_every
+      if checkpoint:
+        writer.flush()
+        selection.set_video_progress(shard_id=shard_id, progress=pending)
+        pending = {}
+
+      stage_secs["write"] += time.time() - checkpoint_start
+
+      if checkpoint:
+        _log_stage_throughput(stage_secs,
+                              num_videos=num_written,
+                              elapsed_secs=time.time() - start)
+
+    writer.flush()
+    if pending:
+      selection.set_video_progress(shard_id=shard_id, progress=pending)
+
+  _log_stage_throughput(stage_secs,
+                        num_videos=num_written,
+                        elapsed_secs=time.time() - start)
+
+  # Only mark the shard finished once all of its writes have completed.
+  shard_meta.status = "finished"
+
+  selection.set_shard_meta(shard_meta)
+
+  return num_written
+
+
 def extract_to_cbt(manifest_path,
                    project,
                    instance,
@@ -187,8 +501,36 @@ def extract_to_cbt(manifest_path,
                    downsample_xy_dims=64,
                    greyscale=True,
                    resample_every=2,
-                   audio_block_size=1000):
-  """Data-parallel extraction of input from file path manifest."""
+                   audio_block_size=1000,
+                   max_in_flight_batches=4,
+                   frames_per_row=1,
+                   scale_in_ffmpeg=True,
+                   resume=True,
+                   checkpoint_every=10,
+                   num_workers=1):
+  """Data-parallel extraction of input from file path manifest.
+
+  Progress is checkpointed as a record per video in the meta column
+  family, so a preempted or re-run job skips the videos it has already
+  written and only fills the gaps, see extract_shard.
+
+  Args:
+    max_in_flight_batches(int): The number of mutation batches that may be
+      in flight (per worker) while subsequent videos are downloaded and
+      decoded.
+    frames_per_row(int): The number of consecutive frames to pack into
+      each row, see RawVideoSelection.write_av.
+    scale_in_ffmpeg(bool): Whether frames are converted and downsampled by
+      ffmpeg, see video_file_to_cbt.
+    resume(bool): Whether to skip videos recorded as written from the same
+      file and with the same settings by a previous run.
+    checkpoint_every(int): The number of videos extracted between progress
+      checkpoints, each of which waits for in-flight writes.
+    num_workers(int): The number of processes with which to download,
+      decode and write videos, each streaming its videos to the table.
+      Video ids are given by position in the manifest regardless.
+
+  """
 
   tf.logging.info("Processing manifest: %s" % manifest_path)
 
@@ -220,31 +562,65 @@ def extract_to_cbt(manifest_path,
                                           table=table,
                                           prefix=target_prefix)
 
-  shard_meta = cbt_utils.VideoShardMeta(shard_id=shard_id,
-                                        num_videos=0,
-                                        status="started",
-                                        num_shards=num_shards)
-  #selection.set_shard_meta(shard_meta)
-
-  ct = 0
-  for video_id, remote_file_path in enumerate(file_paths):
-
-    video_file_to_cbt(remote_file_path=remote_file_path,
-                      selection=selection,
-                      tmp_dir=tmp_dir,
-                      shard_id=shard_id,
-                      num_shards=num_shards,
-                      video_id=video_id,
-                      downsample_xy_dims=downsample_xy_dims,
-                      greyscale=greyscale,
-                      resample_every=resample_every,
-                      audio_block_size=audio_block_size)
-    ct += 1
-
-  shard_meta.num_videos = ct
-  shard_meta.status = "finished"
-
-  selection.set_shard_meta(shard_meta)
+  settings = dict(downsample_xy_dims=downsample_xy_dims,
+                  greyscale=greyscale,
+                  resample_every=resample_every,
+                  audio_block_size=audio_block_size,
+                  frames_per_row=frames_per_row,
+                  scale_in_ffmpeg=scale_in_ffmpeg)
+
+  def _extract_videos(todo, writer):
+
+    if num_workers <= 1:
+      # Each video is streamed from its decoder to the writer.
+      for video_id, remote_file_path in todo:
+        yield video_id, remote_file_path, video_file_to_cbt(
+            remote_file_path=remote_file_path,
+            selection=selection,
+            tmp_dir=tmp_dir,
+            shard_id=shard_id,
+            num_shards=num_shards,
+            video_id=video_id,
+            downsample_xy_dims=downsample_xy_dims,
+            greyscale=greyscale,
+            resample_every=resample_every,
+            audio_block_size=audio_block_size,
+            writer=writer,
+            frames_per_row=frames_per_row,
+            scale_in_ffmpeg=scale_in_ffmpeg)
+      return
+
+    # Each worker streams its videos to the table with a writer of its
+    # own, so only their stage timings are returned.
+    for extracted in _extracted_videos(
+        todo,
+        _extract_video_file,
+        num_workers=num_workers,
+        selection_kwargs=dict(project=project,
+                              instance=instance,
+                              table=table,
+                              prefix=target_prefix),
+        max_in_flight_batches=max_in_flight_batches,
+        tmp_dir=tmp_dir,
+        shard_id=shard_id,
+        num_shards=num_shards,
+        downsample_xy_dims=downsample_xy_dims,
+        greyscale=greyscale,
+        resample_every=resample_every,
+        audio_block_size=audio_block_size,
+        frames_per_row=frames_per_row,
+        scale_in_ffmpeg=scale_in_ffmpeg):
+      yield extracted
+
+  extract_shard(selection=selection,
+                file_paths=file_paths,
+                extract_videos=_extract_videos,
+                shard_id=shard_id,
+                num_shards=num_shards,
+                settings=settings,
+                resume=resume,
+                checkpoint_every=checkpoint_every,
+                max_in_flight_batches=max_in_flight_batches)
 
   tf.logging.info("Batch extraction complete.")
 
@@ -299,7 +675,9 @@ def main(_):
                  instance=FLAGS.instance,
                  table=FLAGS.table,
                  tmp_dir=FLAGS.tmp_dir,
-                 target_prefix=FLAGS.target_prefix)
+                 target_prefix=FLAGS.target_prefix,
+                 resume=FLAGS.resume,
+                 num_workers=FLAGS.workers)
 
 
 def flag_definitions(flags):
@@ -337,6 +715,12 @@ def flag_definitions(flags):
 
   flags.DEFINE_string('log_verbosity', 'INFO', 'Log verbosity.')
 
+  flags.DEFINE_boolean('resume', True,
+                       'Whether to skip videos written by a previous run.')
+
+  flags.DEFINE_integer('workers', 1,
+                       'Num processes with which to download and decode.')
+
 
 if __name__ == "__main__":
 
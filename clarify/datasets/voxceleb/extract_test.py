@@ -11,10 +11,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import uuid
 import os
 import tensorflow as tf
 import tempfile
+import numpy as np
+import time
 
 from pcml.operations import extract
 from pcml.launcher.kube_test import _testing_run_poll_and_check_job
@@ -22,6 +25,7 @@ from pcml.launcher.kube_test import _testing_run_poll_and_check_job
 from google.cloud.bigtable import row_filters
 
 from pcml.utils import cbt_utils
+from pcml.utils import cbt_test_utils
 
 from pcml.utils.cfg_utils import Config
 
@@ -147,7 +151,12 @@ class TestExtract(tf.test.TestCase):
     self.assertTrue(isinstance(shard_metadata, dict))
     self.assertTrue("train_meta_0" in shard_metadata)
 
-    self.assertEqual(shard_metadata["train_meta_0"].as_dict(),
+    # The time of the last write is recorded along with the counts.
+    recv_shard_metadata = shard_metadata["train_meta_0"]
+    self.assertIsNotNone(recv_shard_metadata.updated_at)
+    expected_shard_metadata.updated_at = recv_shard_metadata.updated_at
+
+    self.assertEqual(recv_shard_metadata.as_dict(),
                      expected_shard_metadata.as_dict())
 
     # Just to double-check we're correctly counting by prefix and not
@@ -157,5 +166,132 @@ class TestExtract(tf.test.TestCase):
     self.assertTrue(not selection.rows_at_least(1))
 
 
+def _fake_extract_videos(todo, writer, extracted, fail_after=None):
+  """Stands in for decoding and writing videos, failing after some."""
+  for i, (video_id, remote_file_path) in enumerate(todo):
+    if i == fail_after:
+      raise RuntimeError("Preempted.")
+    extracted.append(video_id)
+    yield video_id, remote_file_path, {"write": 0.0}
+
+
+def _stub_extract_video(video_id, remote_file_path, delays=None, fail_on=None):
+  """Stands in for _extract_video_file, in a worker process."""
+  if delays:
+    time.sleep(delays[video_id])
+  if video_id == fail_on:
+    raise ValueError("Failed extracting {}.".format(remote_file_path))
+  return {"extracted": remote_file_path}
+
+
+class TestExtractShard(tf.test.TestCase):
+
+  def test_prepare_audio_blocks(self):
+
+    audio = np.random.uniform(-0.5, 0.5, (1001,)).astype(np.float32)
+
+    # Blocks of any sizes are prepared as the audio would be as a whole.
+    blocks = [audio[0:5], audio[5:6], audio[6:6], audio[6:1001]]
+    for resample_every in [1, 2, 3]:
+      prepared = extract._prepare_audio_blocks(blocks,
+                                               resample_every=resample_every)
+      self.assertAllEqual(
+          np.concatenate(list(prepared)),
+          extract._prepare_audio(audio, resample_every=resample_every))
+
+  def test_extracted_videos(self):
+
+    num_videos = 10
+    pulled = []
+
+    def _todo():
+      for video_id in range(num_videos):
+        pulled.append(video_id)
+        yield video_id, "video_{}.mp4".format(video_id)
+
+    # Videos are yielded in order even though later ones finish first,
+    # with no more than max_pending submitted ahead of the one yielded.
+    videos = extract._extracted_videos(
+        _todo(),
+        _stub_extract_video,
+        num_workers=2,
+        max_pending=3,
+        delays=[0.01 * (num_videos - i) for i in range(num_videos)])
+    extracted = [next(videos)]
+    self.assertEqual(len(pulled), 4)
+    extracted.extend(videos)
+    self.assertEqual([video[0] for video in extracted], list(range(num_videos)))
+    self.assertEqual(extracted[3][2], {"extracted": "video_3.mp4"})
+
+    # As they are without a pool.
+    del pulled[:]
+    self.assertEqual(
+        list(extract._extracted_videos(_todo(), _stub_extract_video)),
+        extracted)
+
+    # Errors are raised in the position of the video that failed.
+    for num_workers in [1, 2]:
+      videos = extract._extracted_videos(_todo(),
+                                         _stub_extract_video,
+                                         num_workers=num_workers,
+                                         fail_on=3)
+      self.assertEqual([next(videos)[0] for _ in range(3)], [0, 1, 2])
+      with self.assertRaises(ValueError):
+        next(videos)
+
+  def test_extract_shard_resume(self):
+
+    selection = cbt_utils.RawVideoSelection(project="fake",
+                                            instance="fake",
+                                            table="raw",
+                                            prefix="train",
+                                            client=cbt_test_utils.FakeClient())
+
+    file_paths = ["video_{}.mp4".format(i) for i in range(12)]
+    settings = {"greyscale": True}
+    extracted = []
+
+    def _extract_shard(**kwargs):
+      del extracted[:]
+      kwargs.setdefault("settings", settings)
+      return extract.extract_shard(selection=selection,
+                                   file_paths=file_paths,
+                                   extract_videos=functools.partial(
+                                       _fake_extract_videos,
+                                       extracted=extracted,
+                                       fail_after=kwargs.pop(
+                                           "fail_after", None)),
+                                   checkpoint_every=3,
+                                   **kwargs)
+
+    def _shard_meta():
+      return list(selection.lookup_shard_metadata().values())[0]
+
+    # A run preempted part way has only checkpointed complete batches.
+    with self.assertRaises(RuntimeError):
+      _extract_shard(fail_after=7)
+    self.assertEqual(extracted, list(range(7)))
+    self.assertEqual(sorted(selection.lookup_video_progress(shard_id=0)),
+                     list(range(6)))
+    self.assertEqual(_shard_meta().status, "started")
+    version = cbt_utils.shard_meta_version(selection.lookup_shard_metadata())
+
+    # Resuming extracts only the rest and finishes the shard.
+    self.assertEqual(_extract_shard(), 6)
+    self.assertEqual(extracted, list(range(6, 12)))
+    self.assertEqual(sorted(selection.lookup_video_progress(shard_id=0)),
+                     list(range(12)))
+    self.assertEqual(_shard_meta().status, "finished")
+    self.assertNotEqual(
+        cbt_utils.shard_meta_version(selection.lookup_shard_metadata()),
+        version)
+
+    # Re-running has nothing left to do, unless the settings change or
+    # resuming is disabled.
+    self.assertEqual(_extract_shard(), 0)
+    self.assertEqual(_extract_shard(settings={"greyscale": False}), 12)
+    self.assertEqual(_extract_shard(resume=False), 12)
+
+
 if __name__ == "__main__":
   tf.test.main()
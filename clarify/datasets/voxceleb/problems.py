@@ -141,10 +141,24 @@ class VoxCelebCbt(problem.Problem):
   def generate_max_examples(self):
     return None
 
+  @property
+  def meta_cache_dir(self):
+    # Where samplers cache the raw table's video meta index locally.
+    return os.path.join(tempfile.gettempdir(), "clarify", "meta_index")
+
+  @property
+  def persist_meta_index(self):
+    # Whether a sampler that has to rebuild the video meta index (after
+    # shards have been extracted) writes it to the raw table, so that
+    # samplers started later needn't read every video's meta.
+    return True
+
   def sampling_generator(self, source_selection):
 
     sample_generator = source_selection.sample_av_correspondence_examples(
-        frames_per_video=self.video_shape[0])
+        frames_per_video=self.video_shape[0],
+        meta_cache_dir=self.meta_cache_dir,
+        persist_meta_index=self.persist_meta_index)
 
     generator = example_generator(
         raw_sampler=sample_generator,
@@ -392,7 +406,9 @@ class VoxCelebSingleFrame(VoxCelebCbt):
   def sampling_generator(self, source_selection):
 
     sample_generator = source_selection.sample_av_correspondence_examples(
-        frames_per_video=self.video_shape[0])
+        frames_per_video=self.video_shape[0],
+        meta_cache_dir=self.meta_cache_dir,
+        persist_meta_index=self.persist_meta_index)
 
     generator = example_generator(
         raw_sampler=sample_generator,
@@ -37,6 +37,12 @@ def standardize_audio_array(audio, audio_shape):
   return audio
 
 
+def int16_to_float32(audio_data):
+  """Scale 16 bit PCM samples to floats in [-1, 1]."""
+  audio_data = audio_data / np.iinfo(np.int16).max
+  return audio_data.astype(np.float32)
+
+
 def mp4_to_1d_array(mp4_path, audio_bitrate=44100):
   """Extract audio from MP4 and load as 1d array."""
   with tempfile.TemporaryDirectory() as tmpd:
@@ -46,6 +52,4 @@ def mp4_to_1d_array(mp4_path, audio_bitrate=44100):
         str(audio_bitrate), "-vn", tmp_wav_path
     ])
     audio_data = wavfile.read(tmp_wav_path)[1]
-  audio_data = audio_data / np.iinfo(np.int16).max
-  audio_data = audio_data.astype(np.float32)
-  return audio_data
+  return int16_to_float32(audio_data)
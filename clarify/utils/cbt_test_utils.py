@@ -0,0 +1,426 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-memory stand-in for the parts of Cloud BigTable used by cbt_utils.
+
+Lets selections be exercised (and their round trips counted) without
+access to a Cloud BigTable instance, e.g.
+
+  client = FakeClient()
+  selection = cbt_utils.RawVideoSelection(project="p",
+                                          instance="i",
+                                          table="t",
+                                          prefix="train",
+                                          client=client)
+
+Tables can simulate per-RPC latency (with a long tail), per-row cost, a
+throughput limit, and injected read and write errors, so that batching
+and retry behaviour can be benchmarked reproducibly, e.g.
+
+  client = FakeClient(latency_secs=0.005,
+                      latency_tail_secs=0.01,
+                      max_bytes_per_sec=50e6,
+                      read_error_rate=0.01,
+                      seed=0)
+
+Alternatively `make_client` returns a real client for the Cloud BigTable
+emulator when BIGTABLE_EMULATOR_HOST is set.
+
+"""
+
+import os
+import random
+import re
+import time
+import threading
+
+import numpy as np
+
+from google.api_core import exceptions
+
+
+def _encode(obj):
+  if isinstance(obj, str):
+    return obj.encode()
+  return obj
+
+
+class FakeCell(object):
+
+  def __init__(self, value):
+    self.value = value
+
+
+class FakeRow(object):
+  """A row to be mutated, as obtained from `FakeTable.row`."""
+
+  def __init__(self, row_key, table):
+    self.row_key = row_key
+    self.table = table
+    self._cells = {}
+
+  def set_cell(self, column_family_id, column, value, timestamp=None):
+    family = self._cells.setdefault(column_family_id, {})
+    family[_encode(column)] = _encode(value)
+
+
+class FakePartialRowData(object):
+  """A row as returned by reads, exposing `cells[family][column][0].value`."""
+
+  def __init__(self, row_key, cells):
+    self.row_key = row_key
+    self.cells = {
+        family: {
+            column: [FakeCell(value)] for column, value in columns.items()
+        } for family, columns in cells.items()
+    }
+
+
+class FakeSampleRowKey(object):
+
+  def __init__(self, row_key, offset_bytes):
+    self.row_key = row_key
+    self.offset_bytes = offset_bytes
+
+
+class FakeStatus(object):
+
+  def __init__(self, code=0, message=""):
+    self.code = code
+    self.message = message
+
+
+# The status code of injected write errors, i.e. UNAVAILABLE.
+UNAVAILABLE = 14
+
+
+def _row_num_bytes(row_key, cells):
+  return len(row_key) + sum(
+      len(column) + len(value)
+      for columns in cells.values()
+      for column, value in columns.items())
+
+
+def _in_range(key, row_range):
+  start_key = _encode(row_range.start_key)
+  end_key = _encode(row_range.end_key)
+  start_inclusive = getattr(row_range, "start_inclusive", True)
+  end_inclusive = getattr(row_range, "end_inclusive", False)
+  if start_key:
+    if key < start_key or (key == start_key and not start_inclusive):
+      return False
+  if end_key:
+    if key > end_key or (key == end_key and not end_inclusive):
+      return False
+  return True
+
+
+class FakeTable(object):
+  """Sorted in-memory table that counts the RPCs made against it.
+
+  Args:
+    table_id(str): The name of the table.
+    latency_secs(float): A delay added to every simulated RPC.
+    rows_per_sample(int): The number of rows between the keys returned by
+      sample_row_keys, standing in for tablet boundaries.
+    latency_tail_secs(float): The mean of an exponentially distributed
+      delay added to every RPC, giving latencies a long tail.
+    secs_per_row(float): A delay added per row read or written.
+    max_bytes_per_sec(float): If set, the throughput of a link shared by
+      all RPCs to the table; transfers queue behind each other.
+    read_error_rate(float): The probability that a read fails, raising
+      google.api_core.exceptions.ServiceUnavailable.
+    write_error_rate(float): The probability that each row of a
+      mutate_rows fails with an UNAVAILABLE status.
+    seed(int): Seeds latencies and injected errors.
+
+  """
+
+  def __init__(self,
+               table_id,
+               latency_secs=0.0,
+               rows_per_sample=100,
+               latency_tail_secs=0.0,
+               secs_per_row=0.0,
+               max_bytes_per_sec=None,
+               read_error_rate=0.0,
+               write_error_rate=0.0,
+               seed=None):
+    self.table_id = table_id
+    self.latency_secs = latency_secs
+    self.rows_per_sample = rows_per_sample
+    self.latency_tail_secs = latency_tail_secs
+    self.secs_per_row = secs_per_row
+    self.max_bytes_per_sec = max_bytes_per_sec
+    self.read_error_rate = read_error_rate
+    self.write_error_rate = write_error_rate
+    self.column_families = None
+    self._rows = {}
+    self._lock = threading.Lock()
+    self._random = random.Random(seed)
+    self._link_free_at = 0.0
+    self.reset_counters()
+
+  def reset_counters(self):
+    self.num_rpcs = 0
+    self.num_rows_read = 0
+    self.num_rows_written = 0
+    self.num_bytes_read = 0
+    self.num_bytes_written = 0
+    self.num_read_errors = 0
+    self.num_write_errors = 0
+
+  def _uniform(self):
+    with self._lock:
+      return self._random.random()
+
+  def _rpc(self, read=False):
+    """Count an RPC and apply its fixed latency, maybe failing a read."""
+
+    with self._lock:
+      self.num_rpcs += 1
+      delay = self.latency_secs
+      if self.latency_tail_secs > 0:
+        delay += self._random.expovariate(1.0 / self.latency_tail_secs)
+      failed = read and self._random.random() < self.read_error_rate
+      if failed:
+        self.num_read_errors += 1
+
+    if delay > 0:
+      time.sleep(delay)
+
+    if failed:
+      raise exceptions.ServiceUnavailable("Injected read error.")
+
+  def _transfer(self, num_rows, num_bytes):
+    """Apply the per-row cost and throughput limit of a transfer."""
+
+    delay = self.secs_per_row * num_rows
+
+    if self.max_bytes_per_sec:
+      with self._lock:
+        now = time.time()
+        start = max(now, self._link_free_at)
+        self._link_free_at = start + num_bytes / float(self.max_bytes_per_sec)
+        delay += self._link_free_at - now
+
+    if delay > 0:
+      time.sleep(delay)
+
+  def exists(self):
+    self._rpc()
+    return self.column_families is not None
+
+  def create(self, column_families=None):
+    self._rpc()
+    self.column_families = dict(column_families or {})
+
+  def row(self, row_key):
+    return FakeRow(row_key=_encode(row_key), table=self)
+
+  def mutate_rows(self, rows):
+    self._rpc()
+
+    self._transfer(num_rows=len(rows),
+                   num_bytes=sum(
+                       _row_num_bytes(row.row_key, row._cells) for row in rows))
+
+    statuses = []
+    with self._lock:
+      for row in rows:
+        if self._random.random() < self.write_error_rate:
+          self.num_write_errors += 1
+          statuses.append(
+              FakeStatus(code=UNAVAILABLE, message="Injected write error."))
+          continue
+        stored = self._rows.setdefault(row.row_key, {})
+        for family, columns in row._cells.items():
+          stored.setdefault(family, {}).update(columns)
+        statuses.append(FakeStatus())
+        self.num_rows_written += 1
+        self.num_bytes_written += _row_num_bytes(row.row_key, row._cells)
+    return statuses
+
+  def _partial_row(self, row_key):
+    if row_key not in self._rows:
+      return None
+    return FakePartialRowData(row_key=row_key, cells=self._rows[row_key])
+
+  def _count_reads(self, row_keys):
+    num_bytes = sum(
+        _row_num_bytes(row_key, self._rows[row_key]) for row_key in row_keys)
+    self._transfer(num_rows=len(row_keys), num_bytes=num_bytes)
+    with self._lock:
+      self.num_rows_read += len(row_keys)
+      self.num_bytes_read += num_bytes
+
+  def read_row(self, row_key, filter_=None):
+    self._rpc(read=True)
+    row = self._partial_row(_encode(row_key))
+    if row is not None:
+      self._count_reads([row.row_key])
+    return row
+
+  def sample_row_keys(self):
+    self._rpc(read=True)
+
+    with self._lock:
+      keys = sorted(self._rows.keys())
+
+    samples = [
+        FakeSampleRowKey(row_key=keys[i], offset_bytes=i)
+        for i in range(self.rows_per_sample, len(keys), self.rows_per_sample)
+    ]
+
+    # As with Cloud BigTable the last sample marks the end of the table.
+    samples.append(FakeSampleRowKey(row_key=b"", offset_bytes=len(keys)))
+
+    return iter(samples)
+
+  def _matching_keys(self, start_key, end_key, end_inclusive, filter_, row_set):
+
+    with self._lock:
+      keys = sorted(self._rows.keys())
+
+    start_key = _encode(start_key)
+    end_key = _encode(end_key)
+
+    if row_set is not None:
+      row_set_keys = set(_encode(key) for key in row_set.row_keys)
+
+    def _selected(key):
+      if start_key and key < start_key:
+        return False
+      if end_key and (key > end_key or (key == end_key and not end_inclusive)):
+        return False
+      if row_set is not None:
+        if key not in row_set_keys and not any(
+            _in_range(key, row_range) for row_range in row_set.row_ranges):
+          return False
+      regex = getattr(filter_, "regex", None)
+      if regex is not None:
+        if re.fullmatch(_encode(regex), key, flags=re.DOTALL) is None:
+          return False
+      return True
+
+    return [key for key in keys if _selected(key)]
+
+  def read_rows(self,
+                start_key=None,
+                end_key=None,
+                limit=None,
+                filter_=None,
+                end_inclusive=False,
+                row_set=None):
+    self._rpc(read=True)
+
+    keys = self._matching_keys(start_key=start_key,
+                               end_key=end_key,
+                               end_inclusive=end_inclusive,
+                               filter_=filter_,
+                               row_set=row_set)
+    if limit:
+      keys = keys[:limit]
+
+    rows = [self._partial_row(key) for key in keys]
+
+    self._count_reads(keys)
+
+    return iter(rows)
+
+
+class FakeInstance(object):
+
+  def __init__(self, instance_id, client):
+    self.instance_id = instance_id
+    self._client = client
+    self._tables = {}
+
+  def table(self, table_id):
+    if table_id not in self._tables:
+      self._tables[table_id] = FakeTable(table_id=table_id,
+                                         **self._client.table_kwargs)
+    return self._tables[table_id]
+
+
+class FakeClient(object):
+  """Drop-in for `bigtable.Client`; tables persist for the client lifetime.
+
+  Args:
+    latency_secs(float): A delay added to every simulated RPC.
+    **table_kwargs: Further FakeTable args, e.g. error rates, applied to
+      each of the client's tables.
+
+  """
+
+  def __init__(self, latency_secs=0.0, **table_kwargs):
+    self.latency_secs = latency_secs
+    self.table_kwargs = dict(table_kwargs, latency_secs=latency_secs)
+    self._instances = {}
+
+  def instance(self, instance_id):
+    if instance_id not in self._instances:
+      self._instances[instance_id] = FakeInstance(instance_id=instance_id,
+                                                  client=self)
+    return self._instances[instance_id]
+
+
+def make_client(project="fake", **kwargs):
+  """A client for the Cloud BigTable emulator if one is configured.
+
+  When BIGTABLE_EMULATOR_HOST is set (e.g. by `gcloud beta emulators
+  bigtable env-init`) this is a real bigtable.Client, which then connects
+  to the emulator; otherwise a FakeClient given `kwargs`.
+
+  """
+
+  if os.environ.get("BIGTABLE_EMULATOR_HOST"):
+    from google.cloud import bigtable
+    return bigtable.Client(project=project, admin=True)
+
+  return FakeClient(**kwargs)
+
+
+def write_synthetic_videos(selection,
+                           num_videos=2,
+                           video_length=60,
+                           frame_shape=(8, 8, 1),
+                           audio_length=6000,
+                           audio_block_size=1000,
+                           shard_id=0,
+                           frames_per_row=1):
+  """Write random videos and a finished shard meta to a RawVideoSelection."""
+
+  # Imported here so only users of this helper need the video stack.
+  from clarify.utils import cbt_utils
+  from clarify.utils import video_utils
+
+  for video_id in range(num_videos):
+
+    video = video_utils.Video()
+    for _ in range(video_length):
+      video.insert(np.random.randint(0, 255, frame_shape).astype(np.uint8))
+
+    audio = np.random.randint(0, 255, (audio_length,)).astype(np.uint8)
+
+    selection.write_av(frames=video,
+                       audio=audio,
+                       shard_id=shard_id,
+                       video_id=video_id,
+                       audio_block_size=audio_block_size,
+                       frames_per_row=frames_per_row)
+
+  selection.set_shard_meta(
+      cbt_utils.VideoShardMeta(num_videos=num_videos,
+                               status="finished",
+                               shard_id=shard_id,
+                               num_shards=1))
@@ -14,22 +14,428 @@
 
 import tensorflow as tf
 import numpy as np
+import cv2
 import datetime
+import collections
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
 import json
 import math
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from concurrent import futures
+
+from google.api_core import exceptions
 
 from clarify.utils import video_utils
 
 from google.cloud.bigtable import column_family as cbt_lib_column_family
 from google.cloud import bigtable
 from google.cloud.bigtable import row_filters
+from google.cloud.bigtable.row_set import RowSet
 
 from tensor2tensor.data_generators.generator_utils import to_example
 
 from collections import namedtuple
 
+# Optional compressors, the codecs for which are only registered if they
+# can be imported.
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import lz4.frame as lz4_frame
+except ImportError:
+  lz4_frame = None
+
 MAX_ALLOWABLE_FRAME_AUDIO_KEY_SUFFIX = 9999
 
+# The names of the registered ArrayCodecs with which numpy arrays can be
+# serialized to cells, in order of registration (see register_array_codec
+# and the codecs registered below it).
+ARRAY_ENCODINGS = []
+
+ARRAY_HEADER_MAGIC = b"\x93NDA"
+
+SHARD_STATUSES = ["started", "finished"]
+
+# Clients (and with them their gRPC channels) shared by all selections in a
+# process, keyed by (pid, project, sa_key_path, admin). The pid is included
+# so that forked processes don't share their parent's channels.
+_CLIENT_REGISTRY = {}
+
+# (project, instance, table) that are known to exist.
+_EXISTING_TABLES = set()
+
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_client(project, sa_key_path=None, admin=False):
+  """Obtain a process-wide shared bigtable.Client.
+
+  Args:
+    project(str): A GCP project.
+    sa_key_path(str): Optionally, a path to service account credentials.
+    admin(bool): Whether the client is needed for admin operations such as
+      creating tables; data-only clients are used otherwise.
+
+  """
+
+  key = (os.getpid(), project, sa_key_path, admin)
+
+  with _REGISTRY_LOCK:
+
+    if key not in _CLIENT_REGISTRY:
+
+      if isinstance(sa_key_path, str):
+        client = bigtable.Client.from_service_account_json(sa_key_path,
+                                                           project=project,
+                                                           admin=admin)
+      else:
+        client = bigtable.Client(project=project, admin=admin)
+
+      _CLIENT_REGISTRY[key] = client
+
+    return _CLIENT_REGISTRY[key]
+
+
+def clear_client_registry():
+  """Forget shared clients and cached table existence, e.g. in tests."""
+  with _REGISTRY_LOCK:
+    _CLIENT_REGISTRY.clear()
+    _EXISTING_TABLES.clear()
+
+
+# Errors from which reads are retried by default.
+RETRYABLE_ERRORS = (exceptions.DeadlineExceeded, exceptions.ServiceUnavailable,
+                    exceptions.InternalServerError, exceptions.Aborted)
+
+
+def _remaining_secs(deadline):
+  """The seconds until `deadline`, a time.time(), if there is one."""
+  if deadline is None:
+    return None
+  return max(deadline - time.time(), 0)
+
+
+class ReadPolicy(object):
+  """Deadlines, retries with backoff, and hedging for reads.
+
+  Each call of `call` is attempted up to 1 + `max_retries` times, sleeping
+  between attempts for an exponentially growing delay with full jitter,
+  and gives up once `deadline_secs` have passed overall. With hedging, if
+  an attempt hasn't completed after the `hedge_percentile` of recent
+  latencies (or `hedge_after_secs`) a duplicate is issued and whichever
+  completes first is used.
+
+  Deadlines and hedging run attempts on a thread pool; an attempt that
+  outlives its deadline can't be cancelled and is left to complete in
+  the background. Otherwise attempts run on the calling thread.
+
+  Args:
+    max_retries(int): The maximum number of retries per call.
+    deadline_secs(float): The overall deadline per call, if any.
+    initial_backoff_secs(float): The maximum delay before the first retry.
+    max_backoff_secs(float): The maximum delay before any retry.
+    backoff_multiplier(float): The growth of the delay per retry.
+    hedge_percentile(float): Hedge attempts slower than this percentile
+      of recent latencies, e.g. 95.
+    hedge_after_secs(float): Alternatively, a fixed hedging delay.
+    retryable_errors(tuple): The exception types that are retried.
+    num_workers(int): The size of the thread pool, if one is needed.
+    seed(int): Seeds the backoff jitter.
+
+  """
+
+  # Latencies are kept for this many of the most recent calls.
+  LATENCY_WINDOW = 1000
+
+  # Percentile hedging begins once this many latencies are known.
+  MIN_HEDGE_SAMPLES = 20
+
+  def __init__(self,
+               max_retries=3,
+               deadline_secs=None,
+               initial_backoff_secs=0.05,
+               max_backoff_secs=2.0,
+               backoff_multiplier=2.0,
+               hedge_percentile=None,
+               hedge_after_secs=None,
+               retryable_errors=RETRYABLE_ERRORS,
+               num_workers=16,
+               seed=None):
+
+    if hedge_percentile is not None and not 0 < hedge_percentile < 100:
+      raise ValueError("Expected 0 < hedge_percentile < 100, saw {}".format(
+          hedge_percentile))
+
+    self.max_retries = max_retries
+    self.deadline_secs = deadline_secs
+    self.initial_backoff_secs = initial_backoff_secs
+    self.max_backoff_secs = max_backoff_secs
+    self.backoff_multiplier = backoff_multiplier
+    self.hedge_percentile = hedge_percentile
+    self.hedge_after_secs = hedge_after_secs
+    self.retryable_errors = tuple(retryable_errors)
+    self.num_workers = num_workers
+
+    self.num_calls = 0
+    self.num_attempts = 0
+    self.num_retries = 0
+    self.num_hedges = 0
+    self.num_hedge_wins = 0
+    self.num_failures = 0
+
+    self._latencies = collections.deque(maxlen=self.LATENCY_WINDOW)
+    self._random = np.random.RandomState(seed)
+    self._lock = threading.Lock()
+    self._executor = None
+
+  def _uses_executor(self):
+    return (self.deadline_secs is not None or
+            self.hedge_percentile is not None or
+            self.hedge_after_secs is not None)
+
+  def _get_executor(self):
+    with self._lock:
+      if self._executor is None:
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self.num_workers)
+      return self._executor
+
+  def _hedge_delay(self):
+    if self.hedge_after_secs is not None:
+      return self.hedge_after_secs
+    if self.hedge_percentile is None:
+      return None
+    with self._lock:
+      if len(self._latencies) < self.MIN_HEDGE_SAMPLES:
+        return None
+      return np.percentile(self._latencies, self.hedge_percentile)
+
+  def _backoff(self, retry):
+    limit = min(self.max_backoff_secs,
+                self.initial_backoff_secs * self.backoff_multiplier**retry)
+    with self._lock:
+      return self._random.uniform(0, limit)
+
+  def _attempt(self, fn, deadline):
+
+    with self._lock:
+      self.num_attempts += 1
+
+    if not self._uses_executor():
+      return fn()
+
+    executor = self._get_executor()
+
+    attempts = [executor.submit(fn)]
+    self._maybe_hedge(executor, fn, attempts, deadline)
+
+    return self._first_result(attempts, deadline)
+
+  def _maybe_hedge(self, executor, fn, attempts, deadline):
+    """Add a duplicate to `attempts` if the first outlives the hedge delay."""
+
+    hedge_delay = self._hedge_delay()
+    if hedge_delay is None:
+      return
+
+    remaining = _remaining_secs(deadline)
+    if remaining is not None and hedge_delay >= remaining:
+      return
+
+    done, _ = futures.wait(attempts, timeout=hedge_delay)
+    if done:
+      return
+
+    attempts.append(executor.submit(fn))
+    with self._lock:
+      self.num_hedges += 1
+      self.num_attempts += 1
+
+  def _first_result(self, attempts, deadline):
+    """The result of the first of `attempts` to succeed, by `deadline`."""
+
+    pending = set(attempts)
+    error = None
+
+    while pending:
+
+      done, pending = futures.wait(pending,
+                                   timeout=_remaining_secs(deadline),
+                                   return_when=futures.FIRST_COMPLETED)
+
+      if not done:
+        raise exceptions.DeadlineExceeded(
+            "Read exceeded its deadline of {}s.".format(self.deadline_secs))
+
+      for future in done:
+        if future.exception() is None:
+          if future is not attempts[0]:
+            with self._lock:
+              self.num_hedge_wins += 1
+          return future.result()
+        error = future.exception()
+
+    raise error
+
+  def call(self, fn, *args, **kwargs):
+    """Call `fn(*args, **kwargs)` according to the policy."""
+
+    start = time.time()
+    deadline = None
+    if self.deadline_secs is not None:
+      deadline = start + self.deadline_secs
+
+    with self._lock:
+      self.num_calls += 1
+
+    retry = 0
+
+    while True:
+
+      try:
+        attempt_start = time.time()
+        result = self._attempt(lambda: fn(*args, **kwargs), deadline)
+        # The latency of the successful attempt, excluding prior attempts
+        # and backoff, as hedging delays are relative to an attempt.
+        with self._lock:
+          self._latencies.append(time.time() - attempt_start)
+        return result
+
+      except self.retryable_errors as e:
+
+        backoff = self._backoff(retry)
+
+        if retry >= self.max_retries or (deadline is not None and
+                                         time.time() + backoff >= deadline):
+          with self._lock:
+            self.num_failures += 1
+          raise
+
+        tf.logging.info("Retrying read after {:.3f}s, error: {}".format(
+            backoff, e))
+
+        time.sleep(backoff)
+
+        with self._lock:
+          self.num_retries += 1
+        retry += 1
+
+  def iterate(self, read):
+    """Yield the items of a stream, resuming it if it fails part way.
+
+    Streams aren't subject to the deadline or hedging of `call`, but a
+    retryable error while reading is retried (with backoff, up to
+    `max_retries` consecutive times without progress) by resuming after
+    the last item that was yielded, so that none are skipped or repeated.
+
+    Args:
+      read(callable): Given the last item yielded (None at first),
+        returns an iterator of the items that follow it.
+
+    Yields:
+      The items of the stream.
+
+    """
+
+    with self._lock:
+      self.num_calls += 1
+
+    retry = 0
+    last = None
+
+    while True:
+
+      with self._lock:
+        self.num_attempts += 1
+
+      try:
+        for item in read(last):
+          last = item
+          retry = 0
+          yield item
+        return
+
+      except self.retryable_errors as e:
+
+        if retry >= self.max_retries:
+          with self._lock:
+            self.num_failures += 1
+          raise
+
+        backoff = self._backoff(retry)
+
+        tf.logging.info("Resuming read after {:.3f}s, error: {}".format(
+            backoff, e))
+
+        time.sleep(backoff)
+
+        with self._lock:
+          self.num_retries += 1
+        retry += 1
+
+  def stats(self):
+    """Call counts and p50/p99 latencies (of successful attempts)."""
+
+    with self._lock:
+      latencies = np.array(self._latencies)
+      stats = {
+          "num_calls": self.num_calls,
+          "num_attempts": self.num_attempts,
+          "num_retries": self.num_retries,
+          "num_hedges": self.num_hedges,
+          "num_hedge_wins": self.num_hedge_wins,
+          "num_failures": self.num_failures,
+          "retry_rate": self.num_retries / float(max(self.num_calls, 1))
+      }
+
+    for percentile in [50, 99]:
+      stats["p{}_secs".format(percentile)] = (float(
+          np.percentile(latencies, percentile)) if len(latencies) else None)
+
+    return stats
+
+
+def _put_unless_stopped(q, item, stop):
+  """Put `item` on `q`, giving up if `stop` is set while `q` is full."""
+  while not stop.is_set():
+    try:
+      q.put(item, timeout=0.1)
+      return
+    except queue.Full:
+      continue
+
+
+def _merge_queues(queues, num_readers, done):
+  """Yield the items of each of `queues` in turn, re-raising errors.
+
+  Each queue is drained until it has yielded `done` once for each of its
+  `num_readers`.
+
+  """
+  for q, remaining in zip(queues, num_readers):
+    while remaining > 0:
+      item = q.get()
+      if item is done:
+        remaining -= 1
+      elif isinstance(item, Exception):
+        raise item
+      else:
+        yield item
+
 
 class BigTableSelection(object):
 
@@ -42,10 +448,23 @@ class BigTableSelection(object):
                sa_key_path=None,
                column_qualifier=None,
                column_family=None,
+               client=None,
+               row_cache=None,
+               read_policy=None,
                *args,
                **kwargs):
 
     self.project = project
+
+    # The ReadPolicy with which point reads and scans of bounded size are
+    # made, see `_read`, and with which streaming scans are resumed, see
+    # `_read_rows`.
+    if read_policy is None:
+      read_policy = ReadPolicy()
+    self.read_policy = read_policy
+
+    # Optionally, a RowCache in front of read_rows_by_keys.
+    self.row_cache = row_cache
     self.instance_name = instance
     self.prefix = prefix
     self.column_qualifier = column_qualifier
@@ -68,51 +487,259 @@ class BigTableSelection(object):
 
     self.table_name = table
 
-    self.materialize(sa_key_path=sa_key_path)
+    self.materialize(sa_key_path=sa_key_path, client=client)
 
-  def materialize(self, sa_key_path=None):
+  def materialize(self, sa_key_path=None, client=None):
 
-    if isinstance(sa_key_path, str):
-      self.client = bigtable.Client.from_service_account_json(sa_key_path,
-                                                              admin=True)
+    if client is not None:
+      # E.g. a cbt_test_utils.FakeClient when running without a CBT instance.
+      self.client = client
     else:
-      self.client = bigtable.Client(admin=True)
+      # Reads and writes only need a data client, shared process-wide.
+      self.client = get_client(project=self.project, sa_key_path=sa_key_path)
 
     self.instance = self.client.instance(self.instance_name)
 
     self.table = self.instance.table(self.table_name)
 
-    if self.table.exists():
+    table_key = (self.project, self.instance_name, self.table_name)
+
+    if client is None and table_key in _EXISTING_TABLES:
       return
 
-    max_versions_rule = cbt_lib_column_family.MaxVersionsGCRule(1)
-    cf = {key: max_versions_rule for key in self.column_families}
-    self.table.create(column_families=cf)
+    # Checking for and creating the table require the admin API.
+    if client is None:
+      admin_client = get_client(project=self.project,
+                                sa_key_path=sa_key_path,
+                                admin=True)
+      admin_table = admin_client.instance(self.instance_name).table(
+          self.table_name)
+    else:
+      admin_table = self.table
 
-  def get_basic_row_iterator(self):
-    """Convenience function to obtain iterator, maybe using prefix."""
+    if not admin_table.exists():
+      max_versions_rule = cbt_lib_column_family.MaxVersionsGCRule(1)
+      cf = {key: max_versions_rule for key in self.column_families}
+      admin_table.create(column_families=cf)
 
-    table = self.table
+    if client is None:
+      with _REGISTRY_LOCK:
+        _EXISTING_TABLES.add(table_key)
+
+  def _read(self, fn, *args, **kwargs):
+    """Make a read, e.g. `self.table.read_row`, under the read policy.
+
+    As it may be retried `fn` should perform the whole read, i.e. consume
+    any stream of rows.
+
+    """
+    return self.read_policy.call(fn, *args, **kwargs)
+
+  def prefix_key_range(self):
+    """The (start_key, end_key) range of the selection's prefix, if any."""
+
+    if not isinstance(self.prefix, str):
+      return None, None
+
+    prefix = self.prefix
+
+    # Prefixes were previously allowed to be given in regex form.
+    if prefix.endswith(".*"):
+      prefix = prefix[:-2]
+
+    start_key = prefix.encode()
+
+    return start_key, prefix_end_key(start_key)
+
+  def get_basic_row_iterator(self, limit=None, filter_=None):
+    """Convenience function to obtain iterator, maybe using prefix.
+
+    Rows with the selection's prefix are read as a key range, i.e. by
+    seeking to the prefix rather than by filtering the whole table.
+
+    Args:
+      limit(int): The maximum number of rows to read, if any.
+      filter_(RowFilter): An optional filter to apply to rows.
+
+    """
+
+    start_key, end_key = self.prefix_key_range()
+
+    return self._read_rows(start_key=start_key,
+                           end_key=end_key,
+                           limit=limit,
+                           filter_=filter_)
+
+  def _read_rows(self, start_key=None, end_key=None, limit=None, filter_=None):
+    """Stream the rows of a key range, resumed by the read policy on error.
+
+    Args:
+      start_key(bytes): The first key of the range, if any.
+      end_key(bytes): The (exclusive) end of the range, if any.
+      limit(int): The maximum number of rows to read, if any.
+      filter_(RowFilter): An optional filter to apply to rows.
+
+    Returns:
+      An iterator of rows.
+
+    """
+
+    num_read = [0]
+
+    def _read_after(last_row):
+
+      resume_key = start_key
+      if last_row is not None:
+        # The smallest key following that of the last row.
+        resume_key = last_row.row_key + b"\x00"
+
+      remaining = None
+      if limit is not None:
+        remaining = limit - num_read[0]
+        if remaining <= 0:
+          return
+
+      for row in self.table.read_rows(start_key=resume_key,
+                                      end_key=end_key,
+                                      limit=remaining,
+                                      filter_=filter_):
+        num_read[0] += 1
+        yield row
+
+    return self.read_policy.iterate(_read_after)
+
+  def key_range_splits(self, max_splits=None):
+    """Split the prefix's key range at the table's sampled row keys.
+
+    Args:
+      max_splits(int): If provided, sampled keys are thinned so that at
+        most this many ranges are returned.
 
-    row_filter = None
+    Returns:
+      list: Contiguous (start_key, end_key) ranges covering the prefix.
 
-    if isinstance(self.prefix, str):
+    """
+
+    start_key, end_key = self.prefix_key_range()
+
+    boundaries = []
+    for sample in self._read(lambda: list(self.table.sample_row_keys())):
+      key = sample.row_key
+      if not key:
+        continue
+      if start_key and key <= start_key:
+        continue
+      if end_key and key >= end_key:
+        continue
+      boundaries.append(key)
+
+    boundaries = sorted(set(boundaries))
+
+    if max_splits and len(boundaries) >= max_splits:
+      step = len(boundaries) / float(max_splits)
+      boundaries = [boundaries[int(i * step)] for i in range(1, max_splits)]
+
+    edges = [start_key] + boundaries + [end_key]
+
+    return list(zip(edges[:-1], edges[1:]))
+
+  def parallel_scan(self,
+                    num_workers=8,
+                    ordered=False,
+                    filter_=None,
+                    splits_per_worker=4,
+                    max_buffered_rows=1000):
+    """Read the selection's rows with concurrent reads of key range splits.
+
+    Args:
+      num_workers(int): The number of concurrent reads.
+      ordered(bool): Whether rows should be yielded in key order; otherwise
+        they are yielded as they arrive.
+      filter_(RowFilter): An optional filter to apply to rows.
+      splits_per_worker(int): How finely to split the key range, with
+        more splits balancing uneven ranges across workers.
+      max_buffered_rows(int): Bounds the rows read ahead of the consumer.
+
+    Yields:
+      Rows of the selection.
+
+    """
+
+    splits = self.key_range_splits(max_splits=num_workers * splits_per_worker)
 
-      prefix = self.prefix
+    return self.read_key_ranges(key_ranges=splits,
+                                num_workers=num_workers,
+                                ordered=ordered,
+                                filter_=filter_,
+                                max_buffered_rows=max_buffered_rows)
 
-      if not prefix.endswith(".*"):
-        prefix += ".*"
+  def read_key_ranges(self,
+                      key_ranges,
+                      num_workers=8,
+                      ordered=False,
+                      filter_=None,
+                      max_buffered_rows=1000):
+    """Read a list of (start_key, end_key) ranges concurrently.
 
-      row_filter = row_filters.RowKeyRegexFilter(regex=prefix)
+    See parallel_scan for args; when `ordered` rows are yielded in the
+    order of `key_ranges`.
+    """
+
+    # Ordered reads each have their own queue, drained in turn, whereas
+    # unordered reads share one.
+    num_queues = len(key_ranges) if ordered else 1
+    queues = [
+        queue.Queue(maxsize=max(1, max_buffered_rows // num_queues))
+        for _ in range(num_queues)
+    ]
+    num_readers = [1] * num_queues if ordered else [len(key_ranges)]
 
-    partial_rows = table.read_rows(filter_=row_filter)
+    done = object()
+    stop = threading.Event()
 
-    return partial_rows
+    executor = futures.ThreadPoolExecutor(max_workers=num_workers)
+
+    def _generator():
+      try:
+        for i, key_range in enumerate(key_ranges):
+          executor.submit(self._read_key_range_to_queue, key_range,
+                          queues[i % num_queues], filter_, stop, done)
+
+        for row in _merge_queues(queues, num_readers, done):
+          yield row
+      finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+    return _generator()
+
+  def _read_key_range_to_queue(self, key_range, q, filter_, stop, done):
+    """Put the rows of `key_range` on `q`, then any error, then `done`."""
+    try:
+      for row in self._read_rows(start_key=key_range[0],
+                                 end_key=key_range[1],
+                                 filter_=filter_):
+        if stop.is_set():
+          return
+        _put_unless_stopped(q, row, stop)
+    except Exception as e:  # Re-raised by the consumer
+      _put_unless_stopped(q, e, stop)
+    _put_unless_stopped(q, done, stop)
 
   def rows_at_least(self, min_rows=1):
-    """That there are at least `min_rows` in the table."""
+    """That there are more than `min_rows` in the table.
 
-    iterator = self.get_basic_row_iterator()
+    Reads no more than the rows needed to answer and strips their values.
+    """
+
+    # Only the existence of rows matters, not their contents
+    row_filter = row_filters.RowFilterChain(filters=[
+        row_filters.CellsRowLimitFilter(1),
+        row_filters.StripValueTransformerFilter(True)
+    ])
+
+    iterator = self.get_basic_row_iterator(limit=int(math.floor(min_rows)) + 1,
+                                           filter_=row_filter)
 
     i = 0
 
@@ -123,6 +750,48 @@ class BigTableSelection(object):
 
     return i > min_rows
 
+  def read_rows_by_keys(self, keys):
+    """Read an arbitrary list of row keys in a single round trip.
+
+    Args:
+      keys(list): Row keys (str or bytes), possibly with duplicates.
+
+    Returns:
+      dict: A mapping from (bytes) row key to row for each of `keys`
+        that was present in the table.
+
+    """
+
+    row_set = RowSet()
+    unique_keys = set()
+    rows = {}
+
+    for key in keys:
+      key = _maybe_encode_str(key)
+      if key in unique_keys:
+        continue
+      unique_keys.add(key)
+      if self.row_cache is not None:
+        row = self.row_cache.get(key)
+        if row is not None:
+          rows[key] = row
+          continue
+      row_set.add_row_key(key)
+
+    if len(rows) == len(unique_keys):
+      return rows
+
+    for row in self._read(lambda: list(self.table.read_rows(row_set=row_set))):
+      if self.row_cache is not None:
+        row = self.row_cache.put(row)
+      rows[row.row_key] = row
+
+    return rows
+
+  def batched_writer(self, **kwargs):
+    """A BatchedRowWriter for this selection's table, see its args."""
+    return BatchedRowWriter(table=self.table, **kwargs)
+
   def as_dict(self):
     return {
         "table_name": self.table_name,
@@ -146,6 +815,12 @@ def _maybe_decode_bytes(obj):
   return obj
 
 
+def _maybe_encode_str(obj):
+  if isinstance(obj, str):
+    return obj.encode()
+  return obj
+
+
 class AVCorrespondenceSample(object):
 
   def __init__(self, video, audio, labels, meta):
@@ -227,9 +902,7 @@ class AVCorrespondenceSample(object):
         "audioKeys": [
             _maybe_decode_bytes(key) for key in self.meta["audio_keys"]
         ],
-        "frameKeys": [
-            _maybe_decode_bytes(key) for key in self.meta["frame_keys"]
-        ],
+        "frameKeys": [dump_frame_key(key) for key in self.meta["frame_keys"]],
         "audioSampleBounds": [int(abm["query_start"]),
                               int(abm["query_end"])],
         "labels": self.labels
@@ -242,17 +915,45 @@ class AVCorrespondenceSample(object):
 
 class VideoMeta(object):
 
+  __slots__ = [
+      "_video_length", "_audio_length", "_video_id", "_shard_id",
+      "_audio_block_size", "_frame_shape", "_frame_encoding", "_audio_encoding",
+      "_frames_per_row"
+  ]
+
   def __init__(self,
                video_length,
                audio_length,
                video_id,
                shard_id,
-               audio_block_size=256):
+               audio_block_size=256,
+               frame_shape=None,
+               frame_encoding="uint8",
+               audio_encoding="uint8",
+               frames_per_row=1):
     self.video_length = video_length
     self.audio_length = audio_length
     self.video_id = video_id
     self.shard_id = shard_id
     self.audio_block_size = audio_block_size
+    self.frame_shape = frame_shape
+    self.frame_encoding = frame_encoding
+    self.audio_encoding = audio_encoding
+    self.frames_per_row = frames_per_row
+
+  @classmethod
+  def from_dict(cls, d):
+    # Fields added after the original five are optional so that metadata
+    # written by earlier versions can still be read.
+    return cls(video_length=d["video_length"],
+               audio_length=d["audio_length"],
+               video_id=d["video_id"],
+               shard_id=d["shard_id"],
+               audio_block_size=d["audio_block_size"],
+               frame_shape=d.get("frame_shape"),
+               frame_encoding=d.get("frame_encoding", "uint8"),
+               audio_encoding=d.get("audio_encoding", "uint8"),
+               frames_per_row=d.get("frames_per_row", 1))
 
   @property
   def video_length(self):
@@ -300,23 +1001,76 @@ class VideoMeta(object):
     assert x > 0
     self._audio_block_size = x
 
+  @property
+  def frame_shape(self):
+    return self._frame_shape
+
+  @frame_shape.setter
+  def frame_shape(self, x):
+    # Optional given videos written before frame shapes were recorded.
+    if x is not None:
+      x = [int(dim) for dim in x]
+      assert len(x) > 0
+    self._frame_shape = x
+
+  @property
+  def frame_encoding(self):
+    return self._frame_encoding
+
+  @frame_encoding.setter
+  def frame_encoding(self, x):
+    assert x in ARRAY_ENCODINGS
+    self._frame_encoding = x
+
+  @property
+  def audio_encoding(self):
+    return self._audio_encoding
+
+  @audio_encoding.setter
+  def audio_encoding(self, x):
+    assert x in ARRAY_ENCODINGS
+    self._audio_encoding = x
+
+  @property
+  def frames_per_row(self):
+    return self._frames_per_row
+
+  @frames_per_row.setter
+  def frames_per_row(self, x):
+    # 1 for a row per frame, otherwise see make_frame_chunk_key.
+    assert isinstance(x, int)
+    assert x > 0
+    self._frames_per_row = x
+
   def as_dict(self):
     return {
         "video_length": self.video_length,
         "audio_length": self.audio_length,
         "video_id": self.video_id,
         "shard_id": self.shard_id,
-        "audio_block_size": self.audio_block_size
+        "audio_block_size": self.audio_block_size,
+        "frame_shape": self.frame_shape,
+        "frame_encoding": self.frame_encoding,
+        "audio_encoding": self.audio_encoding,
+        "frames_per_row": self.frames_per_row
     }
 
 
 class VideoShardMeta(object):
+  """The status of an extraction shard.
+
+  `updated_at` is the time at which the meta was last written (set by
+  set_shard_meta), so that re-writing a shard changes its meta even when
+  its counts and status are unchanged, see shard_meta_version.
+
+  """
 
-  def __init__(self, num_videos, status, shard_id, num_shards):
+  def __init__(self, num_videos, status, shard_id, num_shards, updated_at=None):
     self.num_videos = num_videos
     self.status = status
     self.shard_id = shard_id
     self.num_shards = num_shards
+    self.updated_at = updated_at
 
   @property
   def num_videos(self):
@@ -333,7 +1087,7 @@ class VideoShardMeta(object):
 
   @status.setter
   def status(self, x):
-    assert x in ["started", "finished"]
+    assert x in SHARD_STATUSES
     self._status = x
 
   @property
@@ -359,8 +1113,212 @@ class VideoShardMeta(object):
         "num_videos": self.num_videos,
         "shard_id": self.shard_id,
         "status": self.status,
-        "num_shards": self.num_shards
+        "num_shards": self.num_shards,
+        "updated_at": self.updated_at
+    }
+
+
+class VideoMetaIndex(object):
+  """Columnar index of the VideoMeta of each video in a raw table.
+
+  Holds one numpy array per VideoMeta field so that the metadata for
+  millions of videos is compact, cheap to (de)serialize, and can be
+  persisted as a single blob. Indexing returns a VideoMeta so the index
+  can stand in for a list of them.
+
+  Args:
+    columns(dict): A mapping from each of VideoMetaIndex.COLUMNS to an
+      array with one entry per video.
+    version(str): Identifies the shard meta state the index was built
+      from, see shard_meta_version.
+
+  """
+
+  COLUMNS = [
+      "video_id", "shard_id", "video_length", "audio_length",
+      "audio_block_size", "frame_shape", "frame_encoding", "audio_encoding",
+      "frames_per_row"
+  ]
+
+  # Frame shapes are stored zero-padded to this many dimensions.
+  MAX_FRAME_NDIM = 4
+
+  def __init__(self, columns, version=None):
+    missing = [key for key in self.COLUMNS if key not in columns]
+    if missing:
+      raise ValueError("Index is missing columns {}".format(missing))
+    self.columns = {key: np.asarray(columns[key]) for key in self.COLUMNS}
+    self.version = version
+    self.validate()
+
+  def validate(self):
+    """Check the constraints VideoMeta enforces, for all videos at once."""
+
+    c = self.columns
+    num_videos = len(c["video_id"])
+
+    for key in self.COLUMNS:
+      if len(c[key]) != num_videos:
+        raise ValueError("Expected {} values of {}, saw {}".format(
+            num_videos, key, len(c[key])))
+
+    for key in [
+        "video_length", "audio_length", "audio_block_size", "frames_per_row"
+    ]:
+      invalid = np.flatnonzero(c[key] <= 0)
+      if len(invalid):
+        raise ValueError("Expected {} > 0, saw {} for videos {}".format(
+            key, c[key][invalid[:10]], c["video_id"][invalid[:10]]))
+
+    for key in ["frame_encoding", "audio_encoding"]:
+      if np.any((c[key] < 0) | (c[key] >= len(ARRAY_ENCODINGS))):
+        raise ValueError("Saw {} not in {}".format(key, ARRAY_ENCODINGS))
+
+    frame_shape = c["frame_shape"]
+    if num_videos and (frame_shape.ndim != 2 or frame_shape.shape[1]
+                       != self.MAX_FRAME_NDIM or np.any(frame_shape < 0)):
+      raise ValueError("Saw invalid frame_shape column of shape {}".format(
+          frame_shape.shape))
+
+  @classmethod
+  def from_video_meta(cls, video_metas, version=None):
+    """Build from VideoMeta objects, e.g. for compatibility."""
+    return cls.from_dicts([meta.as_dict() for meta in video_metas],
+                          version=version)
+
+  def to_video_meta(self):
+    """The list of VideoMeta objects the index stands in for."""
+    return [self[i] for i in range(len(self))]
+
+  def take(self, indices):
+    """A VideoMetaIndex of the videos at `indices`."""
+    return VideoMetaIndex(columns={
+        key: value[indices] for key, value in self.columns.items()
+    },
+                          version=self.version)
+
+  def sample_indices(self, size, random_state=None):
+    """Sample `size` (an int or shape) video indices, uniformly at random.
+
+    Args:
+      size: The number or shape of indices to sample.
+      random_state(np.random.RandomState): Optionally, the source of
+        randomness; np.random by default.
+
+    """
+
+    if not len(self):
+      raise ValueError("Can't sample from an empty VideoMetaIndex.")
+
+    if random_state is None:
+      random_state = np.random
+
+    return random_state.randint(0, len(self), size)
+
+  @classmethod
+  def from_dicts(cls, video_meta_dicts, version=None):
+    """Build from VideoMeta.as_dict-style dicts, e.g. parsed meta rows."""
+
+    values = {key: [] for key in cls.COLUMNS}
+
+    for d in video_meta_dicts:
+      for key in ["video_id", "shard_id", "video_length", "audio_length"]:
+        values[key].append(d[key])
+      values["audio_block_size"].append(d["audio_block_size"])
+      values["frames_per_row"].append(d.get("frames_per_row", 1))
+      frame_shape = list(d.get("frame_shape") or [])
+      values["frame_shape"].append(frame_shape + [0] *
+                                   (cls.MAX_FRAME_NDIM - len(frame_shape)))
+      values["frame_encoding"].append(
+          ARRAY_ENCODINGS.index(d.get("frame_encoding", "uint8")))
+      values["audio_encoding"].append(
+          ARRAY_ENCODINGS.index(d.get("audio_encoding", "uint8")))
+
+    columns = {
+        key: np.asarray(values[key], dtype=np.int64) for key in [
+            "video_id", "shard_id", "video_length", "audio_length",
+            "audio_block_size", "frames_per_row"
+        ]
     }
+    columns["frame_shape"] = np.asarray(values["frame_shape"],
+                                        dtype=np.int32).reshape(
+                                            (-1, cls.MAX_FRAME_NDIM))
+    for key in ["frame_encoding", "audio_encoding"]:
+      columns[key] = np.asarray(values[key], dtype=np.int8)
+
+    return cls(columns=columns, version=version)
+
+  def __len__(self):
+    return len(self.columns["video_id"])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __getitem__(self, i):
+    c = self.columns
+    frame_shape = [int(dim) for dim in c["frame_shape"][i] if dim > 0]
+    return VideoMeta(video_length=int(c["video_length"][i]),
+                     audio_length=int(c["audio_length"][i]),
+                     video_id=int(c["video_id"][i]),
+                     shard_id=int(c["shard_id"][i]),
+                     audio_block_size=int(c["audio_block_size"][i]),
+                     frame_shape=frame_shape or None,
+                     frame_encoding=ARRAY_ENCODINGS[c["frame_encoding"][i]],
+                     audio_encoding=ARRAY_ENCODINGS[c["audio_encoding"][i]],
+                     frames_per_row=int(c["frames_per_row"][i]))
+
+  def to_bytes(self):
+    buf = io.BytesIO()
+    # The encoding columns index into ARRAY_ENCODINGS, which is saved
+    # alongside them as codecs may be registered in a different order by
+    # the reader.
+    np.savez_compressed(buf,
+                        version=np.asarray(self.version or ""),
+                        encodings=np.asarray(ARRAY_ENCODINGS),
+                        **self.columns)
+    return buf.getvalue()
+
+  @classmethod
+  def from_bytes(cls, value):
+    with np.load(io.BytesIO(value), allow_pickle=False) as data:
+      columns = {key: data[key] for key in cls.COLUMNS if key in data.files}
+      version = str(data["version"]) or None
+      encodings = ARRAY_ENCODINGS[0:2]
+      if "encodings" in data.files:
+        encodings = [str(name) for name in data["encodings"]]
+    codes = np.asarray([
+        ARRAY_ENCODINGS.index(get_array_codec(name).name) for name in encodings
+    ],
+                       dtype=np.int8)
+    for key in ["frame_encoding", "audio_encoding"]:
+      columns[key] = codes[columns[key]]
+    # Indexes built before frames could be packed into rows.
+    if "frames_per_row" not in columns:
+      columns["frames_per_row"] = np.ones_like(columns["video_id"])
+    return cls(columns=columns, version=version)
+
+
+def shard_meta_version(all_shard_meta):
+  """A short hash of shard meta, e.g. from lookup_shard_metadata."""
+  state = sorted(
+      json.dumps(meta.as_dict(), sort_keys=True)
+      for meta in all_shard_meta.values())
+  return hashlib.sha1(json.dumps(state).encode()).hexdigest()[0:16]
+
+
+def prefix_end_key(prefix):
+  """The first key after all of those beginning with `prefix`.
+
+  Returns None, i.e. the end of the table, for a prefix of only 0xff bytes.
+  """
+
+  prefix = _maybe_encode_str(prefix).rstrip(b"\xff")
+
+  if not prefix:
+    return None
+
+  return prefix[:-1] + bytes([prefix[-1] + 1])
 
 
 def _validate_shard_meta_key(key):
@@ -383,109 +1341,453 @@ def _validate_shard_meta_key(key):
   assert meta == "meta"
 
 
-def _compose_av_write(table, key, value, column_family, key_tag=None):
-  """Write composition helper.
+def encode_array(array):
+  """Serialize an array's buffer behind a dtype and shape header."""
 
-  Note: Casts numpy array values to uint8.
+  array = np.ascontiguousarray(array)
+  dtype = array.dtype.str.encode()
 
-  """
+  header = struct.pack("<4sB{}sB{}I".format(len(dtype),
+                                            array.ndim), ARRAY_HEADER_MAGIC,
+                       len(dtype), dtype, array.ndim, *array.shape)
 
-  # If it's a dictionary, serialize it to a string
-  if isinstance(value, dict):
-    value = json.dumps(value).encode()
-  elif isinstance(value, np.ndarray):
-    value = bytes(value.astype(np.uint8).flatten().tolist())
-  elif isinstance(value, list):
-    value = bytes(value)
-  elif not isinstance(value, bytes):
-    msg = "Tried to write unrecognized type: {}".format(type(value))
-    raise ValueError(msg)
+  # Joining with a memoryview copies the array buffer exactly once.
+  return b"".join([header, memoryview(array)])
 
-  # Compose key and obtain row
-  #if key_tag is not None:
-  #  key = "{}_{}".format(key, key_tag)
-  #key = key.encode()
 
-  row = table.row(key)
+def decode_array(value):
+  """Inverse of encode_array, returning a read-only view of `value`."""
 
-  # Compose write
-  row.set_cell(column_family_id=column_family,
-               column=column_family,
-               value=value,
-               timestamp=datetime.datetime(1970, 1, 1))
-  #timestamp=datetime.datetime.utcnow())
+  buf = memoryview(value)
 
-  return row
+  if bytes(buf[0:4]) != ARRAY_HEADER_MAGIC:
+    msg = "Value does not begin with an array header, {}".format(bytes(
+        buf[0:4]))
+    raise ValueError(msg)
 
+  dtype_length = buf[4]
+  offset = 5 + dtype_length
+  dtype = np.dtype(bytes(buf[5:offset]).decode())
 
-def audio_blocks_for_indices(start, end, block_size):
+  ndim = buf[offset]
+  offset += 1
+  shape = struct.unpack_from("<{}I".format(ndim), buf, offset)
+  offset += 4 * ndim
 
-  query_length = end - start
+  return np.frombuffer(value, dtype=dtype, offset=offset).reshape(shape)
 
-  min_query_block = int(math.floor(start / block_size))
-  max_query_block = int(math.floor(end / block_size))
-  num_query_blocks = max_query_block - min_query_block + 1
 
-  query_start = start - min_query_block * block_size
-  query_end = query_start + query_length
+class ArrayCodec(object):
+  """Encodes the arrays stored in a column family, e.g. frames or audio.
 
-  return {
-      "min_query_block": min_query_block,
-      "max_query_block": max_query_block,
-      "num_query_blocks": num_query_blocks,
-      "query_start": query_start,
-      "query_end": query_end
-  }
+  Subclasses define a unique `name`, which is what's recorded as the
+  frame_encoding or audio_encoding of a VideoMeta so that readers can
+  decode without further configuration.
 
+  """
 
-def _lex_index(idx):
-  max_allowable_suffix = MAX_ALLOWABLE_FRAME_AUDIO_KEY_SUFFIX
-  tag_length = len(str(max_allowable_suffix))
-  zero_str = "".join([str(0) for _ in range(tag_length)])
-  str_idx = str(idx)
-  diff_len = tag_length - len(str_idx)
-  if diff_len > 0:
-    str_idx = zero_str[0:diff_len] + str_idx
-  letters = "abcdefghij"
-  lexxed = ""
-  for c in str_idx:
-    l = letters[int(c)]
-    lexxed += l
-  return lexxed
+  name = None
 
+  def encode(self, array):
+    raise NotImplementedError()
 
-def make_audio_key(table_prefix, shard_id, video_id, audio_block_id):
+  def decode(self, value):
+    raise NotImplementedError()
 
-  max_allowable_suffix = MAX_ALLOWABLE_FRAME_AUDIO_KEY_SUFFIX
 
-  key = "{}_{}_{}".format(table_prefix, shard_id, video_id)
+class Uint8Codec(ArrayCodec):
+  """Values cast to uint8, written without a header (so also without a
+  shape or dtype)."""
 
-  tag = "audio_{}".format(_lex_index(audio_block_id))
+  name = "uint8"
 
-  return "{}_{}".format(key, tag).encode()
+  def encode(self, array):
+    return array.astype(np.uint8, copy=False).tobytes()
 
+  def decode(self, value):
+    return np.frombuffer(value, dtype=np.uint8)
 
-def make_frame_key(table_prefix, shard_id, video_id, frame_id):
 
-  max_allowable_suffix = MAX_ALLOWABLE_FRAME_AUDIO_KEY_SUFFIX
+class NdarrayCodec(ArrayCodec):
+  """Arrays of any dtype and shape, see encode_array."""
 
-  key = "{}_{}_{}".format(table_prefix, shard_id, video_id)
+  name = "ndarray"
 
-  tag = "frame_{}".format(_lex_index(frame_id))
+  def encode(self, array):
+    return encode_array(array)
 
-  return "{}_{}".format(key, tag).encode()
+  def decode(self, value):
+    return decode_array(value)
 
 
-def make_shard_meta_key(table_prefix, shard_id):
-  """Construct the key for an individual shard's meta."""
-  key = "{}_meta_{}".format(table_prefix, _lex_index(shard_id))
-  return key.encode()
+class ZlibCodec(ArrayCodec):
+  """An encode_array'd array, compressed with zlib."""
 
+  name = "zlib"
 
-def make_shard_meta_common_prefix(table_prefix):
-  """Construct the key for an individual shard's meta."""
-  key = "{}_meta_.".format(table_prefix)
-  return key
+  def __init__(self, level=6):
+    self.level = level
+
+  def encode(self, array):
+    return zlib.compress(encode_array(array), self.level)
+
+  def decode(self, value):
+    return decode_array(zlib.decompress(value))
+
+
+class DeltaZlibCodec(ZlibCodec):
+  """Differences between consecutive values, compressed with zlib.
+
+  Suited to slowly varying integer signals such as audio, for which the
+  differences are small and compress far better than the values. Integer
+  overflow wraps on both encode and decode so the round trip is exact.
+
+  """
+
+  name = "delta_zlib"
+
+  def encode(self, array):
+    array = np.asarray(array)
+    if array.dtype.kind not in "iu":
+      msg = "Delta encoding requires an integer dtype, saw {}".format(
+          array.dtype)
+      raise ValueError(msg)
+    flat = array.reshape(-1)
+    deltas = np.empty_like(flat)
+    deltas[:1] = flat[:1]
+    np.subtract(flat[1:], flat[:-1], out=deltas[1:])
+    return super(DeltaZlibCodec, self).encode(deltas.reshape(array.shape))
+
+  def decode(self, value):
+    deltas = super(DeltaZlibCodec, self).decode(value)
+    return np.cumsum(deltas.reshape(-1),
+                     dtype=deltas.dtype).reshape(deltas.shape)
+
+
+class PngCodec(ArrayCodec):
+  """Lossless PNG images, for uint8 frames of 1, 3, or 4 channels.
+
+  Decoded single-channel frames lack their channel dimension, which is
+  restored from the frame_shape of the VideoMeta.
+
+  """
+
+  name = "png"
+
+  def __init__(self, compression=3):
+    self.compression = compression
+
+  def encode(self, array):
+    ok, encoded = cv2.imencode(
+        ".png", array.astype(np.uint8, copy=False),
+        [int(cv2.IMWRITE_PNG_COMPRESSION), self.compression])
+    if not ok:
+      raise ValueError("Failed to PNG encode array of shape {}".format(
+          array.shape))
+    return encoded.tobytes()
+
+  def decode(self, value):
+    return cv2.imdecode(np.frombuffer(value, dtype=np.uint8),
+                        cv2.IMREAD_UNCHANGED)
+
+
+class ZstdCodec(ArrayCodec):
+  """An encode_array'd array, compressed with zstd (requires zstandard)."""
+
+  name = "zstd"
+
+  def __init__(self, level=3):
+    self.level = level
+
+  def encode(self, array):
+    return zstandard.ZstdCompressor(level=self.level).compress(
+        encode_array(array))
+
+  def decode(self, value):
+    return decode_array(zstandard.ZstdDecompressor().decompress(value))
+
+
+class Lz4Codec(ArrayCodec):
+  """An encode_array'd array, compressed with lz4 (requires lz4)."""
+
+  name = "lz4"
+
+  def encode(self, array):
+    return lz4_frame.compress(encode_array(array))
+
+  def decode(self, value):
+    return decode_array(lz4_frame.decompress(value))
+
+
+_ARRAY_CODECS = {}
+
+# The packages required by codecs that are only registered if installed.
+_OPTIONAL_CODEC_PACKAGES = {"zstd": "zstandard", "lz4": "lz4"}
+
+
+def register_array_codec(codec):
+  """Make `codec` (an ArrayCodec) available as an encoding by its name."""
+
+  if not isinstance(codec, ArrayCodec) or not codec.name:
+    raise ValueError("Expected a named ArrayCodec, saw {}".format(codec))
+
+  if codec.name not in _ARRAY_CODECS:
+    ARRAY_ENCODINGS.append(codec.name)
+
+  _ARRAY_CODECS[codec.name] = codec
+
+
+def get_array_codec(encoding):
+
+  if encoding not in _ARRAY_CODECS:
+    if encoding in _OPTIONAL_CODEC_PACKAGES:
+      msg = "The {} encoding requires the {} package.".format(
+          encoding, _OPTIONAL_CODEC_PACKAGES[encoding])
+      raise ValueError(msg)
+    msg = "Unrecognized encoding {}, expected one of {}".format(
+        encoding, ARRAY_ENCODINGS)
+    raise ValueError(msg)
+
+  return _ARRAY_CODECS[encoding]
+
+
+for _codec in [
+    Uint8Codec(),
+    NdarrayCodec(),
+    ZlibCodec(),
+    DeltaZlibCodec(),
+    PngCodec()
+]:
+  register_array_codec(_codec)
+
+if zstandard is not None:
+  register_array_codec(ZstdCodec())
+
+if lz4_frame is not None:
+  register_array_codec(Lz4Codec())
+
+
+def _encode_value(value, encoding="uint8"):
+
+  # If it's a dictionary, serialize it to a string
+  if isinstance(value, dict):
+    return json.dumps(value).encode()
+  elif isinstance(value, np.ndarray):
+    return get_array_codec(encoding).encode(value)
+  elif isinstance(value, list):
+    return bytes(value)
+  elif not isinstance(value, bytes):
+    msg = "Tried to write unrecognized type: {}".format(type(value))
+    raise ValueError(msg)
+  return value
+
+
+def _decode_value(value, encoding="uint8"):
+  return get_array_codec(encoding).decode(value)
+
+
+def _compose_av_write(table,
+                      key,
+                      value,
+                      column_family,
+                      key_tag=None,
+                      encoding="uint8"):
+  """Write composition helper.
+
+  Note: With the default `encoding` numpy array values are cast to uint8
+  and written without a header; see ARRAY_ENCODINGS.
+
+  """
+
+  value = _encode_value(value, encoding=encoding)
+
+  # Compose key and obtain row
+  #if key_tag is not None:
+  #  key = "{}_{}".format(key, key_tag)
+  #key = key.encode()
+
+  row = table.row(key)
+
+  # Compose write
+  row.set_cell(column_family_id=column_family,
+               column=column_family,
+               value=value,
+               timestamp=datetime.datetime(1970, 1, 1))
+  #timestamp=datetime.datetime.utcnow())
+
+  return row
+
+
+def audio_blocks_for_indices(start, end, block_size):
+
+  query_length = end - start
+
+  min_query_block = int(math.floor(start / block_size))
+  max_query_block = int(math.floor(end / block_size))
+  num_query_blocks = max_query_block - min_query_block + 1
+
+  query_start = start - min_query_block * block_size
+  query_end = query_start + query_length
+
+  return {
+      "min_query_block": min_query_block,
+      "max_query_block": max_query_block,
+      "num_query_blocks": num_query_blocks,
+      "query_start": query_start,
+      "query_end": query_end
+  }
+
+
+_LEX_DIGITS = str.maketrans("0123456789", "abcdefghij")
+
+
+def _lex_index(idx):
+  """Zero-pad `idx` and spell its digits as letters, e.g. 12 -> "aabc"."""
+  tag_length = len(str(MAX_ALLOWABLE_FRAME_AUDIO_KEY_SUFFIX))
+  if idx < 0:
+    raise ValueError("Expected a non-negative index, saw {}".format(idx))
+  return "{:0{}d}".format(int(idx), tag_length).translate(_LEX_DIGITS)
+
+
+def _lex_indices(indices):
+  """Vectorised _lex_index of an array of indices, as an array of bytes."""
+
+  indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+  tag_length = len(str(MAX_ALLOWABLE_FRAME_AUDIO_KEY_SUFFIX))
+
+  if not len(indices):
+    return np.array([], dtype="S{}".format(tag_length))
+
+  if indices.min() < 0:
+    raise ValueError("Expected non-negative indices, saw {}".format(
+        indices.min()))
+
+  if indices.max() >= 10**tag_length:
+    # Longer than the tag, which _lex_index leaves unpadded.
+    return np.array([_lex_index(idx).encode() for idx in indices])
+
+  # The digits of each index, most significant first, spelled as letters.
+  powers = 10**np.arange(tag_length - 1, -1, -1, dtype=np.int64)
+  letters = (indices[:, None] // powers) % 10 + ord("a")
+
+  return letters.astype(np.uint8).view("S{}".format(tag_length)).reshape(-1)
+
+
+@functools.lru_cache(maxsize=4096)
+def _video_key_prefix(table_prefix, shard_id, video_id, tag):
+  return "{}_{}_{}_{}_".format(table_prefix, shard_id, video_id, tag).encode()
+
+
+def _make_video_keys(table_prefix, shard_id, video_id, tag, indices):
+  prefix = _video_key_prefix(table_prefix, shard_id, video_id, tag)
+  return [prefix + suffix for suffix in _lex_indices(indices).tolist()]
+
+
+def make_audio_key(table_prefix, shard_id, video_id, audio_block_id):
+  prefix = _video_key_prefix(table_prefix, shard_id, video_id, "audio")
+  return prefix + _lex_index(audio_block_id).encode()
+
+
+def make_audio_keys(table_prefix, shard_id, video_id, audio_block_ids):
+  """The make_audio_key of each of an array of `audio_block_ids`."""
+  return _make_video_keys(table_prefix, shard_id, video_id, "audio",
+                          audio_block_ids)
+
+
+def make_frame_key(table_prefix, shard_id, video_id, frame_id):
+  prefix = _video_key_prefix(table_prefix, shard_id, video_id, "frame")
+  return prefix + _lex_index(frame_id).encode()
+
+
+def make_frame_keys(table_prefix, shard_id, video_id, frame_ids):
+  """The make_frame_key of each of an array of `frame_ids`."""
+  return _make_video_keys(table_prefix, shard_id, video_id, "frame", frame_ids)
+
+
+def make_frame_chunk_key(table_prefix, shard_id, video_id, chunk_id):
+  """Construct the key of a row of frames_per_row consecutive frames.
+
+  Frame i of such a video is stored in chunk i // frames_per_row, in the
+  column given by frame_chunk_column(i % frames_per_row).
+
+  """
+  prefix = _video_key_prefix(table_prefix, shard_id, video_id, "frames")
+  return prefix + _lex_index(chunk_id).encode()
+
+
+def make_frame_chunk_keys(table_prefix, shard_id, video_id, chunk_ids):
+  """The make_frame_chunk_key of each of an array of `chunk_ids`."""
+  return _make_video_keys(table_prefix, shard_id, video_id, "frames", chunk_ids)
+
+
+def frame_chunk_column(offset):
+  """The column of the frame at `offset` within a chunk row."""
+  return b"%d" % offset
+
+
+# Separates the row key and column of a packed frame's key when dumped to
+# a string, see dump_frame_key.
+FRAME_KEY_COLUMN_SEPARATOR = "#"
+
+
+def dump_frame_key(frame_key):
+  """A JSON-safe string form of an entry of `frame_keys`.
+
+  Row keys are decoded as they are and (row key, column) tuples of packed
+  frames are joined as "row_key#column", both of which _frame_cell accepts.
+
+  """
+  if isinstance(frame_key, tuple):
+    row_key, column = frame_key
+    return "{}{}{}".format(_maybe_decode_bytes(row_key),
+                           FRAME_KEY_COLUMN_SEPARATOR,
+                           _maybe_decode_bytes(column))
+  return _maybe_decode_bytes(frame_key)
+
+
+def _frame_cell(frame_key):
+  """The (row key, column) of an entry of `frame_keys`.
+
+  These are row keys for videos with a row per frame and otherwise
+  (row key, column) tuples, see RawVideoSelection._frame_keys_for_indices,
+  or either as dumped by dump_frame_key.
+
+  """
+  if isinstance(frame_key, tuple):
+    return frame_key
+  frame_key = _maybe_encode_str(frame_key)
+  separator = FRAME_KEY_COLUMN_SEPARATOR.encode()
+  if separator in frame_key:
+    return tuple(frame_key.rsplit(separator, 1))
+  return frame_key, b"video_frames"
+
+
+def _check_mutate_statuses(rows, statuses):
+  """Raise if any of the `statuses` returned by mutate_rows is an error."""
+
+  failed = [(row, status) for row, status in zip(rows, statuses) if status.code]
+
+  if failed:
+    row, status = failed[0]
+    msg = "Failed writing {} rows, e.g. {}: {}".format(len(failed), row.row_key,
+                                                       status)
+    raise RuntimeError(msg)
+
+
+def _frame_row_keys(frame_keys):
+  return [_frame_cell(frame_key)[0] for frame_key in frame_keys]
+
+
+def make_shard_meta_key(table_prefix, shard_id):
+  """Construct the key for an individual shard's meta."""
+  key = "{}_meta_{}".format(table_prefix, _lex_index(shard_id))
+  return key.encode()
+
+
+def make_shard_meta_common_prefix(table_prefix):
+  """Construct the key for an individual shard's meta."""
+  key = "{}_meta_.".format(table_prefix)
+  return key
 
 
 def make_shard_meta_first_key(table_prefix):
@@ -499,12 +1801,38 @@ def make_shard_meta_last_key(table_prefix, num_shards):
   return key
 
 
+def make_video_meta_index_key(table_prefix):
+  """Construct the key for the persisted VideoMetaIndex of a prefix.
+
+  Note: Deliberately not prefixed by `table_prefix` so that the index row
+  falls outside of every prefix's key range (and so is not seen by scans,
+  row counts or key range splits of the data).
+  """
+  return "~index_{}".format(table_prefix).encode()
+
+
 def make_video_meta_key(table_prefix, shard_id, video_id):
   """Construct a key for an individual video's metadata."""
   key = "{}_{}_meta_{}".format(table_prefix, shard_id, _lex_index(video_id))
   return key.encode()
 
 
+def make_video_meta_key_prefix(table_prefix, shard_id):
+  """The prefix shared by the meta keys of all videos in a shard."""
+  return "{}_{}_meta_".format(table_prefix, shard_id).encode()
+
+
+def make_video_progress_key(table_prefix, shard_id, video_id):
+  """Construct the key of a video's extraction progress record."""
+  key = "{}_{}_progress_{}".format(table_prefix, shard_id, _lex_index(video_id))
+  return key.encode()
+
+
+def make_video_progress_key_prefix(table_prefix, shard_id):
+  """The prefix shared by the progress keys of all videos in a shard."""
+  return "{}_{}_progress_".format(table_prefix, shard_id).encode()
+
+
 def make_video_meta_common_prefix(table_prefix, shard_id):
   """Construct a key for an individual video's metadata."""
   key = "{}_{}_meta_.".format(table_prefix, _lex_index(shard_id))
@@ -523,6 +1851,424 @@ def make_video_meta_last_key(table_prefix, shard_id, num_videos):
   return key
 
 
+class BatchedRowWriter(object):
+  """Writes rows in batches while keeping several batches in flight.
+
+  Rows are buffered into batches of `batch_size` rows (or, when
+  `max_batch_bytes` is given, of at most that many bytes as reported to
+  `write`) that are sent with mutate_rows from a thread pool. Once
+  `max_in_flight` batches are outstanding `write` blocks until one of them
+  completes so the amount of buffered data stays bounded. Rows whose
+  per-row status reports an error are retried (with exponential backoff)
+  up to `max_retries` times.
+
+  Rows are only guaranteed to have been written once `flush` or `close`
+  has returned, each of which raises if any batch ultimately failed, e.g.
+
+    with selection.batched_writer(max_in_flight=8) as writer:
+      for row in rows:
+        writer.write(row)
+
+  """
+
+  def __init__(self,
+               table,
+               batch_size=32,
+               max_in_flight=4,
+               max_retries=3,
+               retry_delay_secs=0.1,
+               max_batch_bytes=None):
+
+    for obj in [batch_size, max_in_flight]:
+      if not isinstance(obj, int) or obj < 1:
+        raise ValueError("Expected an int >= 1, saw {}".format(obj))
+
+    if max_batch_bytes is not None and max_batch_bytes < 1:
+      raise ValueError(
+          "Expected max_batch_bytes >= 1, saw {}".format(max_batch_bytes))
+
+    self.table = table
+    self.batch_size = batch_size
+    self.max_in_flight = max_in_flight
+    self.max_retries = max_retries
+    self.retry_delay_secs = retry_delay_secs
+    self.max_batch_bytes = max_batch_bytes
+
+    self.num_rows_written = 0
+    self.num_rows_retried = 0
+    self.num_batches = 0
+
+    self._rows = []
+    self._num_bytes = 0
+    self._futures = []
+    self._closed = False
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(max_in_flight)
+    self._executor = futures.ThreadPoolExecutor(max_workers=max_in_flight)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+  def write(self, row, num_bytes=0):
+    """Buffer `row`, the cell values of which total `num_bytes`."""
+
+    if self._closed:
+      raise ValueError("Can't write to a closed BatchedRowWriter.")
+
+    self._rows.append(row)
+    self._num_bytes += num_bytes
+
+    if len(self._rows) >= self.batch_size or (
+        self.max_batch_bytes is not None and
+        self._num_bytes >= self.max_batch_bytes):
+      self._submit()
+
+  def _submit(self):
+
+    if not self._rows:
+      return
+
+    rows = self._rows
+    self._rows = []
+    self._num_bytes = 0
+
+    # Back-pressure: wait for a batch to complete if max_in_flight are
+    # already outstanding.
+    self._slots.acquire()
+    future = self._executor.submit(self._mutate, rows)
+    future.add_done_callback(lambda _: self._slots.release())
+    self._futures.append(future)
+
+    # Surface failures as soon as they're known rather than at flush.
+    self._collect(wait=False)
+
+  def _mutate(self, rows):
+
+    attempt = 0
+
+    while True:
+
+      statuses = self.table.mutate_rows(rows)
+      failed = [
+          (row, status) for row, status in zip(rows, statuses) if status.code
+      ]
+
+      with self._lock:
+        self.num_batches += 1
+        self.num_rows_written += len(rows) - len(failed)
+
+      if not failed:
+        return
+
+      if attempt >= self.max_retries:
+        row, status = failed[0]
+        msg = "Failed writing {} rows after {} retries, e.g. {}: {}".format(
+            len(failed), attempt, row.row_key, status)
+        raise RuntimeError(msg)
+
+      with self._lock:
+        self.num_rows_retried += len(failed)
+
+      time.sleep(self.retry_delay_secs * 2**attempt)
+
+      rows = [row for row, _ in failed]
+      attempt += 1
+
+  def _collect(self, wait):
+
+    pending = []
+    error = None
+
+    for future in self._futures:
+      if not wait and not future.done():
+        pending.append(future)
+      elif future.exception() is not None and error is None:
+        error = future.exception()
+
+    self._futures = pending
+
+    if error is not None:
+      raise error
+
+  def flush(self):
+    """Send any partial batch and wait for all batches to complete."""
+    self._submit()
+    self._collect(wait=True)
+
+  def close(self):
+    if self._closed:
+      return
+    try:
+      self.flush()
+    finally:
+      self._closed = True
+      self._executor.shutdown(wait=True)
+
+  def abort(self):
+    """Discard any partial batch and wait for those in flight to finish.
+
+    Unlike close this raises nothing, so as not to mask whatever failure
+    prompted it.
+
+    """
+    self._rows = []
+    self._num_bytes = 0
+    self._futures = []
+    self._closed = True
+    self._executor.shutdown(wait=True)
+
+
+class CachedCell(object):
+
+  def __init__(self, value):
+    self.value = value
+
+
+class CachedRow(object):
+  """A row held by a RowCache, read as `cells[family][column][0].value`."""
+
+  def __init__(self, row_key, values):
+    self.row_key = row_key
+    self.cells = {
+        family: {
+            column: [CachedCell(value)] for column, value in columns.items()
+        } for family, columns in values.items()
+    }
+    self.num_bytes = len(row_key) + sum(
+        len(column) + len(value)
+        for columns in values.values()
+        for column, value in columns.items())
+
+  @classmethod
+  def from_row(cls, row):
+    values = {
+        family: {
+            column: cells[0].value for column, cells in columns.items()
+        } for family, columns in row.cells.items()
+    }
+    return cls(row_key=row.row_key, values=values)
+
+  def values(self):
+    return {
+        family: {
+            column: cells[0].value for column, cells in columns.items()
+        } for family, columns in self.cells.items()
+    }
+
+
+class RowCache(object):
+  """A memory-bounded, read-through LRU cache of rows keyed by row key.
+
+  Rows evicted from memory are, if `cache_dir` is given (e.g. on local
+  SSD), spilled to files there that are themselves evicted LRU once they
+  exceed `max_disk_bytes`. Rows are assumed not to change while cached,
+  as is the case for the frames and audio blocks of extracted videos.
+
+  Args:
+    max_bytes(int): The maximum total size of rows held in memory.
+    cache_dir(str): Optionally, a directory in which to spill rows.
+    max_disk_bytes(int): The maximum total size of rows spilled to disk.
+
+  """
+
+  def __init__(self,
+               max_bytes=256 * 2**20,
+               cache_dir=None,
+               max_disk_bytes=None):
+
+    if max_bytes < 1:
+      raise ValueError("Expected max_bytes >= 1, saw {}".format(max_bytes))
+
+    if max_disk_bytes is None:
+      max_disk_bytes = 8 * max_bytes
+
+    self.max_bytes = max_bytes
+    self.cache_dir = cache_dir
+    self.max_disk_bytes = max_disk_bytes
+
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+
+    self.num_bytes = 0
+    self.num_disk_bytes = 0
+
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+    self._rows = collections.OrderedDict()
+    self._disk_sizes = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._rows)
+
+  def stats(self):
+    return {
+        "hits": self.hits,
+        "disk_hits": self.disk_hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "num_rows": len(self._rows),
+        "num_bytes": self.num_bytes,
+        "num_disk_bytes": self.num_disk_bytes
+    }
+
+  def _path(self, key):
+    return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+
+  def get(self, key):
+    """The cached row for (bytes) `key`, or None if not cached."""
+
+    with self._lock:
+
+      if key in self._rows:
+        self._rows.move_to_end(key)
+        self.hits += 1
+        return self._rows[key]
+
+      if key not in self._disk_sizes:
+        self.misses += 1
+        return None
+
+      self._disk_sizes.move_to_end(key)
+      self.disk_hits += 1
+
+    # Read outside the lock, tolerating concurrent eviction.
+    try:
+      with open(self._path(key), "rb") as f:
+        values = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+      with self._lock:
+        self.disk_hits -= 1
+        self.misses += 1
+      return None
+
+    return self._insert(CachedRow(row_key=key, values=values))
+
+  def put(self, row):
+    """Cache `row`, returning the CachedRow that stands in for it."""
+    if not isinstance(row, CachedRow):
+      row = CachedRow.from_row(row)
+    return self._insert(row)
+
+  def _insert(self, row):
+
+    if row.num_bytes > self.max_bytes:
+      return row
+
+    spilled = []
+
+    with self._lock:
+
+      if row.row_key in self._rows:
+        self.num_bytes -= self._rows.pop(row.row_key).num_bytes
+
+      self._rows[row.row_key] = row
+      self.num_bytes += row.num_bytes
+
+      while self.num_bytes > self.max_bytes:
+        _, evicted = self._rows.popitem(last=False)
+        self.num_bytes -= evicted.num_bytes
+        self.evictions += 1
+        if (self.cache_dir is not None and
+            evicted.row_key not in self._disk_sizes):
+          spilled.append(evicted)
+
+    for evicted in spilled:
+      self._spill(evicted)
+
+    return row
+
+  def _spill(self, row):
+
+    if row.num_bytes > self.max_disk_bytes:
+      return
+
+    with open(self._path(row.row_key), "wb") as f:
+      pickle.dump(row.values(), f)
+
+    removed = []
+
+    with self._lock:
+
+      self._disk_sizes[row.row_key] = row.num_bytes
+      self.num_disk_bytes += row.num_bytes
+
+      while self.num_disk_bytes > self.max_disk_bytes:
+        key, size = self._disk_sizes.popitem(last=False)
+        self.num_disk_bytes -= size
+        removed.append(key)
+
+    for key in removed:
+      try:
+        os.remove(self._path(key))
+      except OSError:
+        pass
+
+
+def _reblock(blocks, block_size):
+  """Yield the concatenation of arrays `blocks` in blocks of `block_size`.
+
+  Only the last block may be shorter. At most a block is buffered.
+
+  """
+
+  pending = []
+  num_pending = 0
+
+  for block in blocks:
+
+    start = 0
+
+    while num_pending + len(block) - start >= block_size:
+      end = start + block_size - num_pending
+      pending.append(block[start:end])
+      yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+      pending = []
+      num_pending = 0
+      start = end
+
+    if start < len(block):
+      pending.append(block[start:])
+      num_pending += len(block) - start
+
+  if pending:
+    yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+
+
+def _sampling_random_states(seed):
+  """Random states for sampling videos and the windows within them.
+
+  These are separate so that the stream of samples doesn't depend on how
+  sampling is batched. Without a `seed` both are the global random state.
+
+  """
+  if seed is None:
+    return np.random, np.random
+  video_seed, window_seed = np.random.RandomState(seed).randint(0, 2**31, 2)
+  return np.random.RandomState(video_seed), np.random.RandomState(window_seed)
+
+
+def _sample_video_pairs(all_video_meta, random_state, block_size=1024):
+  """Yield pairs of VideoMeta from `all_video_meta`, a VideoMetaIndex.
+
+  Pairs of video indices are sampled a block at a time.
+
+  """
+  while True:
+    for v0i, v1i in all_video_meta.sample_indices((block_size, 2),
+                                                  random_state):
+      yield all_video_meta[v0i], all_video_meta[v1i]
+
+
 class RawVideoSelection(BigTableSelection):
 
   def __init__(self, *args, **kwargs):
@@ -547,6 +2293,8 @@ class RawVideoSelection(BigTableSelection):
     key = make_shard_meta_key(table_prefix=self.prefix,
                               shard_id=shard_meta.shard_id)
 
+    shard_meta.updated_at = time.time()
+
     row = self.table.row(key)
     row.set_cell(column_family_id="meta",
                  column="meta",
@@ -554,6 +2302,49 @@ class RawVideoSelection(BigTableSelection):
                  timestamp=datetime.datetime(1970, 1, 1))
     self.table.mutate_rows([row])
 
+  def set_video_progress(self, shard_id, progress):
+    """Record that videos of a shard have been completely written.
+
+    Progress records are only meaningful once the rows of the videos they
+    describe have been written, e.g. after flushing a shared writer.
+
+    Args:
+      shard_id(int): The shard of the videos.
+      progress(dict): A JSON-serializable record for each video id, e.g.
+        describing the source file and settings it was extracted with.
+
+    """
+
+    with self.batched_writer() as writer:
+      for video_id, record in sorted(progress.items()):
+        row = self.table.row(
+            make_video_progress_key(table_prefix=self.prefix,
+                                    shard_id=shard_id,
+                                    video_id=video_id))
+        row.set_cell(column_family_id="meta",
+                     column="progress",
+                     value=json.dumps(dict(record, video_id=video_id)),
+                     timestamp=datetime.datetime(1970, 1, 1))
+        writer.write(row)
+
+  def lookup_video_progress(self, shard_id):
+    """The progress records of a shard's written videos, by video id."""
+
+    start_key = make_video_progress_key_prefix(table_prefix=self.prefix,
+                                               shard_id=shard_id)
+
+    partial_rows = self._read(lambda: list(
+        self.table.read_rows(start_key=start_key,
+                             end_key=prefix_end_key(start_key))))
+
+    progress = {}
+
+    for row in partial_rows:
+      record = json.loads(row.cells["meta"][b"progress"][0].value.decode())
+      progress[record.pop("video_id")] = record
+
+    return progress
+
   def lookup_shard_metadata(self, num_shards=99999, ignore_unfinished=False):
     if not isinstance(self.prefix, str):
       msg = ("Metadata lookup is expected after writing "
@@ -567,9 +2358,10 @@ class RawVideoSelection(BigTableSelection):
 
     prefix = make_shard_meta_common_prefix(table_prefix=self.prefix)
 
-    partial_rows = self.table.read_rows(
-        start_key=make_shard_meta_first_key(self.prefix),
-        end_key=make_shard_meta_last_key(self.prefix, num_shards))
+    partial_rows = self._read(lambda: list(
+        self.table.read_rows(start_key=make_shard_meta_first_key(self.prefix),
+                             end_key=make_shard_meta_last_key(
+                                 self.prefix, num_shards))))
 
     if partial_rows is None:
       return metadata
@@ -588,7 +2380,8 @@ class RawVideoSelection(BigTableSelection):
       metadata[key] = VideoShardMeta(num_videos=shard_meta["num_videos"],
                                      status=shard_meta["status"],
                                      shard_id=shard_meta["shard_id"],
-                                     num_shards=shard_meta["num_shards"])
+                                     num_shards=shard_meta["num_shards"],
+                                     updated_at=shard_meta.get("updated_at"))
 
       # Hack: This shouldn't be necessary but doesn't cause any harm. There's
       # currently a bug where this loop iterates over the eval meta partial_rows
@@ -599,44 +2392,116 @@ class RawVideoSelection(BigTableSelection):
 
     return metadata
 
+  def _scan_video_meta_dicts(self, all_shard_meta, num_workers=1):
+
+    # The key range of each shard's video meta rows
+    key_ranges = []
+    for shard_meta_key, shard_meta in all_shard_meta.items():
+      start_key = make_video_meta_key_prefix(self.prefix, shard_meta.shard_id)
+      key_ranges.append((start_key, prefix_end_key(start_key)))
+
+    if num_workers > 1:
+      partial_rows = self.read_key_ranges(key_ranges,
+                                          num_workers=num_workers,
+                                          ordered=True)
+    else:
+      partial_rows = (
+          row for start_key, end_key in key_ranges
+          for row in self.table.read_rows(start_key=start_key, end_key=end_key))
+
+    for row in partial_rows:
+
+      value = row.cells["meta"]["meta".encode()][0].value.decode()
+      yield json.loads(value)
+
   def _lookup_all_video_metadata(self, num_shards=1):
 
     all_shard_meta = self.lookup_shard_metadata(num_shards=num_shards,
                                                 ignore_unfinished=True)
 
-    all_video_meta = []
+    return VideoMetaIndex.from_dicts(
+        self._scan_video_meta_dicts(all_shard_meta))
+
+  def load_video_meta_index(self,
+                            num_shards=1,
+                            cache_dir=None,
+                            rebuild=False,
+                            num_workers=1,
+                            persist=False):
+    """Load a VideoMetaIndex of all videos in finished shards.
+
+    The index is versioned by the state of the shard meta so that it is
+    rebuilt (by scanning every video's meta row) only when shards have
+    been added or changed. Otherwise it is loaded from `cache_dir`, if
+    provided, or from a single row of the table. A rebuilt index is
+    cached to `cache_dir` and, only if `persist`, written to the table.
+
+    Args:
+      num_shards(int): As with lookup_shard_metadata.
+      cache_dir(str): A local (or GCS) directory in which to cache the
+        index.
+      rebuild(bool): Whether to rebuild the index regardless.
+      num_workers(int): The number of shards to scan concurrently when
+        building the index.
+      persist(bool): Whether to write a rebuilt index to the table, which
+        requires write access to it.
+
+    Returns:
+      VideoMetaIndex: The index.
 
-    # HACK: Currently the regex filter approach isn't yielding the correct list of videos.
-    # But specifying the start and end key does. The only problem is that row keys are
-    # sorted lexicographically. So for now a num_videos beyond what would be present is
-    # used. And in the future we can move from using integers to some perhaps alphabet
-    # letter alternative.
-    num_videos = 99999999
+    """
 
-    for shard_meta_key, shard_meta in all_shard_meta.items():
+    all_shard_meta = self.lookup_shard_metadata(num_shards=num_shards,
+                                                ignore_unfinished=True)
+    version = shard_meta_version(all_shard_meta)
+
+    cache_path = None
+    if cache_dir:
+      cache_path = os.path.join(
+          cache_dir, "{}-{}-{}.npz".format(self.table_name, self.prefix,
+                                           version))
+
+    index_key = make_video_meta_index_key(self.prefix)
+
+    if not rebuild:
 
-      shard_id = shard_meta._shard_id
-      #num_videos = shard_meta._num_videos
-      meta_prefix = make_video_meta_common_prefix(self.prefix, shard_id)
-      start_key = make_video_meta_first_key(self.prefix, shard_id)
-      end_key = make_video_meta_last_key(self.prefix, shard_id, num_videos)
+      if cache_path and tf.gfile.Exists(cache_path):
+        with tf.gfile.Open(cache_path, "rb") as f:
+          return VideoMetaIndex.from_bytes(f.read())
 
-      partial_rows = self.table.read_rows(start_key=start_key, end_key=end_key)
+      row = self._read(self.table.read_row, index_key)
+      if row is not None:
+        index = VideoMetaIndex.from_bytes(
+            row.cells["meta"]["meta".encode()][0].value)
+        if index.version == version:
+          if cache_path:
+            self._cache_video_meta_index(index, cache_path)
+          return index
 
-      for row in partial_rows:
+    tf.logging.info("Building video meta index, version {}.".format(version))
 
-        value = row.cells["meta"]["meta".encode()][0].value.decode()
-        video_meta = json.loads(value)
+    index = VideoMetaIndex.from_dicts(self._scan_video_meta_dicts(
+        all_shard_meta, num_workers=num_workers),
+                                      version=version)
 
-        vm = VideoMeta(video_length=video_meta["video_length"],
-                       audio_length=video_meta["audio_length"],
-                       video_id=video_meta["video_id"],
-                       shard_id=video_meta["shard_id"],
-                       audio_block_size=video_meta["audio_block_size"])
+    if persist:
+      rows = [
+          _compose_av_write(table=self.table,
+                            key=index_key,
+                            value=index.to_bytes(),
+                            column_family="meta")
+      ]
+      _check_mutate_statuses(rows, self.table.mutate_rows(rows))
+
+    if cache_path:
+      self._cache_video_meta_index(index, cache_path)
 
-        all_video_meta.append(vm)
+    return index
 
-    return all_video_meta
+  def _cache_video_meta_index(self, index, cache_path):
+    tf.gfile.MakeDirs(os.path.dirname(cache_path))
+    with tf.gfile.Open(cache_path, "wb") as f:
+      f.write(index.to_bytes())
 
   def _lookup_video_metadata(self, prefix, shard_id, video_id):
 
@@ -644,230 +2509,628 @@ class RawVideoSelection(BigTableSelection):
                               shard_id=shard_id,
                               video_id=video_id)
 
-    msg = "looking up metadata for video with key {}, shard {}, video {}".format(
-        key, shard_id, video_id)
+    msg = "looking up metadata for video with key {}, shard {}, video {}"
+    msg = msg.format(key, shard_id, video_id)
+
+    row = self._read(self.table.read_row, key)
+
+    if row is None:
+      raise ValueError("No metadata for video with key {}.".format(key))
 
-    row = self.table.read_row(key)
     value = row.cells["meta"]["meta".encode()][0].value.decode()
     video_meta = json.loads(value)
 
-    return VideoMeta(video_length=video_meta["video_length"],
-                     audio_length=video_meta["audio_length"],
-                     video_id=video_meta["video_id"],
-                     shard_id=video_meta["shard_id"],
-                     audio_block_size=video_meta["audio_block_size"])
+    return VideoMeta.from_dict(video_meta)
 
-  def _get_random_video_meta(self, shard_meta):
+  def _get_random_video_meta(self, shard_meta, max_attempts=100):
 
     if not isinstance(shard_meta, dict):
       msg = "Expected meta dictionary, saw type {}.".format(type(shard_meta))
       raise ValueError(msg)
     """
     
-    Hack: This is to deal with the fact that cloud function extraction does not
-    identify and re-try failures leaving gaps in the raw table and thus creating
-    the opportunity for failures at least at this level (looking up meta at video
-    and shard indices that have not been written).
+    Hack: This is to deal with the fact that cloud function extraction does
+    not identify and re-try failures leaving gaps in the raw table and thus
+    creating the opportunity for failures at least at this level (looking up
+    meta at video and shard indices that have not been written).
+
+    Transient errors are retried by the read policy; here only the sampling
+    of videos whose meta is missing is retried, up to `max_attempts` times.
     
     """
-    while True:
+    shard_meta_keys = list(shard_meta.keys())
 
-      try:
+    for _ in range(max_attempts):
 
-        num_keys = len(list(shard_meta.keys()))
-        sampled_shard_index = np.random.randint(0, num_keys)
+      sampled_shard_index = np.random.randint(0, len(shard_meta_keys))
 
-        shard_meta_key = list(shard_meta.keys())[sampled_shard_index]
-        sampled_shard_meta = shard_meta[shard_meta_key]
+      shard_meta_key = shard_meta_keys[sampled_shard_index]
+      sampled_shard_meta = shard_meta[shard_meta_key]
 
-        videos_per_sampled_shard = sampled_shard_meta.num_videos
-        sampled_video_index = np.random.randint(0, videos_per_sampled_shard)
+      videos_per_sampled_shard = sampled_shard_meta.num_videos
+      sampled_video_index = np.random.randint(0, videos_per_sampled_shard)
 
-        tf.logging.debug("sampled shard index: {}".format(sampled_shard_index))
-        tf.logging.debug("sampled video index: {}".format(sampled_video_index))
+      tf.logging.debug("sampled shard index: {}".format(sampled_shard_index))
+      tf.logging.debug("sampled video index: {}".format(sampled_video_index))
+
+      try:
 
         # Look up the length of the video
-        meta = self._lookup_video_metadata(prefix=self.prefix,
+        return self._lookup_video_metadata(prefix=self.prefix,
                                            shard_id=sampled_shard_index,
                                            video_id=sampled_video_index)
 
-        return meta
-
-      except:
+      except ValueError:
         tf.logging.info(
             "Failed fetching meta for video and shard, will retry: {},  {}".
             format(sampled_video_index, sampled_shard_index))
 
-  def write_av(self, frames, audio, shard_id, video_id, audio_block_size=1000):
+    raise ValueError(
+        "Failed to find video meta after {} attempts.".format(max_attempts))
+
+  def write_av(self,
+               frames,
+               audio,
+               shard_id,
+               video_id,
+               audio_block_size=1000,
+               frame_encoding="uint8",
+               audio_encoding="uint8",
+               writer=None,
+               frames_per_row=1):
+    """Write a video's frames, audio, and metadata to the raw table.
+
+    Args:
+      frames(video_utils.Video): The frames of the video.
+      audio(np.ndarray): A 1D array of audio samples.
+      frame_encoding(str): One of ARRAY_ENCODINGS; "ndarray" preserves
+        the dtype of the frames instead of casting them to uint8 while
+        "png" and "zlib" compress them losslessly.
+      audio_encoding(str): As with `frame_encoding`, e.g. "ndarray" for
+        float audio or "delta_zlib" to compress integer audio.
+      writer(BatchedRowWriter): A writer to share across calls so that
+        the writes for one video overlap with decoding the next; the
+        caller is then responsible for closing it. By default a writer
+        is created and closed within the call.
+      frames_per_row(int): The number of consecutive frames to store in
+        each row, so that a contiguous sample of frames is read from one
+        or two rows rather than one row per frame.
+
+    """
 
     if not isinstance(frames, video_utils.Video):
       msg = "expected frames of type {}, saw {}.".format(
           video_utils.Video, type(frames))
       raise ValueError(msg)
 
-    meta = VideoMeta(video_length=frames.length,
-                     audio_length=len(audio),
-                     shard_id=shard_id,
-                     video_id=video_id,
-                     audio_block_size=audio_block_size)
+    return self.write_av_stream(frames=frames.frames,
+                                audio=audio,
+                                shard_id=shard_id,
+                                video_id=video_id,
+                                audio_block_size=audio_block_size,
+                                frame_encoding=frame_encoding,
+                                audio_encoding=audio_encoding,
+                                writer=writer,
+                                frames_per_row=frames_per_row)
+
+  def write_av_stream(self,
+                      frames,
+                      audio,
+                      shard_id,
+                      video_id,
+                      audio_block_size=1000,
+                      frame_encoding="uint8",
+                      audio_encoding="uint8",
+                      writer=None,
+                      frames_per_row=1):
+    """As with write_av but for an iterable of `frames`, e.g. from a decoder.
+
+    Each frame is written as it's produced, so only the rows buffered by the
+    writer (at most its max_in_flight batches) are held in memory however
+    long the video. Audio given as blocks is likewise written as each block
+    is produced. The video's metadata, e.g. its length, is written once the
+    frames and audio are exhausted.
+
+    Args:
+      audio: A 1D array of audio samples, or a callable returning them once
+        the frames are exhausted, e.g. when decoded alongside the frames.
+        The callable may instead return an iterable of consecutive blocks
+        of samples, of any sizes.
+
+    Returns:
+      The VideoMeta of the written video.
+
+    """
 
     video_meta_key = make_video_meta_key(table_prefix=self.prefix,
                                          shard_id=shard_id,
                                          video_id=video_id)
 
-    rows = []
+    owns_writer = writer is None
+
+    # An owned writer is closed however the write ends, discarding what's
+    # buffered if it fails.
+    with contextlib.ExitStack() as stack:
+
+      if owns_writer:
+        writer = stack.enter_context(self.batched_writer())
+
+      write_audio = functools.partial(self._write_audio_blocks,
+                                      writer=writer,
+                                      shard_id=shard_id,
+                                      video_id=video_id,
+                                      audio_block_size=audio_block_size,
+                                      audio_encoding=audio_encoding)
+
+      if not callable(audio):
+        audio_length = write_audio([np.asarray(audio)])
+
+      video_length, frame_shape = self._write_frames(
+          writer=writer,
+          frames=frames,
+          shard_id=shard_id,
+          video_id=video_id,
+          frame_encoding=frame_encoding,
+          frames_per_row=frames_per_row)
+
+      if callable(audio):
+        audio_blocks = audio()
+        if isinstance(audio_blocks, np.ndarray):
+          audio_blocks = [audio_blocks]
+        audio_length = write_audio(audio_blocks)
+
+      meta = VideoMeta(video_length=video_length,
+                       audio_length=audio_length,
+                       shard_id=shard_id,
+                       video_id=video_id,
+                       audio_block_size=audio_block_size,
+                       frame_shape=frame_shape,
+                       frame_encoding=frame_encoding,
+                       audio_encoding=audio_encoding,
+                       frames_per_row=frames_per_row)
+
+      # Written last, and when not sharing a writer only once the data it
+      # describes has been written. With a shared writer readers rely on the
+      # shard meta instead, i.e. on only sampling from finished shards.
+      if owns_writer:
+        writer.flush()
+
+      writer.write(
+          _compose_av_write(table=self.table,
+                            key=video_meta_key,
+                            value=meta.as_dict(),
+                            column_family="meta"))
+
+    return meta
 
-    rows.append(
-        _compose_av_write(table=self.table,
-                          key=video_meta_key,
-                          value=meta.as_dict(),
-                          column_family="meta"))
+  def _write_audio_blocks(self, audio_blocks, writer, shard_id, video_id,
+                          audio_block_size, audio_encoding):
+    """Write consecutive `audio_blocks` as rows of `audio_block_size`.
 
-    num_audio_blocks = math.ceil(meta.audio_length / audio_block_size)
+    Returns:
+      int: The number of audio samples written.
 
-    for i in range(num_audio_blocks):
+    """
 
-      subset_start = i * audio_block_size
-      subset_end = subset_start + audio_block_size
+    audio_length = 0
 
-      audio_subset = audio[subset_start:subset_end]
+    for i, audio_subset in enumerate(
+        _reblock(audio_blocks, block_size=audio_block_size)):
 
       key = make_audio_key(table_prefix=self.prefix,
                            shard_id=shard_id,
                            video_id=video_id,
                            audio_block_id=i)
 
-      rows.append(
+      writer.write(
           _compose_av_write(table=self.table,
                             key=key,
                             value=audio_subset,
-                            column_family="audio"))
+                            column_family="audio",
+                            encoding=audio_encoding))
+
+      audio_length += len(audio_subset)
+
+    return audio_length
 
-    _ = self.table.mutate_rows(rows)
-    rows = []
+  def _write_frames(self, writer, frames, shard_id, video_id, frame_encoding,
+                    frames_per_row):
+    """Write each of `frames` as it's produced, see write_av_stream.
+
+    Returns:
+      tuple: The number of frames written and the shape of the first.
+
+    """
 
-    frame_write_buffer_size = 32
-    buffer_counter = 0
+    chunk_row = None
+    frame_shape = None
+    video_length = 0
 
-    frame_iterator = frames.get_iterator()
-    for i, video_frame in enumerate(frame_iterator):
+    for i, video_frame in enumerate(frames):
 
       video_frame = np.asarray(video_frame)
 
-      frame_key = make_frame_key(table_prefix=self.prefix,
-                                 shard_id=shard_id,
-                                 video_id=video_id,
-                                 frame_id=i)
+      if frame_shape is None:
+        frame_shape = video_frame.shape
+      video_length += 1
 
-      rows.append(
-          _compose_av_write(table=self.table,
-                            key=frame_key,
-                            value=video_frame,
-                            column_family="video_frames"))
-      buffer_counter += 1
+      if frames_per_row == 1:
 
-      if buffer_counter >= frame_write_buffer_size:
-        _ = self.table.mutate_rows(rows)
-        rows = []
-        buffer_counter = 0
+        frame_key = make_frame_key(table_prefix=self.prefix,
+                                   shard_id=shard_id,
+                                   video_id=video_id,
+                                   frame_id=i)
 
-    if buffer_counter > 0:
-      _ = self.table.mutate_rows(rows)
+        writer.write(
+            _compose_av_write(table=self.table,
+                              key=frame_key,
+                              value=video_frame,
+                              column_family="video_frames",
+                              encoding=frame_encoding))
+        continue
 
-  def _frame_keys_for_indices(self, indices, meta):
+      # Frames are encoded individually, to a column of the chunk row.
+      chunk_id, offset = divmod(i, frames_per_row)
 
-    assert isinstance(indices, np.ndarray)
-    assert isinstance(meta, VideoMeta)
+      if offset == 0:
+        chunk_row = self.table.row(
+            make_frame_chunk_key(table_prefix=self.prefix,
+                                 shard_id=shard_id,
+                                 video_id=video_id,
+                                 chunk_id=chunk_id))
 
-    frame_keys = []
+      chunk_row.set_cell(column_family_id="video_frames",
+                         column=frame_chunk_column(offset),
+                         value=_encode_value(video_frame,
+                                             encoding=frame_encoding),
+                         timestamp=datetime.datetime(1970, 1, 1))
 
-    for i in range(len(indices)):
+      if offset == frames_per_row - 1:
+        writer.write(chunk_row)
+        chunk_row = None
 
-      index = indices[i]
+    # The last chunk of a video is partial unless its length is a multiple
+    # of frames_per_row.
+    if chunk_row is not None:
+      writer.write(chunk_row)
 
-      frame_key = make_frame_key(table_prefix=self.prefix,
-                                 shard_id=meta.shard_id,
-                                 video_id=meta.video_id,
-                                 frame_id=index)
+    return video_length, frame_shape
 
-      frame_keys.append(frame_key)
+  def _frame_keys_for_indices(self, indices, meta):
 
-    return frame_keys
+    assert isinstance(indices, np.ndarray)
+    assert isinstance(meta, VideoMeta)
+
+    if meta.frames_per_row > 1:
+      # Frames of packed videos are a column of their chunk's row, only
+      # one or two of which are spanned by a contiguous sample.
+      chunk_ids, offsets = np.divmod(indices, meta.frames_per_row)
+      chunk_keys = make_frame_chunk_keys(table_prefix=self.prefix,
+                                         shard_id=meta.shard_id,
+                                         video_id=meta.video_id,
+                                         chunk_ids=chunk_ids)
+      return [(chunk_key, frame_chunk_column(offset))
+              for chunk_key, offset in zip(chunk_keys, offsets.tolist())]
+
+    return make_frame_keys(table_prefix=self.prefix,
+                           shard_id=meta.shard_id,
+                           video_id=meta.video_id,
+                           frame_ids=indices)
 
   def _audio_keys(self, meta, indices):
 
     audio_block_meta = audio_blocks_for_indices(
         start=indices[0], end=indices[-1], block_size=meta.audio_block_size)
 
-    keys = []
-
-    for i in range(audio_block_meta["num_query_blocks"]):
-
-      audio_key = make_audio_key(
-          table_prefix=self.prefix,
-          shard_id=meta.shard_id,
-          video_id=meta.video_id,
-          audio_block_id=audio_block_meta["min_query_block"] + i)
-
-      keys.append(audio_key)
+    keys = make_audio_keys(table_prefix=self.prefix,
+                           shard_id=meta.shard_id,
+                           video_id=meta.video_id,
+                           audio_block_ids=np.arange(
+                               audio_block_meta["min_query_block"],
+                               audio_block_meta["max_query_block"] + 1))
 
     return keys, audio_block_meta
 
-  def _lookup_frame_data(self, frame_keys):
+  def _frame_data_from_rows(self,
+                            frame_keys,
+                            rows,
+                            frame_shape=None,
+                            encoding="uint8"):
+    """Decode frames from rows into one contiguous array.
+
+    Args:
+      frame_keys(list): The keys of the frames to decode, in order, as
+        from _frame_keys_for_indices.
+      rows(dict): A mapping from row key to row as from read_rows_by_keys.
+      frame_shape(list): Optionally, the shape to give each frame, e.g.
+        the frame_shape of the VideoMeta. Otherwise frames are flattened,
+        whatever their encoding, as they always have been.
+      encoding(str): The frame_encoding of the VideoMeta.
+
+    Returns:
+      np.ndarray: Of shape (len(frame_keys),) + frame_shape, or otherwise
+        (len(frame_keys), frame_size).
+
+    """
 
-    frames = np.asarray([None for _ in frame_keys])
+    frames = None
 
     for i, frame_key in enumerate(frame_keys):
 
-      row = self.table.read_row(frame_key)
+      row_key, column = _frame_cell(frame_key)
 
-      if row is None:
+      row = rows.get(row_key)
+
+      if row is None or column not in row.cells.get("video_frames", {}):
         msg = "Frame data query for key {} got None.".format(frame_key)
         raise ValueError(msg)
 
-      frame_data = row.cells["video_frames"]["video_frames".encode()][0].value
-      frames[i] = np.asarray(list(frame_data), dtype=np.uint8)
+      frame_data = row.cells["video_frames"][column][0].value
+      frame_data = _decode_value(frame_data, encoding=encoding)
+
+      if frames is None:
+        shape = [frame_data.size]
+        if frame_shape:
+          shape = frame_shape
+        frames = np.empty([len(frame_keys)] + list(shape),
+                          dtype=frame_data.dtype)
+
+      frames[i] = frame_data.reshape(frames.shape[1:])
 
-    return np.asarray([np.asarray(thing) for thing in frames])
+    if frames is None:
+      return np.empty((0,), dtype=np.uint8)
 
-  def _lookup_audio_data(self, audio_keys, audio_block_meta):
+    return frames
+
+  def _audio_data_from_rows(self,
+                            audio_keys,
+                            audio_block_meta,
+                            rows,
+                            encoding="uint8"):
+    """Decode the queried range of a sequence of audio blocks.
+
+    Only the [query_start, query_end) range of the concatenated blocks is
+    copied, directly into a single preallocated output. As it always has
+    been this is float64 for "uint8" encoded audio, otherwise it's of the
+    stored dtype.
+
+    """
 
     query_start = audio_block_meta["query_start"]
     query_end = audio_block_meta["query_end"]
 
-    all_audio_data = np.array([])
+    ret = None
+
+    # The offset of the current block within the concatenated blocks and
+    # the number of values written to `ret` so far.
+    offset = 0
+    filled = 0
 
     for audio_key in audio_keys:
 
-      row = self.table.read_row(audio_key)
+      row = rows.get(_maybe_encode_str(audio_key))
 
       if row is None:
         msg = "Audio data query got None, {}".format(audio_key)
         raise ValueError(msg)
 
       value = row.cells["audio"]["audio".encode()][0].value
-      data = np.asarray(list(value), dtype=np.uint8)
+      data = _decode_value(value, encoding=encoding).reshape(-1)
+
+      if ret is None:
+        dtype = np.float64 if encoding == "uint8" else data.dtype
+        ret = np.empty((max(query_end - query_start, 0),), dtype=dtype)
 
-      all_audio_data = np.concatenate([all_audio_data, data])
+      start = max(query_start - offset, 0)
+      end = min(query_end - offset, len(data))
 
-    ret = all_audio_data[query_start:query_end]
+      if end > start:
+        ret[filled:filled + end - start] = data[start:end]
+        filled += end - start
 
-    length = len(ret)
+      offset += len(data)
 
-    if not isinstance(ret, np.ndarray) or length == 0:
+    if filled == 0:
 
-      msg = "Wrong type or length: {}, {}; response len: {}; other: {}".format(
-          type(ret), length, len(all_audio_data), _logging_data())
+      msg = "Wrong length: {}; response len: {}; keys: {}".format(
+          filled, offset, audio_keys)
       raise ValueError(msg)
 
-    return ret
+    return ret[:filled]
+
+  def _lookup_frame_data(self, frame_keys, frame_shape=None, encoding="uint8"):
+    rows = self.read_rows_by_keys(_frame_row_keys(frame_keys))
+    return self._frame_data_from_rows(frame_keys, rows, frame_shape, encoding)
+
+  def _lookup_audio_data(self, audio_keys, audio_block_meta, encoding="uint8"):
+    rows = self.read_rows_by_keys(audio_keys)
+    return self._audio_data_from_rows(audio_keys, audio_block_meta, rows,
+                                      encoding)
+
+  def _lookup_example_set_data(self, example_sets):
+    """Fill in video and audio for keys-only example sets with one read.
+
+    All of the frame and audio keys of all of the samples in
+    `example_sets` are fetched with a single RowSet query and the
+    results are assigned back to each sample in order.
+
+    Args:
+      example_sets(list): Dicts of AVCorrespondenceSample's as yielded by
+        sample_av_correspondence_examples with keys_only=True.
+
+    Returns:
+      list: The same `example_sets`, with video and audio populated.
+
+    """
+
+    keys = []
+    for example_set in example_sets:
+      for sample in example_set.values():
+        keys.extend(_frame_row_keys(sample.meta["frame_keys"]))
+        keys.extend(sample.meta["audio_keys"])
+
+    rows = self.read_rows_by_keys(keys)
+
+    for example_set in example_sets:
+
+      # Samples within a set commonly share their frames (e.g. the
+      # positive_same and negative_same samples) so only decode once.
+      decoded_frames = {}
+
+      for sample in example_set.values():
+
+        video_source = sample.meta["video_source"]
+        frame_keys = tuple(sample.meta["frame_keys"])
+        if frame_keys not in decoded_frames:
+          decoded_frames[frame_keys] = self._frame_data_from_rows(
+              frame_keys, rows, encoding=video_source.frame_encoding)
+
+        sample.video = decoded_frames[frame_keys]
+        sample.audio = self._audio_data_from_rows(
+            audio_keys=sample.meta["audio_keys"],
+            audio_block_meta=sample.meta["audio_block_meta"],
+            rows=rows,
+            encoding=sample.meta["audio_source"].audio_encoding)
+
+    return example_sets
+
+  def _sample_example_set(self, v0, v1, frames_per_video, max_frame_shift,
+                          max_frame_skip, random_state):
+    """Sample the keys (but not the data) of an AV correspondence set.
+
+    Args:
+      v0(VideoMeta): The video from which to sample frames and both the
+        overlapping and non-overlapping audio.
+      v1(VideoMeta): The video from which to sample the audio of
+        negative_different.
+
+    """
+
+    def _sample(vlen, alen):
+      avs = video_utils.AVSamplable(video_length=vlen,
+                                    audio_length=alen,
+                                    random_state=random_state)
+      return avs.sample_av_pair(num_frames=frames_per_video,
+                                max_frame_shift=max_frame_shift,
+                                max_frame_skip=max_frame_skip)
+
+    # Get indices for two samples from the first video
+    # The first one frames and audio
+    f00_, a00_, sampling_meta00 = _sample(v0.video_length, v0.audio_length)
+    # and the second one only audio
+    _, a01_, sampling_meta01 = _sample(v0.video_length, v0.audio_length)
+
+    # Then sample audio indices from the second video
+    _, a10_, sampling_meta10 = _sample(v1.video_length, v1.audio_length)
+
+    kf00 = self._frame_keys_for_indices(f00_, meta=v0)
+
+    ka00, abm00 = self._audio_keys(meta=v0, indices=a00_)
+    ka01, abm01 = self._audio_keys(meta=v0, indices=a01_)
+    ka10, abm10 = self._audio_keys(meta=v1, indices=a10_)
+
+    positive_same = AVCorrespondenceSample(
+        video=np.array([]),
+        audio=np.array([]),
+        labels={
+            "same_video": 1,
+            "overlap": 1
+        },
+        meta={
+            "video_source": v0,
+            "audio_source": v0,
+            "video_sample_meta": sampling_meta00,
+            "audio_sample_meta": sampling_meta00,
+            "audio_keys": ka00,
+            "frame_keys": kf00,
+            "audio_block_meta": abm00
+        })
+
+    negative_same = AVCorrespondenceSample(
+        video=np.array([]),
+        audio=np.array([]),
+        labels={
+            "same_video": 1,
+            "overlap": 0
+        },
+        meta={
+            "video_source": v0,
+            "audio_source": v0,
+            "video_sample_meta": sampling_meta00,
+            "audio_sample_meta": sampling_meta01,
+            "audio_keys": ka01,
+            "frame_keys": kf00,
+            "audio_block_meta": abm01
+        })
+
+    negative_different = AVCorrespondenceSample(
+        video=np.array([]),
+        audio=np.array([]),
+        labels={
+            "same_video": 0,
+            "overlap": 0
+        },
+        meta={
+            "video_source": v0,
+            "audio_source": v1,
+            "video_sample_meta": sampling_meta00,
+            "audio_sample_meta": sampling_meta10,
+            "audio_keys": ka10,
+            "frame_keys": kf00,
+            "audio_block_meta": abm10
+        })
+
+    return {
+        "positive_same": positive_same,
+        "negative_same": negative_same,
+        #"negative_different": negative_different
+    }
 
   def sample_av_correspondence_examples(self,
                                         frames_per_video,
                                         max_num_samples=None,
                                         max_frame_shift=0,
                                         max_frame_skip=0,
-                                        keys_only=False):
+                                        keys_only=False,
+                                        samples_per_read=1,
+                                        meta_cache_dir=None,
+                                        persist_meta_index=False,
+                                        prefetch_depth=0,
+                                        num_fetch_workers=1,
+                                        seed=None):
+    """Sample AV correspondence example sets from the raw table.
+
+    With `prefetch_depth` > 0 keys are sampled ahead of the consumer and
+    the data for the next `prefetch_depth` reads are fetched by a pool of
+    `num_fetch_workers` threads while the current example sets are being
+    consumed. Example sets are yielded in the order they were sampled in
+    either case so, given a `seed`, the stream is deterministic.
+
+    Args:
+      frames_per_video(int): The number of frames per sample.
+      max_num_samples(int): Stop after this many example sets, if set.
+      keys_only(bool): Yield example sets with keys but without data.
+      samples_per_read(int): The number of example sets whose frame and
+        audio data are fetched together in a single read.
+      meta_cache_dir(str): A directory in which to cache the video meta
+        index, see load_video_meta_index.
+      persist_meta_index(bool): Whether to write the video meta index to
+        the table if it has to be rebuilt, so that samplers started later
+        read it instead of every video's meta row.
+      prefetch_depth(int): The number of reads to keep in flight ahead of
+        the consumer.
+      num_fetch_workers(int): The number of threads performing reads when
+        prefetching.
+      seed(int): Optionally, a seed for the sampling of keys.
+
+    """
+
+    for name, value, minimum in [("samples_per_read", samples_per_read, 1),
+                                 ("prefetch_depth", prefetch_depth, 0),
+                                 ("num_fetch_workers", num_fetch_workers, 1)]:
+      if not isinstance(value, int) or value < minimum:
+        msg = "Expected {} >= {}, saw {}".format(name, minimum, value)
+        raise ValueError(msg)
 
     #make_video_meta_common_prefix(table_prefix, shard_id)
 
@@ -876,126 +3139,90 @@ class RawVideoSelection(BigTableSelection):
     # TODO: Provide more clear logging in the event there aren't any completed
     # shards.
 
-    all_video_meta = self._lookup_all_video_metadata()
-    num_videos = len(all_video_meta)
+    all_video_meta = self.load_video_meta_index(cache_dir=meta_cache_dir,
+                                                persist=persist_meta_index)
+
+    video_random_state, random_state = _sampling_random_states(seed)
+
+    reads = self._sample_reads(
+        all_video_meta,
+        sets_per_read=1 if keys_only else samples_per_read,
+        max_num_samples=max_num_samples,
+        video_random_state=video_random_state,
+        frames_per_video=frames_per_video,
+        max_frame_shift=max_frame_shift,
+        max_frame_skip=max_frame_skip,
+        random_state=random_state)
+
+    if keys_only:
+      for example_sets in reads:
+        for example_set in example_sets:
+          yield example_set
+      return
+
+    # Then look up the actual frame and audio data for those sampled
+    # indices (from bigtable), for `samples_per_read` example sets at a
+    # time with a single read.
+    for example_sets in self._fetch_reads(reads, prefetch_depth,
+                                          num_fetch_workers):
+      for filled in example_sets:
+        yield filled
+
+  def _sample_reads(self, all_video_meta, sets_per_read, max_num_samples,
+                    video_random_state, **kwargs):
+    """Yield lists of `sets_per_read` sampled example sets.
+
+    The last list is shorter if needed to make `max_num_samples`, if set.
+
+    Args:
+      all_video_meta(VideoMetaIndex): The videos to sample from.
+      video_random_state: The random state with which videos are sampled.
+      **kwargs: Further args of _sample_example_set.
+
+    """
 
     i = 0
-    while True:
+    video_pairs = _sample_video_pairs(all_video_meta, video_random_state)
 
-      #v0 = self._get_random_video_meta(all_shard_meta)
-      #v1 = self._get_random_video_meta(all_shard_meta)
-      v0i, v1i = np.random.randint(0, num_videos, 2)
-      v0 = all_video_meta[v0i]
-      v1 = all_video_meta[v1i]
-
-      def _sample(vlen, alen):
-        avs = video_utils.AVSamplable(video_length=vlen, audio_length=alen)
-        return avs.sample_av_pair(num_frames=frames_per_video,
-                                  max_frame_shift=max_frame_shift,
-                                  max_frame_skip=max_frame_skip)
-
-      # Get indices for two samples from the first video
-      # The first one frames and audio
-      f00_, a00_, sampling_meta00 = _sample(v0.video_length, v0.audio_length)
-      # and the second one only audio
-      _, a01_, sampling_meta01 = _sample(v0.video_length, v0.audio_length)
-
-      # Then sample audio indices from the second video
-      _, a10_, sampling_meta10 = _sample(v1.video_length, v1.audio_length)
-
-      kf00 = self._frame_keys_for_indices(f00_, meta=v0)
-
-      ka00, abm00 = self._audio_keys(meta=v0, indices=a00_)
-      ka01, abm01 = self._audio_keys(meta=v0, indices=a01_)
-      ka10, abm10 = self._audio_keys(meta=v1, indices=a10_)
-
-      positive_same = AVCorrespondenceSample(
-          video=np.array([]),
-          audio=np.array([]),
-          labels={
-              "same_video": 1,
-              "overlap": 1
-          },
-          meta={
-              "video_source": v0,
-              "audio_source": v0,
-              "video_sample_meta": sampling_meta00,
-              "audio_sample_meta": sampling_meta00,
-              "audio_keys": ka00,
-              "frame_keys": kf00,
-              "audio_block_meta": abm00
-          })
-
-      negative_same = AVCorrespondenceSample(
-          video=np.array([]),
-          audio=np.array([]),
-          labels={
-              "same_video": 1,
-              "overlap": 0
-          },
-          meta={
-              "video_source": v0,
-              "audio_source": v0,
-              "video_sample_meta": sampling_meta00,
-              "audio_sample_meta": sampling_meta01,
-              "audio_keys": ka01,
-              "frame_keys": kf00,
-              "audio_block_meta": abm01
-          })
-
-      negative_different = AVCorrespondenceSample(
-          video=np.array([]),
-          audio=np.array([]),
-          labels={
-              "same_video": 0,
-              "overlap": 0
-          },
-          meta={
-              "video_source": v0,
-              "audio_source": v1,
-              "video_sample_meta": sampling_meta00,
-              "audio_sample_meta": sampling_meta10,
-              "audio_keys": ka10,
-              "frame_keys": kf00,
-              "audio_block_meta": abm10
-          })
-
-      example_set = {
-          "positive_same": positive_same,
-          "negative_same": negative_same,
-          #"negative_different": negative_different
-      }
+    while not max_num_samples or i < max_num_samples:
 
-      if keys_only:
-        yield example_set
-      else:
+      num_sets = sets_per_read
+      if max_num_samples:
+        num_sets = min(num_sets, max_num_samples - i)
+      i += num_sets
 
-        # Then look up the actual frame and audio data for those sampled indices
-        # (from bigtable).
-        f00 = self._lookup_frame_data(kf00)
+      yield [
+          self._sample_example_set(v0=v0, v1=v1, **kwargs)
+          for v0, v1 in itertools.islice(video_pairs, num_sets)
+      ]
 
-        a00 = self._lookup_audio_data(audio_keys=ka00, audio_block_meta=abm00)
-        a01 = self._lookup_audio_data(audio_keys=ka01, audio_block_meta=abm01)
-        a10 = self._lookup_audio_data(audio_keys=ka10, audio_block_meta=abm10)
+  def _fetch_reads(self, reads, prefetch_depth, num_fetch_workers):
+    """Yield each of `reads` with its data looked up, in order.
 
-        # Lastly store the sampled data in nice organized AVCorrespondenceSample
-        # objects.
+    With `prefetch_depth` > 0 the data of up to that many reads are looked
+    up ahead of the consumer by a pool of `num_fetch_workers` threads.
 
-        example_set["positive_same"].video = f00
-        example_set["positive_same"].audio = a00
+    """
 
-        example_set["negative_same"].video = f00
-        example_set["negative_same"].audio = a01
+    if prefetch_depth < 1:
+      for example_sets in reads:
+        yield self._lookup_example_set_data(example_sets)
+      return
 
-        #example_set["negative_different"].video = f00
-        #example_set["negative_different"].audio = a10
+    with futures.ThreadPoolExecutor(max_workers=num_fetch_workers) as executor:
 
-        yield example_set
+      in_flight = collections.deque()
 
-      i += 1
+      for example_sets in reads:
 
-      if max_num_samples and max_num_samples <= i:
-        break
+        in_flight.append(
+            executor.submit(self._lookup_example_set_data, example_sets))
+
+        if len(in_flight) > prefetch_depth:
+          yield in_flight.popleft().result()
+
+      while in_flight:
+        yield in_flight.popleft().result()
 
 
 class TFExampleSelection(BigTableSelection):
@@ -1015,49 +3242,91 @@ class TFExampleSelection(BigTableSelection):
                                  generator,
                                  prefix_tag_length=4,
                                  max_num_examples=-1,
-                                 log_every=100):
-    """Builds TFExample from dict, serializes, and writes to CBT."""
+                                 log_every=100,
+                                 batch_size=256,
+                                 max_batch_bytes=4 * 2**20,
+                                 max_in_flight=4,
+                                 num_serialize_workers=0,
+                                 replica_id=None):
+    """Builds TFExample from dict, serializes, and writes to CBT.
+
+    Rows are written in bulk by a BatchedRowWriter, flushing whenever
+    `batch_size` rows or `max_batch_bytes` of serialized examples have
+    accumulated. Row keys are obtained from an ExampleKeyGenerator so
+    that concurrent loaders with distinct `replica_id`s never overwrite
+    each other's examples.
+
+    Args:
+      generator: A generator of example dict's.
+      prefix_tag_length(int): The length of the hashed tag that spreads
+        row keys across the prefix's key range.
+      max_num_examples(int): If > 0, stop after this (index of) example.
+      log_every(int): Log progress and throughput every this many examples.
+      batch_size(int): The maximum number of rows per mutate_rows call.
+      max_batch_bytes(int): The maximum bytes of examples per mutate_rows.
+      max_in_flight(int): The maximum number of concurrent mutate_rows calls.
+      num_serialize_workers(int): If > 0, serialize examples in a pool of
+        this many processes while batches are being written.
+      replica_id: An identifier unique to this loader, e.g. a shard id;
+        a random one is used if not provided.
+
+    """
 
-    prefix = self.prefix
     table = self.table
 
-    for i, example_dict in enumerate(generator):
+    key_generator = ExampleKeyGenerator(prefix=self.prefix,
+                                        replica_id=replica_id,
+                                        tag_length=prefix_tag_length)
 
-      if not isinstance(example_dict, dict):
-        msg = "Expected generator to yield dict's, saw {}.".format(
-            type(example_dict))
-        raise ValueError(msg)
+    if max_num_examples > 0:
+      # Bound what's pulled into the serialization pool, if any.
+      generator = itertools.islice(generator, max_num_examples + 1)
 
-      example = to_example(example_dict)
-      example = example.SerializeToString()
+    i = 0
+    num_bytes = 0
+    start_time = time.time()
 
-      # Random target key
-      target_key = random_key(prefix=prefix, length=prefix_tag_length).encode()
+    def _log(msg):
+      elapsed = max(time.time() - start_time, 1e-6)
+      tf.logging.info("{} ({:.1f} examples/sec, {:.1f} bytes/sec)".format(
+          msg, (i + 1) / elapsed, num_bytes / elapsed))
 
-      row = table.row(target_key)
-      row.set_cell(column_family_id="tfexample",
-                   column="example",
-                   value=example,
-                   timestamp=datetime.datetime(1970, 1, 1))
-      # Don't set a timestamp so we set instead of
-      # append cell values.
-      #timestamp=datetime.datetime.utcnow())
+    examples = _serialized_examples(generator,
+                                    num_workers=num_serialize_workers)
 
-      table.mutate_rows([row])
+    with BatchedRowWriter(table,
+                          batch_size=batch_size,
+                          max_in_flight=max_in_flight,
+                          max_batch_bytes=max_batch_bytes) as writer:
 
-      if log_every > 0 and i % log_every == 0:
-        tf.logging.info("Generated {} examples...".format(i))
+      for i, example in enumerate(examples):
 
-      if max_num_examples > 0 and i >= max_num_examples:
-        break
+        row = table.row(key_generator.next_key())
+        row.set_cell(column_family_id="tfexample",
+                     column="example",
+                     value=example,
+                     timestamp=datetime.datetime(1970, 1, 1))
+        # Don't set a timestamp so we set instead of
+        # append cell values.
+        #timestamp=datetime.datetime.utcnow())
+
+        writer.write(row, num_bytes=len(example))
+        num_bytes += len(example)
+
+        if log_every > 0 and i % log_every == 0:
+          _log("Generated {} examples...".format(i))
 
-    tf.logging.info("Generated {} examples.".format(i))
+    _log("Generated {} examples.".format(i))
 
     return i
 
-  def iterate_tfexamples(self):
+  def iterate_tfexamples(self, num_workers=1):
+    """Iterate over parsed examples, in key order unless `num_workers` > 1."""
 
-    row_iterator = self.get_basic_row_iterator()
+    if num_workers > 1:
+      row_iterator = self.parallel_scan(num_workers=num_workers)
+    else:
+      row_iterator = self.get_basic_row_iterator()
 
     for row in row_iterator:
 
@@ -1068,6 +3337,114 @@ class TFExampleSelection(BigTableSelection):
       yield parsed_example
 
 
+def _serialize_example(example_dict):
+
+  if not isinstance(example_dict, dict):
+    msg = "Expected generator to yield dict's, saw {}.".format(
+        type(example_dict))
+    raise ValueError(msg)
+
+  return to_example(example_dict).SerializeToString()
+
+
+def _serialized_examples(generator, num_workers=0, chunk_size=64):
+  """Serialize example dict's from `generator`, in order.
+
+  With `num_workers` > 0 serialization happens in a process pool, one
+  chunk of `chunk_size` examples ahead of what's being consumed, so that
+  only a bounded number of examples are held in memory.
+
+  """
+
+  if num_workers < 1:
+    for example_dict in generator:
+      yield _serialize_example(example_dict)
+    return
+
+  with futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+    def _submit_chunk():
+      chunk = list(itertools.islice(generator, chunk_size))
+      if not chunk:
+        return None
+      return executor.map(_serialize_example,
+                          chunk,
+                          chunksize=max(1, chunk_size // num_workers))
+
+    pending = _submit_chunk()
+
+    while pending is not None:
+      current = pending
+      pending = _submit_chunk()
+      for example in current:
+        yield example
+
+
+def make_example_key(prefix, replica_id, counter, tag_length=8):
+  """Make a row key unique to (`replica_id`, `counter`).
+
+  Keys have the form {prefix}{tag}_{replica_id}_{counter} where `tag` is
+  the first `tag_length` hex digits of a hash of the suffix. The suffix
+  makes keys collision-free across replicas while the tag spreads them
+  uniformly over the prefix's key range, so that the tablets (and the
+  splits of parallel scans) covering it hold similar numbers of rows.
+
+  Args:
+    prefix(str): The table prefix, e.g. "train".
+    replica_id: An identifier unique to the writer.
+    counter(int): The index of the example among those of the writer.
+    tag_length(int): The number of hex digits of hash to lead with.
+
+  """
+
+  if not isinstance(counter, int) or counter < 0:
+    raise ValueError(
+        "Expected a non-negative int counter, saw {}".format(counter))
+
+  if not isinstance(tag_length, int) or tag_length < 1 or tag_length > 40:
+    raise ValueError(
+        "Expected 1 <= tag_length <= 40, saw {}".format(tag_length))
+
+  # The counter follows the last "_" so distinct (replica_id, counter)
+  # pairs always give distinct suffixes.
+  suffix = "{}_{}".format(replica_id, counter)
+
+  tag = hashlib.sha1(suffix.encode()).hexdigest()[:tag_length]
+
+  return "{}{}_{}".format(prefix, tag, suffix).encode()
+
+
+class ExampleKeyGenerator(object):
+  """Generates a writer's sequence of collision-free example keys.
+
+  Args:
+    prefix(str): The table prefix, e.g. "train".
+    replica_id: An identifier unique to the writer, e.g. a datagen shard
+      id; defaults to a random 64-bit hex string.
+    tag_length(int): See `make_example_key`.
+
+  """
+
+  def __init__(self, prefix, replica_id=None, tag_length=8):
+
+    if replica_id is None:
+      replica_id = os.urandom(8).hex()
+
+    self.prefix = prefix
+    self.replica_id = replica_id
+    self.tag_length = tag_length
+    self._counter = itertools.count()
+    self._lock = threading.Lock()
+
+  def next_key(self):
+    with self._lock:
+      counter = next(self._counter)
+    return make_example_key(prefix=self.prefix,
+                            replica_id=self.replica_id,
+                            counter=counter,
+                            tag_length=self.tag_length)
+
+
 def random_key(prefix="raw_", length=4):
 
   a = "abcdefghijklmnopqrstuvwxyz"
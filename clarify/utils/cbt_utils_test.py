@@ -13,7 +13,10 @@
 """Additional distributed datagen and augmentation problem defs."""
 
 import tensorflow as tf
+import json
 import os
+import time
+import tracemalloc
 import uuid
 import tempfile
 import numpy as np
@@ -23,6 +26,8 @@ import numpy as np
 from tensor2tensor.utils import registry
 
 from clarify.utils import cbt_utils
+from clarify.utils import cbt_test_utils
+from clarify.utils import video_utils
 #from pcml.operations import extract
 
 from clarify.utils.cfg_utils import Config
@@ -32,6 +37,99 @@ TEST_CONFIG = Config()
 from clarify.utils.cbt_utils import _lex_index
 
 
+def _fake_raw_selection(table="raw", client=None, **kwargs):
+  """A RawVideoSelection over a FakeClient, populated with synthetic videos."""
+
+  if client is None:
+    client = cbt_test_utils.FakeClient()
+
+  selection = cbt_utils.RawVideoSelection(project="fake",
+                                          instance="fake",
+                                          table=table,
+                                          prefix="train",
+                                          client=client)
+
+  cbt_test_utils.write_synthetic_videos(selection, **kwargs)
+
+  return selection
+
+
+class _FlakyTable(cbt_test_utils.FakeTable):
+  """Fails each row's first write and tracks concurrent mutate_rows calls."""
+
+  def __init__(self, *args, **kwargs):
+    super(_FlakyTable, self).__init__(*args, **kwargs)
+    self.attempted = set()
+    self.in_flight = 0
+    self.max_in_flight = 0
+
+  def mutate_rows(self, rows):
+
+    with self._lock:
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    time.sleep(0.01)
+
+    ok = [row for row in rows if row.row_key in self.attempted]
+    self.attempted.update(row.row_key for row in rows)
+    super(_FlakyTable, self).mutate_rows(ok)
+
+    with self._lock:
+      self.in_flight -= 1
+
+    return [
+        cbt_test_utils.FakeStatus(code=0 if row in ok else 14) for row in rows
+    ]
+
+
+class _InterruptedTable(cbt_test_utils.FakeTable):
+  """Fails the first `num_interruptions` streams of read_rows part way."""
+
+  def __init__(self, *args, **kwargs):
+    self.num_interruptions = kwargs.pop("num_interruptions", 0)
+    self.rows_per_stream = kwargs.pop("rows_per_stream", 10)
+    super(_InterruptedTable, self).__init__(*args, **kwargs)
+
+  def read_rows(self, *args, **kwargs):
+
+    rows = super(_InterruptedTable, self).read_rows(*args, **kwargs)
+
+    with self._lock:
+      interrupt = self.num_interruptions > 0
+      self.num_interruptions -= 1
+
+    if not interrupt:
+      return rows
+
+    def _interrupted():
+      for i, row in enumerate(rows):
+        if i == self.rows_per_stream:
+          raise cbt_utils.exceptions.ServiceUnavailable("Stream interrupted.")
+        yield row
+
+    return _interrupted()
+
+
+def _time_av_sampling(selection, num_samples, **kwargs):
+  """Round trips and seconds per example set, excluding the metadata scan."""
+
+  generator = selection.sample_av_correspondence_examples(
+      max_num_samples=num_samples + 1, **kwargs)
+
+  # The first example set includes the one-time video metadata lookup.
+  _ = generator.__next__()
+  selection.table.reset_counters()
+
+  start = time.time()
+  for _ in generator:
+    pass
+  elapsed = time.time() - start
+
+  return (selection.table.num_rpcs / float(num_samples),
+          elapsed / float(num_samples))
+
+
 class TestCBTUtils(tf.test.TestCase):
 
   def setUp(self):
@@ -118,6 +216,927 @@ class TestCBTUtils(tf.test.TestCase):
 
     self.assertEqual(recv_meta[train_meta_key].as_dict(), sent_meta.as_dict())
 
+  def test_read_rows_by_keys(self):
+
+    selection = _fake_raw_selection(num_videos=1)
+
+    keys = [cbt_utils.make_frame_key("train", 0, 0, i) for i in [3, 1, 3]
+           ] + ["train_0_0_frame_missing"]
+
+    selection.table.reset_counters()
+
+    rows = selection.read_rows_by_keys(keys)
+
+    self.assertEqual(selection.table.num_rpcs, 1)
+    self.assertEqual(len(rows), 2)
+    self.assertTrue(keys[0] in rows)
+    self.assertTrue(keys[1] in rows)
+
+  def test_row_cache(self):
+
+    selection = _fake_raw_selection(num_videos=1)
+    keys = [cbt_utils.make_frame_key("train", 0, 0, i) for i in range(4)]
+
+    cache_dir = tempfile.mkdtemp()
+    selection.row_cache = cbt_utils.RowCache(max_bytes=10**6,
+                                             cache_dir=cache_dir)
+    selection.table.reset_counters()
+
+    uncached = selection.read_rows_by_keys(keys)
+    cached = selection.read_rows_by_keys(keys[1:3])
+
+    self.assertEqual(selection.table.num_rpcs, 1)
+    self.assertEqual(selection.row_cache.misses, 4)
+    self.assertEqual(selection.row_cache.hits, 2)
+    for key in keys[1:3]:
+      self.assertEqual(cached[key].values(), uncached[key].values())
+
+    # Shrinking the memory budget to two rows spills the rest to disk.
+    num_bytes = uncached[keys[0]].num_bytes
+    cache = cbt_utils.RowCache(max_bytes=2 * num_bytes,
+                               cache_dir=cache_dir,
+                               max_disk_bytes=10 * num_bytes)
+    for key in keys:
+      cache.put(uncached[key])
+
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.evictions, 2)
+    self.assertEqual(len(os.listdir(cache_dir)), 2)
+    self.assertEqual(cache.get(keys[0]).values(), uncached[keys[0]].values())
+    self.assertEqual(cache.disk_hits, 1)
+
+    # Sampling repeatedly from a hot video is served from the cache.
+    selection.row_cache = cbt_utils.RowCache()
+    generator = selection.sample_av_correspondence_examples(frames_per_video=10,
+                                                            max_num_samples=50)
+    for _ in generator:
+      pass
+
+    stats = selection.row_cache.stats()
+    self.assertTrue(stats["hits"] > stats["misses"])
+
+  def test_batched_av_lookup_round_trips(self):
+
+    frames_per_video = 10
+    frame_shape = (8, 8, 1)
+
+    for samples_per_read in [1, 4]:
+
+      selection = _fake_raw_selection(frame_shape=frame_shape)
+
+      generator = selection.sample_av_correspondence_examples(
+          frames_per_video=frames_per_video,
+          max_num_samples=8,
+          samples_per_read=samples_per_read)
+
+      num_sets = 0
+      for example_set in generator:
+        num_sets += 1
+        for sample in example_set.values():
+          # Frames are flat, as they always have been, for callers to
+          # reshape.
+          self.assertEqual(sample.video.shape,
+                           (frames_per_video, int(np.prod(frame_shape))))
+          self.assertEqual(sample.video.dtype, np.uint8)
+          self.assertTrue(len(sample.audio) > 0)
+
+      self.assertEqual(num_sets, 8)
+
+      rpcs_per_set, _ = _time_av_sampling(selection,
+                                          num_samples=8,
+                                          frames_per_video=frames_per_video,
+                                          samples_per_read=samples_per_read)
+
+      self.assertEqual(rpcs_per_set, 1.0 / samples_per_read)
+
+  def test_prefetched_sampling(self):
+
+    selection = _fake_raw_selection(num_videos=3, frame_shape=(4, 4, 1))
+
+    def _sample(**kwargs):
+      return list(
+          selection.sample_av_correspondence_examples(frames_per_video=5,
+                                                      max_num_samples=10,
+                                                      max_frame_skip=2,
+                                                      seed=42,
+                                                      **kwargs))
+
+    expected = _sample()
+
+    for kwargs in [{
+        "prefetch_depth": 3,
+        "num_fetch_workers": 2
+    }, {
+        "prefetch_depth": 2,
+        "num_fetch_workers": 4,
+        "samples_per_read": 3
+    }]:
+      received = _sample(**kwargs)
+      self.assertEqual(len(received), len(expected))
+      for example_set, expected_set in zip(received, expected):
+        for key, sample in example_set.items():
+          self.assertEqual(sample.meta["frame_keys"],
+                           expected_set[key].meta["frame_keys"])
+          self.assertAllEqual(sample.video, expected_set[key].video)
+          self.assertAllEqual(sample.audio, expected_set[key].audio)
+
+    with self.assertRaises(ValueError):
+      _sample(prefetch_depth=-1)
+
+  def test_frame_and_audio_decode(self):
+
+    selection = _fake_raw_selection(num_videos=0)
+
+    frames = np.random.randint(0, 255, (5, 4, 4, 3)).astype(np.uint8)
+    audio = np.random.randint(0, 255, (2500,)).astype(np.uint8)
+
+    video = video_utils.Video()
+    for frame in frames:
+      video.insert(frame)
+
+    selection.write_av(frames=video,
+                       audio=audio,
+                       shard_id=0,
+                       video_id=0,
+                       audio_block_size=1000)
+
+    meta = selection._lookup_video_metadata(prefix="train",
+                                            shard_id=0,
+                                            video_id=0)
+    self.assertEqual(meta.frame_shape, [4, 4, 3])
+
+    indices = np.array([1, 2, 4])
+    frame_keys = selection._frame_keys_for_indices(indices, meta=meta)
+    recv_frames = selection._lookup_frame_data(frame_keys,
+                                               frame_shape=meta.frame_shape)
+    self.assertAllEqual(recv_frames, frames[indices])
+
+    # Without a frame shape frames come back flattened.
+    recv_flat = selection._lookup_frame_data(frame_keys)
+    self.assertEqual(recv_flat.shape, (3, 4 * 4 * 3))
+
+    # A query spanning all three audio blocks
+    audio_indices = np.arange(900, 2200)
+    audio_keys, abm = selection._audio_keys(meta=meta, indices=audio_indices)
+    self.assertEqual(len(audio_keys), 3)
+    recv_audio = selection._lookup_audio_data(audio_keys, abm)
+    self.assertEqual(recv_audio.dtype, np.float64)
+    self.assertAllEqual(recv_audio, audio[900:2199])
+
+  def test_batched_row_writer(self):
+
+    table = _FlakyTable("flaky")
+
+    writer = cbt_utils.BatchedRowWriter(table=table,
+                                        batch_size=4,
+                                        max_in_flight=2,
+                                        retry_delay_secs=0)
+
+    with writer:
+      for i in range(50):
+        row = table.row("row_{}".format(i))
+        row.set_cell(column_family_id="cf", column="cf", value=b"v")
+        writer.write(row)
+
+    self.assertEqual(writer.num_rows_written, 50)
+    self.assertEqual(writer.num_rows_retried, 50)
+    self.assertEqual(len(list(table.read_rows())), 50)
+    self.assertTrue(table.max_in_flight <= 2)
+
+    with self.assertRaises(ValueError):
+      writer.write(row)
+
+    # Rows that still fail once retries are exhausted are surfaced.
+    writer = cbt_utils.BatchedRowWriter(table=_FlakyTable("flaky"),
+                                        max_retries=0)
+    writer.write(row)
+    with self.assertRaises(RuntimeError):
+      writer.close()
+
+    # A failure while writing discards what's buffered, rather than masking
+    # it with any error of the writer's own.
+    table = _FlakyTable("flaky")
+    with self.assertRaises(KeyError):
+      with cbt_utils.BatchedRowWriter(table=table, max_retries=0) as writer:
+        writer.write(row)
+        raise KeyError()
+    self.assertEqual(len(list(table.read_rows())), 0)
+
+  def test_video_meta_index(self):
+
+    selection = _fake_raw_selection(num_videos=3)
+
+    expected = [vm.as_dict() for vm in selection._lookup_all_video_metadata()]
+
+    # Loading is read-only unless the index is explicitly persisted.
+    selection.table.reset_counters()
+    selection.load_video_meta_index()
+    self.assertEqual(selection.table.num_rows_written, 0)
+
+    index = selection.load_video_meta_index(cache_dir=self.tmpdir,
+                                            rebuild=True,
+                                            persist=True)
+    self.assertEqual(len(index), 3)
+    self.assertEqual([index[i].as_dict() for i in range(3)], expected)
+
+    serialized = cbt_utils.VideoMetaIndex.from_bytes(index.to_bytes())
+    self.assertEqual(serialized.version, index.version)
+    self.assertEqual(serialized[2].as_dict(), expected[2])
+
+    # Loading from the local cache only requires reading the shard meta.
+    selection.table.reset_counters()
+    cached = selection.load_video_meta_index(cache_dir=self.tmpdir)
+    self.assertEqual(selection.table.num_rpcs, 1)
+    self.assertEqual(cached[1].as_dict(), expected[1])
+
+    # Without it, from the copy persisted to the table.
+    selection.table.reset_counters()
+    persisted = selection.load_video_meta_index()
+    self.assertEqual(selection.table.num_rpcs, 2)
+    self.assertEqual(persisted.version, index.version)
+
+    # The persisted index is outside of the prefix's key range.
+    index_key = cbt_utils.make_video_meta_index_key(selection.prefix)
+    self.assertIsNotNone(selection.table.read_row(index_key))
+    self.assertNotIn(
+        index_key, [row.row_key for row in selection.get_basic_row_iterator()])
+
+    # Changing the shard meta invalidates the index.
+    cbt_test_utils.write_synthetic_videos(selection, num_videos=4)
+    rebuilt = selection.load_video_meta_index(cache_dir=self.tmpdir,
+                                              num_workers=2)
+    self.assertNotEqual(rebuilt.version, index.version)
+    self.assertEqual(len(rebuilt), 4)
+
+    # As does re-writing it, e.g. when a shard is re-extracted, even though
+    # its counts are unchanged.
+    shard_meta = list(selection.lookup_shard_metadata().values())[0]
+    selection.set_shard_meta(shard_meta)
+    self.assertNotEqual(
+        cbt_utils.shard_meta_version(selection.lookup_shard_metadata()),
+        rebuilt.version)
+
+    # A sampler can persist the index it rebuilds for those started later.
+    selection = _fake_raw_selection(num_videos=3)
+    next(
+        selection.sample_av_correspondence_examples(frames_per_video=2,
+                                                    keys_only=True,
+                                                    persist_meta_index=True))
+    self.assertIsNotNone(selection.table.read_row(index_key))
+    selection.table.reset_counters()
+    next(
+        selection.sample_av_correspondence_examples(frames_per_video=2,
+                                                    keys_only=True))
+    self.assertEqual(selection.table.num_rpcs, 2)
+
+  def test_video_meta_index_columns(self):
+
+    video_metas = [
+        cbt_utils.VideoMeta(video_length=10 + i,
+                            audio_length=1000,
+                            video_id=i,
+                            shard_id=0,
+                            audio_block_size=100,
+                            frame_shape=[4, 4, 1]) for i in range(5)
+    ]
+
+    index = cbt_utils.VideoMetaIndex.from_video_meta(video_metas)
+    self.assertEqual([meta.as_dict() for meta in index.to_video_meta()],
+                     [meta.as_dict() for meta in video_metas])
+
+    subset = index.take(np.array([4, 1]))
+    self.assertEqual([meta.video_id for meta in subset], [4, 1])
+
+    indices = index.sample_indices((100, 2), np.random.RandomState(0))
+    self.assertEqual(indices.shape, (100, 2))
+    self.assertTrue(np.all((indices >= 0) & (indices < 5)))
+    self.assertAllEqual(
+        indices, index.sample_indices((100, 2), np.random.RandomState(0)))
+
+    # Invalid values are caught for all videos at once.
+    columns = dict(index.columns)
+    columns["video_length"] = np.array([10, 11, 0, 13, 14])
+    with self.assertRaises(ValueError):
+      cbt_utils.VideoMetaIndex(columns=columns)
+
+  def test_streamed_av_write(self):
+
+    selection = _fake_raw_selection(num_videos=0)
+
+    frames = np.random.randint(0, 255, (21, 4, 4, 1)).astype(np.uint8)
+
+    for video_id, frames_per_row in enumerate([1, 4]):
+
+      rows_written_during_decode = []
+
+      def _decode():
+        for frame in frames:
+          rows_written_during_decode.append(selection.table.num_rows_written)
+          yield frame
+
+      audio = np.zeros((2000,), dtype=np.uint8)
+      if frames_per_row > 1:
+        # Audio may also only be available once the frames are exhausted.
+        audio = lambda: np.zeros((2000,), dtype=np.uint8)
+
+      with selection.batched_writer(batch_size=2, max_in_flight=1) as writer:
+        meta = selection.write_av_stream(frames=_decode(),
+                                         audio=audio,
+                                         shard_id=0,
+                                         video_id=video_id,
+                                         writer=writer,
+                                         frames_per_row=frames_per_row)
+
+      # Writes began before decoding finished, the meta after it.
+      self.assertTrue(rows_written_during_decode[-1] > 0)
+      self.assertEqual(meta.video_length, 21)
+      self.assertEqual(meta.audio_length, 2000)
+      self.assertEqual(tuple(meta.frame_shape), (4, 4, 1))
+
+      meta = selection._lookup_video_metadata(prefix="train",
+                                              shard_id=0,
+                                              video_id=video_id)
+      self.assertEqual(meta.video_length, 21)
+
+      indices = np.arange(21)
+      recv_frames = selection._lookup_frame_data(
+          selection._frame_keys_for_indices(indices, meta=meta),
+          frame_shape=meta.frame_shape,
+          encoding=meta.frame_encoding)
+      self.assertAllEqual(recv_frames, frames)
+
+    # Audio may be given as consecutive blocks of any sizes.
+    blocks = [
+        np.arange(0, 3),
+        np.arange(3, 3),
+        np.arange(3, 12),
+        np.arange(12, 13)
+    ]
+    self.assertEqual(
+        [block.tolist() for block in cbt_utils._reblock(blocks, 4)],
+        [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11], [12]])
+
+    audio = np.random.randint(0, 255, (2500,)).astype(np.uint8)
+    meta = selection.write_av_stream(
+        frames=frames,
+        audio=lambda: (audio[i:i + 300] for i in range(0, 2500, 300)),
+        shard_id=0,
+        video_id=3)
+    self.assertEqual(meta.audio_length, 2500)
+    audio_keys, abm = selection._audio_keys(meta=meta,
+                                            indices=np.arange(0, 2500))
+    self.assertAllEqual(selection._lookup_audio_data(audio_keys, abm),
+                        audio[:2499])
+
+    # A writer created for the video is closed even if decoding fails.
+    writers = []
+    batched_writer = selection.batched_writer
+
+    def _batched_writer(**kwargs):
+      writers.append(batched_writer(**kwargs))
+      return writers[-1]
+
+    def _failed_decode():
+      yield frames[0]
+      raise IOError("Corrupt video.")
+
+    selection.batched_writer = _batched_writer
+    with self.assertRaises(IOError):
+      selection.write_av_stream(frames=_failed_decode(),
+                                audio=np.zeros((2000,), dtype=np.uint8),
+                                shard_id=0,
+                                video_id=2)
+    self.assertEqual(len(writers), 1)
+    with self.assertRaises(ValueError):
+      writers[0].write(None)
+    with self.assertRaises(ValueError):
+      selection._lookup_video_metadata(prefix="train", shard_id=0, video_id=2)
+
+  def test_vectorised_keys(self):
+
+    # The previous character-by-character implementation, for reference.
+    def _legacy_lex_index(idx):
+      str_idx = str(idx)
+      str_idx = "0000"[0:max(4 - len(str_idx), 0)] + str_idx
+      return "".join(["abcdefghij"[int(c)] for c in str_idx])
+
+    indices = np.array([0, 7, 12, 305, 9999, 3, 3])
+
+    self.assertEqual([cbt_utils._lex_index(i) for i in indices],
+                     [_legacy_lex_index(i) for i in indices])
+    self.assertEqual(cbt_utils._lex_index(12345), _legacy_lex_index(12345))
+
+    for make_keys, make_key in [
+        (cbt_utils.make_frame_keys, cbt_utils.make_frame_key),
+        (cbt_utils.make_audio_keys, cbt_utils.make_audio_key),
+        (cbt_utils.make_frame_chunk_keys, cbt_utils.make_frame_chunk_key)
+    ]:
+      for ids in [indices, np.array([4, 10000, 123456]), np.array([])]:
+        self.assertEqual(make_keys("train", 1, 2, ids),
+                         [make_key("train", 1, 2, i) for i in ids])
+
+    self.assertEqual(cbt_utils.make_frame_key("train", 1, 2, 12),
+                     b"train_1_2_frame_aabc")
+
+    with self.assertRaises(ValueError):
+      cbt_utils.make_frame_keys("train", 1, 2, np.array([3, -1]))
+
+  def test_prefix_end_key(self):
+    self.assertEqual(cbt_utils.prefix_end_key("train"), b"traio")
+    self.assertEqual(cbt_utils.prefix_end_key(b"a\xff\xff"), b"b")
+    self.assertEqual(cbt_utils.prefix_end_key(b"\xff"), None)
+
+  def test_prefix_scan_and_rows_at_least(self):
+
+    client = cbt_test_utils.FakeClient()
+    selection = _fake_raw_selection(client=client, num_videos=2)
+
+    eval_selection = cbt_utils.RawVideoSelection(project="fake",
+                                                 instance="fake",
+                                                 table="raw",
+                                                 prefix="eval",
+                                                 client=client)
+    self.assertTrue(not eval_selection.rows_at_least(1))
+
+    num_train_rows = len(list(selection.get_basic_row_iterator()))
+    self.assertTrue(num_train_rows > 100)
+
+    # Rows beyond those needed to answer are not read.
+    selection.table.reset_counters()
+    self.assertTrue(selection.rows_at_least(10))
+    self.assertEqual(selection.table.num_rpcs, 1)
+    self.assertEqual(selection.table.num_rows_read, 11)
+
+    self.assertTrue(not selection.rows_at_least(num_train_rows))
+    self.assertTrue(selection.rows_at_least(num_train_rows - 1))
+
+  def test_parallel_scan(self):
+
+    selection = _fake_raw_selection(num_videos=3)
+    selection.table.rows_per_sample = 10
+
+    expected = [row.row_key for row in selection.get_basic_row_iterator()]
+
+    splits = selection.key_range_splits(max_splits=8)
+    self.assertEqual(len(splits), 8)
+    self.assertEqual(splits[0][0], b"train")
+    self.assertEqual(splits[-1][1], b"traio")
+
+    ordered = selection.parallel_scan(num_workers=4, ordered=True)
+    self.assertEqual([row.row_key for row in ordered], expected)
+
+    unordered = selection.parallel_scan(num_workers=4, max_buffered_rows=4)
+    self.assertEqual(sorted(row.row_key for row in unordered), expected)
+
+    # Consumers can stop early without leaving readers blocked.
+    partial = selection.parallel_scan(num_workers=2, max_buffered_rows=2)
+    self.assertEqual(len([partial.__next__() for _ in range(5)]), 5)
+    partial.close()
+
+  def test_encode_decode_array(self):
+
+    for array in [
+        np.random.uniform(-0.5, 0.5, (1000,)).astype(np.float32),
+        np.random.randint(0, 255, (4, 6, 3)).astype(np.uint8),
+        np.arange(12, dtype=np.int16).reshape((3, 4)).T
+    ]:
+      decoded = cbt_utils.decode_array(cbt_utils.encode_array(array))
+      self.assertEqual(decoded.dtype, array.dtype)
+      self.assertAllEqual(decoded, array)
+
+    with self.assertRaises(ValueError):
+      cbt_utils.decode_array(b"not an array")
+
+  def test_ndarray_encoded_av_round_trip(self):
+
+    selection = _fake_raw_selection(num_videos=0)
+
+    frames = np.random.randint(0, 255, (6, 4, 5, 3)).astype(np.uint8)
+    audio = np.random.uniform(-0.5, 0.5, (2500,)).astype(np.float32)
+
+    video = video_utils.Video()
+    for frame in frames:
+      video.insert(frame)
+
+    selection.write_av(frames=video,
+                       audio=audio,
+                       shard_id=0,
+                       video_id=0,
+                       audio_block_size=1000,
+                       frame_encoding="ndarray",
+                       audio_encoding="ndarray")
+
+    meta = selection._lookup_video_metadata(prefix="train",
+                                            shard_id=0,
+                                            video_id=0)
+    self.assertEqual(meta.frame_encoding, "ndarray")
+    self.assertEqual(meta.audio_encoding, "ndarray")
+
+    indices = np.array([0, 3, 5])
+    frame_keys = selection._frame_keys_for_indices(indices, meta=meta)
+    recv_frames = selection._lookup_frame_data(frame_keys,
+                                               frame_shape=meta.frame_shape,
+                                               encoding=meta.frame_encoding)
+    self.assertAllEqual(recv_frames, frames[indices])
+
+    audio_keys, abm = selection._audio_keys(meta=meta,
+                                            indices=np.arange(100, 2400))
+    recv_audio = selection._lookup_audio_data(audio_keys,
+                                              abm,
+                                              encoding=meta.audio_encoding)
+    # Of the stored dtype rather than float64 as for "uint8".
+    self.assertEqual(recv_audio.dtype, np.float32)
+    self.assertAllEqual(recv_audio, audio[100:2399])
+
+  def test_random_load_batches_writes(self):
+
+    def _generator(n):
+      for i in range(n):
+        yield {"index": [i], "values": list(range(100))}
+
+    for kwargs, max_rpcs in [({
+        "batch_size": 16
+    }, 4), ({
+        "max_batch_bytes": 10
+    }, 50), ({
+        "batch_size": 16,
+        "num_serialize_workers": 2
+    }, 4)]:
+
+      selection = cbt_utils.TFExampleSelection(
+          project="fake",
+          instance="fake",
+          table="examples",
+          prefix="train",
+          client=cbt_test_utils.FakeClient())
+      selection.table.reset_counters()
+
+      # As before the index of the last example is returned.
+      num_loaded = selection.random_load_from_generator(
+          generator=_generator(50), prefix_tag_length=12, **kwargs)
+      self.assertEqual(num_loaded, 49)
+
+      self.assertEqual(selection.table.num_rows_written, 50)
+      self.assertTrue(selection.table.num_rpcs <= max_rpcs)
+
+      indices = sorted(ex.features.feature["index"].int64_list.value[0]
+                       for ex in selection.iterate_tfexamples())
+      self.assertEqual(indices, list(range(50)))
+
+    with self.assertRaises(ValueError):
+      selection.random_load_from_generator(generator=iter([1, 2]))
+
+  def test_example_keys_across_replicas(self):
+
+    num_writers = 2000
+    keys_per_writer = 5
+
+    # Interleave writers as concurrent datagen replicas would.
+    generators = [
+        cbt_utils.ExampleKeyGenerator(prefix="train", replica_id=replica_id)
+        for replica_id in range(num_writers)
+    ]
+    keys = [
+        generator.next_key()
+        for _ in range(keys_per_writer)
+        for generator in generators
+    ]
+
+    self.assertEqual(len(set(keys)), num_writers * keys_per_writer)
+    self.assertTrue(all(key.startswith(b"train") for key in keys))
+
+    # Keys are spread evenly over the prefix's key range.
+    counts = np.bincount(
+        [int(key[len(b"train"):len(b"train") + 1], 16) for key in keys],
+        minlength=16)
+    expected = len(keys) / 16
+    self.assertTrue(np.all(np.abs(counts - expected) < 0.2 * expected))
+
+    # Random replica ids are distinct too.
+    self.assertNotEqual(
+        cbt_utils.ExampleKeyGenerator(prefix="train").next_key(),
+        cbt_utils.ExampleKeyGenerator(prefix="train").next_key())
+
+    with self.assertRaises(ValueError):
+      cbt_utils.make_example_key("train", replica_id=0, counter=-1)
+
+  def test_array_codecs(self):
+
+    frames = [
+        np.random.randint(0, 255, (6, 5, 1)).astype(np.uint8),
+        np.random.randint(0, 255, (6, 5, 3)).astype(np.uint8)
+    ]
+    audio = np.cumsum(np.random.randint(-3, 4, (5000,))).astype(np.int16)
+
+    codec_arrays = [("zlib", frames + [audio]), ("png", frames),
+                    ("delta_zlib", [audio, frames[0]])]
+    # Those of the optional codecs whose packages are installed.
+    codec_arrays += [(encoding, frames + [audio])
+                     for encoding in ["zstd", "lz4"]
+                     if encoding in cbt_utils.ARRAY_ENCODINGS]
+
+    for encoding, arrays in codec_arrays:
+      codec = cbt_utils.get_array_codec(encoding)
+      for array in arrays:
+        decoded = codec.decode(codec.encode(array))
+        self.assertEqual(decoded.dtype, array.dtype)
+        self.assertAllEqual(decoded.reshape(array.shape), array)
+
+    # Deltas of slowly varying audio compress much better than the values.
+    self.assertTrue(
+        len(cbt_utils.get_array_codec("delta_zlib").encode(audio)) < 0.75 *
+        len(cbt_utils.get_array_codec("zlib").encode(audio)))
+
+    with self.assertRaises(ValueError):
+      cbt_utils.get_array_codec("delta_zlib").encode(audio.astype(np.float32))
+
+    with self.assertRaises(ValueError):
+      cbt_utils.get_array_codec("bz2")
+
+    for encoding in ["zstd", "lz4"]:
+      if encoding not in cbt_utils.ARRAY_ENCODINGS:
+        with self.assertRaisesRegex(ValueError, "requires"):
+          cbt_utils.get_array_codec(encoding)
+
+  def test_compressed_av_round_trip(self):
+
+    selection = _fake_raw_selection(num_videos=0)
+
+    frames = np.random.randint(0, 255, (6, 4, 5, 1)).astype(np.uint8)
+    audio = np.random.randint(-1000, 1000, (2500,)).astype(np.int16)
+
+    video = video_utils.Video()
+    for frame in frames:
+      video.insert(frame)
+
+    selection.write_av(frames=video,
+                       audio=audio,
+                       shard_id=0,
+                       video_id=0,
+                       audio_block_size=1000,
+                       frame_encoding="png",
+                       audio_encoding="delta_zlib")
+    selection.set_shard_meta(
+        cbt_utils.VideoShardMeta(num_videos=1,
+                                 status="finished",
+                                 shard_id=0,
+                                 num_shards=1))
+
+    # Readers find the codecs in the (indexed) VideoMeta.
+    index = cbt_utils.VideoMetaIndex.from_bytes(
+        selection.load_video_meta_index().to_bytes())
+    meta = index[0]
+    self.assertEqual(meta.frame_encoding, "png")
+    self.assertEqual(meta.audio_encoding, "delta_zlib")
+
+    indices = np.array([0, 3, 5])
+    frame_keys = selection._frame_keys_for_indices(indices, meta=meta)
+    recv_frames = selection._lookup_frame_data(frame_keys,
+                                               frame_shape=meta.frame_shape,
+                                               encoding=meta.frame_encoding)
+    self.assertAllEqual(recv_frames, frames[indices])
+
+    audio_keys, abm = selection._audio_keys(meta=meta,
+                                            indices=np.arange(100, 2400))
+    recv_audio = selection._lookup_audio_data(audio_keys,
+                                              abm,
+                                              encoding=meta.audio_encoding)
+    self.assertAllEqual(recv_audio, audio[100:2399])
+
+  def test_packed_frame_rows(self):
+
+    selection = _fake_raw_selection(num_videos=0)
+
+    frames = np.random.randint(0, 255, (20, 4, 4, 1)).astype(np.uint8)
+
+    video = video_utils.Video()
+    for frame in frames:
+      video.insert(frame)
+
+    selection.write_av(frames=video,
+                       audio=np.zeros((2000,), dtype=np.uint8),
+                       shard_id=0,
+                       video_id=0,
+                       frame_encoding="png",
+                       frames_per_row=8)
+
+    meta = selection._lookup_video_metadata(prefix="train",
+                                            shard_id=0,
+                                            video_id=0)
+    self.assertEqual(meta.frames_per_row, 8)
+
+    # Contiguous and frame-skipped samples, including the partial last
+    # chunk, touch only the rows of the chunks they span.
+    for indices, num_rows in [(np.arange(5, 15), 2), (np.arange(0, 8), 1),
+                              (np.array([9, 11, 12, 19]), 2)]:
+      frame_keys = selection._frame_keys_for_indices(indices, meta=meta)
+      selection.table.reset_counters()
+      recv_frames = selection._lookup_frame_data(frame_keys,
+                                                 frame_shape=meta.frame_shape,
+                                                 encoding=meta.frame_encoding)
+      self.assertEqual(selection.table.num_rows_read, num_rows)
+      self.assertAllEqual(recv_frames, frames[indices])
+
+    packed = _fake_raw_selection(num_videos=2, frames_per_row=16)
+    for example_set in packed.sample_av_correspondence_examples(
+        frames_per_video=10, max_num_samples=5, max_frame_skip=3):
+      for sample in example_set.values():
+        self.assertEqual(sample.video.shape, (10, 8 * 8 * 1))
+
+    # Keys of packed frames survive serialization and can be read back.
+    example_set = next(
+        packed.sample_av_correspondence_examples(frames_per_video=10,
+                                                 max_num_samples=1,
+                                                 keys_only=True))
+    sample = example_set["positive_same"]
+    frame_keys = json.loads(sample.serialize())["frameKeys"]
+    self.assertEqual(len(frame_keys), 10)
+    video_source = sample.meta["video_source"]
+    self.assertAllEqual(
+        packed._lookup_frame_data(frame_keys,
+                                  frame_shape=video_source.frame_shape,
+                                  encoding=video_source.frame_encoding),
+        packed._lookup_frame_data(sample.meta["frame_keys"],
+                                  frame_shape=video_source.frame_shape,
+                                  encoding=video_source.frame_encoding))
+
+  def test_fake_table_fault_injection(self):
+
+    table = cbt_test_utils.FakeTable("faulty",
+                                     write_error_rate=0.3,
+                                     read_error_rate=1.0,
+                                     seed=0)
+
+    # The writer retries rows whose writes failed until all succeed.
+    with cbt_utils.BatchedRowWriter(table=table,
+                                    batch_size=10,
+                                    max_retries=10,
+                                    retry_delay_secs=0.0) as writer:
+      for i in range(100):
+        row = table.row("row_{:03d}".format(i))
+        row.set_cell("cf", "col", b"x" * 1000)
+        writer.write(row)
+
+    self.assertTrue(table.num_write_errors > 0)
+    self.assertEqual(writer.num_rows_retried, table.num_write_errors)
+    self.assertEqual(table.num_rows_written, 100)
+
+    with self.assertRaises(cbt_test_utils.exceptions.ServiceUnavailable):
+      table.read_rows()
+    self.assertEqual(table.num_read_errors, 1)
+
+    # Transfers queue behind each other on a throughput limited link.
+    table.read_error_rate = 0.0
+    table.max_bytes_per_sec = 1e6
+    start = time.time()
+    rows = list(table.read_rows())
+    self.assertEqual(len(rows), 100)
+    self.assertTrue(time.time() - start >= 0.1)
+    self.assertTrue(table.num_bytes_read >= 100 * 1000)
+
+  def test_read_policy(self):
+
+    # Injected read errors are retried until the reads succeed.
+    client = cbt_test_utils.FakeClient(read_error_rate=0.3, seed=0)
+    selection = _fake_raw_selection(client=client)
+    selection.read_policy = cbt_utils.ReadPolicy(max_retries=20,
+                                                 initial_backoff_secs=0.0,
+                                                 seed=0)
+    for _ in range(20):
+      selection.lookup_shard_metadata()
+    stats = selection.read_policy.stats()
+    self.assertEqual(stats["num_calls"], 20)
+    self.assertEqual(stats["num_failures"], 0)
+    self.assertEqual(stats["num_retries"], selection.table.num_read_errors)
+    self.assertTrue(stats["retry_rate"] > 0)
+    self.assertTrue(stats["p99_secs"] >= stats["p50_secs"])
+
+    # Other errors, and retryable ones beyond max_retries, are raised.
+    policy = cbt_utils.ReadPolicy(max_retries=2, initial_backoff_secs=0.0)
+    with self.assertRaises(ValueError):
+      policy.call(lambda: int("x"))
+    table = cbt_test_utils.FakeTable("faulty", read_error_rate=1.0)
+    with self.assertRaises(cbt_utils.exceptions.ServiceUnavailable):
+      policy.call(table.read_row, "key")
+    self.assertEqual(table.num_read_errors, 3)
+    self.assertEqual(policy.stats()["num_failures"], 1)
+
+    # Calls outliving their deadline raise DeadlineExceeded.
+    policy = cbt_utils.ReadPolicy(deadline_secs=0.05, max_retries=0)
+    with self.assertRaises(cbt_utils.exceptions.DeadlineExceeded):
+      policy.call(time.sleep, 0.5)
+
+    # A hedged duplicate of a slow attempt completes first.
+    durations = iter([0.5, 0.0])
+    policy = cbt_utils.ReadPolicy(hedge_after_secs=0.02)
+    start = time.time()
+    self.assertEqual(policy.call(lambda: time.sleep(next(durations)) or 1), 1)
+    self.assertTrue(time.time() - start < 0.4)
+    self.assertEqual(policy.stats()["num_hedges"], 1)
+    self.assertEqual(policy.stats()["num_hedge_wins"], 1)
+
+    # Attempts completing before the hedge delay aren't duplicated.
+    self.assertEqual(policy.call(lambda: 2), 2)
+    self.assertEqual(policy.stats()["num_hedges"], 1)
+
+  def test_resumed_scans(self):
+
+    selection = _fake_raw_selection(num_videos=0)
+    selection.table = _InterruptedTable("interrupted", rows_per_stream=7)
+    selection.read_policy = cbt_utils.ReadPolicy(initial_backoff_secs=0.0)
+    cbt_test_utils.write_synthetic_videos(selection, num_videos=2)
+
+    expected = [row.row_key for row in selection.get_basic_row_iterator()]
+
+    # Streams interrupted part way are resumed after the last row read,
+    # so that no rows are skipped or repeated.
+    selection.table.num_interruptions = 3
+    self.assertEqual(
+        [row.row_key for row in selection.get_basic_row_iterator()], expected)
+    self.assertEqual(selection.read_policy.stats()["num_retries"], 3)
+
+    selection.table.num_interruptions = 1
+    self.assertEqual(
+        [row.row_key for row in selection.get_basic_row_iterator(limit=10)],
+        expected[:10])
+
+    selection.table.num_interruptions = 2
+    self.assertEqual(
+        sorted(row.row_key for row in selection.parallel_scan(num_workers=2)),
+        expected)
+
+    # Beyond max_retries consecutive failures the error is raised.
+    selection.read_policy = cbt_utils.ReadPolicy(max_retries=1,
+                                                 initial_backoff_secs=0.0)
+    selection.table.num_interruptions = 2
+    selection.table.rows_per_stream = 0
+    with self.assertRaises(cbt_utils.exceptions.ServiceUnavailable):
+      list(selection.get_basic_row_iterator())
+
+  def test_video_progress(self):
+
+    selection = _fake_raw_selection(num_videos=1)
+
+    self.assertEqual(selection.lookup_video_progress(shard_id=0), {})
+
+    selection.set_video_progress(shard_id=0,
+                                 progress={
+                                     3: {
+                                         "source": "c.mp4"
+                                     },
+                                     12: {
+                                         "source": "d.mp4"
+                                     }
+                                 })
+    selection.set_video_progress(shard_id=1, progress={0: {"source": "e.mp4"}})
+
+    self.assertEqual(selection.lookup_video_progress(shard_id=0), {
+        3: {
+            "source": "c.mp4"
+        },
+        12: {
+            "source": "d.mp4"
+        }
+    })
+    self.assertEqual(selection.lookup_video_progress(shard_id=1),
+                     {0: {
+                         "source": "e.mp4"
+                     }})
+
+    # Progress records don't disturb the sampling of the videos' meta.
+    self.assertEqual(len(selection._lookup_all_video_metadata()), 1)
+
+  def test_client_registry(self):
+
+    created = []
+
+    def _client(project=None, admin=False):
+      created.append((project, admin))
+      return cbt_test_utils.FakeClient()
+
+    cbt_utils.clear_client_registry()
+
+    with tf.test.mock.patch.object(cbt_utils.bigtable,
+                                   "Client",
+                                   side_effect=_client):
+
+      selections = [
+          cbt_utils.TFExampleSelection(project="p",
+                                       instance="i",
+                                       table="t",
+                                       prefix=prefix)
+          for prefix in ["train", "eval", "train"]
+      ]
+
+    cbt_utils.clear_client_registry()
+
+    # One data client is shared by all selections and the admin client is
+    # only needed for the first (cached) existence check.
+    self.assertEqual(created, [("p", False), ("p", True)])
+    self.assertTrue(
+        all(selection.client is selections[0].client
+            for selection in selections))
+
   """
   def test_generate_av_correspondence_examples(self):
 
@@ -283,5 +1302,277 @@ class TestCBTUtils(tf.test.TestCase):
   """
 
 
+class CBTUtilsBenchmark(tf.test.Benchmark):
+
+  def benchmark_av_sampling_round_trips(self):
+
+    num_samples = 32
+
+    for samples_per_read in [1, 8]:
+
+      client = cbt_test_utils.FakeClient(latency_secs=0.005)
+
+      selection = _fake_raw_selection(client=client,
+                                      video_length=100,
+                                      frame_shape=(64, 64, 1),
+                                      audio_length=100000)
+
+      rpcs_per_set, secs_per_set = _time_av_sampling(
+          selection,
+          num_samples=num_samples,
+          frames_per_video=20,
+          samples_per_read=samples_per_read)
+
+      self.report_benchmark(
+          name="av_sampling_samples_per_read_{}".format(samples_per_read),
+          iters=num_samples,
+          wall_time=secs_per_set,
+          extras={"round_trips_per_example_set": rpcs_per_set})
+
+  def benchmark_av_sampling_prefetch(self):
+
+    num_samples = 32
+
+    for prefetch_depth, num_fetch_workers in [(0, 1), (4, 4)]:
+
+      client = cbt_test_utils.FakeClient(latency_secs=0.005)
+
+      selection = _fake_raw_selection(client=client,
+                                      video_length=100,
+                                      frame_shape=(64, 64, 1),
+                                      audio_length=100000)
+
+      _, secs_per_set = _time_av_sampling(selection,
+                                          num_samples=num_samples,
+                                          frames_per_video=20,
+                                          prefetch_depth=prefetch_depth,
+                                          num_fetch_workers=num_fetch_workers)
+
+      self.report_benchmark(
+          name="av_sampling_prefetch_depth_{}".format(prefetch_depth),
+          iters=num_samples,
+          wall_time=secs_per_set)
+
+  def benchmark_writes_with_faults(self):
+
+    num_rows = 200
+
+    for name, batch_size in [("per_row", 1), ("batched", 50)]:
+
+      table = cbt_test_utils.FakeTable("faulty",
+                                       latency_secs=0.002,
+                                       latency_tail_secs=0.002,
+                                       write_error_rate=0.05,
+                                       seed=0)
+
+      start = time.time()
+      with cbt_utils.BatchedRowWriter(table=table,
+                                      batch_size=batch_size,
+                                      max_in_flight=1,
+                                      retry_delay_secs=0.001) as writer:
+        for i in range(num_rows):
+          row = table.row("row_{:04d}".format(i))
+          row.set_cell("cf", "col", b"x" * 1000)
+          writer.write(row)
+      elapsed = time.time() - start
+
+      self.report_benchmark(name="writes_with_faults_{}".format(name),
+                            iters=num_rows,
+                            wall_time=elapsed / num_rows,
+                            extras={
+                                "rpcs": table.num_rpcs,
+                                "rows_retried": writer.num_rows_retried
+                            })
+
+  def benchmark_frame_and_audio_decode(self):
+
+    num_iters = 20
+    frame_shape = [64, 64, 1]
+
+    selection = _fake_raw_selection(num_videos=1,
+                                    video_length=40,
+                                    frame_shape=tuple(frame_shape),
+                                    audio_length=40000)
+
+    frame_keys = [cbt_utils.make_frame_key("train", 0, 0, i) for i in range(20)]
+    audio_keys = [cbt_utils.make_audio_key("train", 0, 0, i) for i in range(3)]
+    abm = cbt_utils.audio_blocks_for_indices(start=500,
+                                             end=2500,
+                                             block_size=1000)
+    rows = selection.read_rows_by_keys(frame_keys + audio_keys)
+
+    def _list_decode():
+      # The previous per-value decode, for reference.
+      frames = [
+          np.asarray(list(
+              rows[key].cells["video_frames"][b"video_frames"][0].value),
+                     dtype=np.uint8) for key in frame_keys
+      ]
+      frames = np.asarray(frames)
+      audio = np.array([])
+      for key in audio_keys:
+        value = rows[key].cells["audio"][b"audio"][0].value
+        audio = np.concatenate([audio, np.asarray(list(value), np.uint8)])
+      return frames, audio[abm["query_start"]:abm["query_end"]]
+
+    def _buffer_decode():
+      frames = selection._frame_data_from_rows(frame_keys, rows)
+      audio = selection._audio_data_from_rows(audio_keys, abm, rows)
+      return frames, audio
+
+    for name, fn in [("list", _list_decode), ("buffer", _buffer_decode)]:
+
+      tracemalloc.start()
+      start = time.time()
+      for _ in range(num_iters):
+        fn()
+      elapsed = time.time() - start
+      _, peak_bytes = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+      self.report_benchmark(name="decode_{}".format(name),
+                            iters=num_iters,
+                            wall_time=elapsed / num_iters,
+                            extras={"peak_bytes_allocated": peak_bytes})
+
+  def benchmark_array_codecs(self):
+
+    num_frames = 20
+    frame_shape = (64, 64, 1)
+
+    # Smooth frames and audio compress roughly as real ones would, unlike
+    # uniform noise.
+    y, x = np.mgrid[0:frame_shape[0], 0:frame_shape[1]]
+    frames = np.stack([
+        ((x + y + 2 * i) % 256 + np.random.randint(0, 8, frame_shape[:2]))
+        for i in range(num_frames)
+    ]).astype(np.uint8).reshape((num_frames,) + frame_shape)
+    audio = (127 + 100 * np.sin(np.arange(40000) / 50.0) +
+             np.random.randint(0, 4, 40000)).astype(np.uint8)
+
+    for frame_encoding, audio_encoding in [("uint8", "uint8"), ("zlib", "zlib"),
+                                           ("png", "delta_zlib")]:
+
+      selection = _fake_raw_selection(num_videos=0)
+
+      video = video_utils.Video()
+      for frame in frames:
+        video.insert(frame)
+
+      selection.write_av(frames=video,
+                         audio=audio,
+                         shard_id=0,
+                         video_id=0,
+                         frame_encoding=frame_encoding,
+                         audio_encoding=audio_encoding)
+
+      frame_keys = [
+          cbt_utils.make_frame_key("train", 0, 0, i) for i in range(num_frames)
+      ]
+      audio_keys = [
+          cbt_utils.make_audio_key("train", 0, 0, i) for i in range(40)
+      ]
+      rows = selection.read_rows_by_keys(frame_keys + audio_keys)
+
+      def _num_bytes(keys, family):
+        return sum(
+            len(rows[key].cells[family][family.encode()][0].value)
+            for key in keys)
+
+      frame_bytes = _num_bytes(frame_keys, "video_frames")
+      audio_bytes = _num_bytes(audio_keys, "audio")
+
+      abm = cbt_utils.audio_blocks_for_indices(start=0,
+                                               end=len(audio),
+                                               block_size=1000)
+
+      start = time.time()
+      selection._frame_data_from_rows(frame_keys,
+                                      rows,
+                                      frame_shape=list(frame_shape),
+                                      encoding=frame_encoding)
+      frame_decode_secs = time.time() - start
+
+      start = time.time()
+      selection._audio_data_from_rows(audio_keys,
+                                      abm,
+                                      rows,
+                                      encoding=audio_encoding)
+      audio_decode_secs = time.time() - start
+
+      self.report_benchmark(
+          name="array_codecs_{}_{}".format(frame_encoding, audio_encoding),
+          iters=1,
+          wall_time=frame_decode_secs + audio_decode_secs,
+          extras={
+              "bytes_per_frame": frame_bytes / float(num_frames),
+              "audio_bytes_per_sample": audio_bytes / float(len(audio)),
+              "frame_decode_usecs": 1e6 * frame_decode_secs / num_frames,
+              "audio_decode_usecs_per_block": 1e6 * audio_decode_secs / 40
+          })
+
+  def benchmark_key_construction(self):
+
+    num_iters = 1000
+    indices = np.arange(100, 120)
+
+    # The previous per-key construction, for reference.
+    def _legacy_frame_key(frame_id):
+      str_idx = str(frame_id)
+      str_idx = "0000"[0:max(4 - len(str_idx), 0)] + str_idx
+      lexxed = ""
+      for c in str_idx:
+        lexxed += "abcdefghij"[int(c)]
+      key = "{}_{}_{}".format("train", 0, 3)
+      return "{}_{}".format(key, "frame_{}".format(lexxed)).encode()
+
+    def _legacy():
+      return [_legacy_frame_key(i) for i in indices]
+
+    def _vectorised():
+      return cbt_utils.make_frame_keys("train", 0, 3, indices)
+
+    for name, fn in [("legacy", _legacy), ("vectorised", _vectorised)]:
+
+      start = time.time()
+      for _ in range(num_iters):
+        fn()
+      elapsed = time.time() - start
+
+      self.report_benchmark(name="frame_key_construction_{}".format(name),
+                            iters=num_iters,
+                            wall_time=elapsed / num_iters)
+
+  def benchmark_compose_av_write(self):
+
+    num_frames = 100
+    frames = np.random.randint(0, 255, (num_frames, 96, 96, 3)).astype(np.uint8)
+    table = cbt_test_utils.FakeTable("bench")
+
+    def _tolist(frame):
+      # The previous per-pixel serialization, for reference.
+      return bytes(frame.astype(np.uint8).flatten().tolist())
+
+    encoders = [("tolist", _tolist)]
+    for encoding in cbt_utils.ARRAY_ENCODINGS:
+      encoders.append((encoding, lambda frame, encoding=encoding: cbt_utils.
+                       _encode_value(frame, encoding=encoding)))
+
+    for name, encode in encoders:
+
+      start = time.time()
+      for i in range(num_frames):
+        row = table.row("frame_{}".format(i))
+        row.set_cell(column_family_id="video_frames",
+                     column="video_frames",
+                     value=encode(frames[i]))
+      elapsed = time.time() - start
+
+      self.report_benchmark(name="encode_frames_{}".format(name),
+                            iters=num_frames,
+                            wall_time=elapsed / num_frames,
+                            extras={"frames_per_sec": num_frames / elapsed})
+
+
 if __name__ == "__main__":
   tf.test.main()
@@ -12,11 +12,22 @@
 # limitations under the License.
 
 import tensorflow as tf
+import bisect
+import collections
+import functools
 import math
-from PIL import Image
+import os
+import subprocess
+import tempfile
+import threading
+
+from concurrent import futures
 
 import numpy as np
 import cv2
+from scipy.io import wavfile
+
+from clarify.utils import audio_utils
 
 
 def mp4_to_frame_array(input_path):
@@ -55,29 +66,92 @@ def mp4_to_frame_array(input_path):
   return np.asarray(frames)
 
 
-def resize_video(input_frame_array, size):
+def resize_frames(frames, size):
+  """Area-resize a (T, H, W[, C]) array of frames to `size`, (width, height).
+
+  Frames are resized with cv2.INTER_AREA directly into one preallocated
+  array, without a round trip through another image type per frame.
+
+  """
+
+  frames = np.asarray(frames)
+  out_width, out_height = size
+
+  resized = np.empty((len(frames), out_height, out_width) + frames.shape[3:],
+                     dtype=frames.dtype)
+
+  for i, frame in enumerate(frames):
+    # A single channel frame is written as a 2D array.
+    cv2.resize(frame, (out_width, out_height),
+               dst=resized[i],
+               interpolation=cv2.INTER_AREA)
 
-  with tf.Session() as sess:
-    img = tf.constant(input_frame_array)
-    resize_op = tf.image.resize_images(img, [size, size],
-                                       tf.image.ResizeMethod.AREA)
-    resized = sess.run([resize_op])[0].tolist()
   return resized
 
 
-def stream_mp4(input_path, downsample_size=(96, 96), greyscale=False):
+def convert_frames(frames, color_conversion):
+  """Apply a cv2.cvtColor conversion to a (T, H, W, C) array of frames.
 
-  frames = []
+  Conversions are per pixel so the frames are converted together, as the
+  rows of one tall image.
 
-  tf.logging.info(input_path)
+  """
 
-  cap = cv2.VideoCapture(input_path)
+  frames = np.ascontiguousarray(frames)
+  num_frames, height, width = frames.shape[:3]
 
-  # Check if camera opened successfully
-  if (cap.isOpened() == False):
-    tf.logging.error("Error opening video stream or file")
+  converted = cv2.cvtColor(
+      frames.reshape((num_frames * height, width) + frames.shape[3:]),
+      color_conversion)
 
-  i = 0
+  return converted.reshape((num_frames, height, width) + converted.shape[2:])
+
+
+def transform_frames(frames, downsample_size=None, greyscale=False):
+  """Convert decoded BGR frames to RGB (or grey) and maybe downsample them.
+
+  Args:
+    frames(np.ndarray): A (T, H, W, 3) array of frames as decoded by cv2.
+    downsample_size(tuple): Optionally, the (width, height) to resize to.
+    greyscale(bool): Whether to convert to greyscale rather than RGB.
+
+  Returns:
+    A (T, H, W, 3) or, if greyscale, (T, H, W) array of frames.
+
+  """
+
+  if isinstance(downsample_size, tuple):
+    if len(downsample_size) != 2:
+      msg = "If downsampling expected size of len 2, saw {}".format(
+          downsample_size)
+      raise ValueError(msg)
+
+  color_conversion = cv2.COLOR_BGR2RGB
+  if greyscale:
+    color_conversion = cv2.COLOR_BGR2GRAY
+
+  frames = convert_frames(frames, color_conversion)
+
+  if isinstance(downsample_size, tuple):
+    frames = resize_frames(frames, downsample_size)
+
+  return frames
+
+
+def resize_video(input_frame_array, size):
+
+  frames = np.asarray(input_frame_array).astype(np.float32)
+
+  # As with tf.image.resize_images a 3D array is a single image.
+  if frames.ndim == 3:
+    return resize_frames(frames[np.newaxis], (size, size))[0].tolist()
+
+  return resize_frames(frames, (size, size)).tolist()
+
+
+def _read_frame_batches(cap, batch_size):
+
+  batch = []
 
   # Read until video is completed
   while (cap.isOpened()):
@@ -85,71 +159,647 @@ def stream_mp4(input_path, downsample_size=(96, 96), greyscale=False):
     ret, frame = cap.read()
     if ret == True:
 
-      color_conversion = cv2.COLOR_BGR2RGB
-      if greyscale:
-        color_conversion = cv2.COLOR_BGR2GRAY
+      batch.append(frame)
+
+      if len(batch) == batch_size:
+        yield np.stack(batch)
+        batch = []
+
+    # Break the loop
+    else:
+      break
+
+  if batch:
+    yield np.stack(batch)
 
-      frame = cv2.cvtColor(frame, color_conversion)
 
-      if isinstance(downsample_size, tuple):
-        if len(downsample_size) != 2:
-          msg = "If downsampling expected size of len 2, saw {}".format(
-              downsample_size)
-          raise ValueError(msg)
+def _map_batches(fn, batches, num_threads=0):
+  """Yield fn of each batch, in order, on `num_threads` threads if any.
 
-        frame = Image.fromarray(frame).resize(size=downsample_size)
+  No more than a couple of batches per thread are read ahead.
 
-      yield np.asarray(frame)
+  """
 
-    # Break the loop
+  if num_threads < 1:
+    for batch in batches:
+      yield fn(batch)
+    return
+
+  with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+
+    pending = collections.deque()
+
+    for batch in batches:
+      pending.append(executor.submit(fn, batch))
+      while len(pending) > 2 * num_threads:
+        yield pending.popleft().result()
+
+    while pending:
+      yield pending.popleft().result()
+
+
+def stream_mp4(input_path,
+               downsample_size=(96, 96),
+               greyscale=False,
+               batch_size=32,
+               num_threads=0):
+  """Decode a video file, yielding its frames one at a time.
+
+  Frames are converted and resized in batches of `batch_size`, see
+  transform_frames.
+
+  Args:
+    num_threads(int): Optionally, the number of threads with which to
+      transform batches while later frames are decoded.
+
+  """
+
+  tf.logging.info(input_path)
+
+  cap = cv2.VideoCapture(input_path)
+
+  # Check if camera opened successfully
+  if (cap.isOpened() == False):
+    tf.logging.error("Error opening video stream or file")
+
+  def _transform(batch):
+    return transform_frames(batch,
+                            downsample_size=downsample_size,
+                            greyscale=greyscale)
+
+  try:
+
+    batches = _read_frame_batches(cap, batch_size=batch_size)
+
+    for batch in _map_batches(_transform, batches, num_threads=num_threads):
+      for frame in batch:
+        yield frame
+
+  finally:
+    # When everything done, release the video capture object
+    cap.release()
+
+
+def _frame_size(input_path):
+  """The (width, height) of a video, read from its header by cv2."""
+  cap = cv2.VideoCapture(input_path)
+  try:
+    if not cap.isOpened():
+      raise ValueError("Error opening video file {}".format(input_path))
+    return (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+  finally:
+    cap.release()
+
+
+@functools.lru_cache(maxsize=1)
+def _passthrough_args():
+  """ffmpeg args to output frames without dropping or duplicating any.
+
+  That's -fps_mode passthrough, or on builds older than ffmpeg 5.1 the
+  (since deprecated) -vsync 0.
+
+  """
+  options = subprocess.run(["ffmpeg", "-hide_banner", "-h", "long"],
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT).stdout
+  if b"-fps_mode" in options:
+    return ["-fps_mode", "passthrough"]
+  return ["-vsync", "0"]
+
+
+class AVDecoder(object):
+  """Decodes the frames and audio of a video file together.
+
+  The file's frames are streamed while its audio is written, by ffmpeg,
+  to a temporary WAV file from which it can then be read in blocks, so
+  that neither is held in memory as a whole, e.g.
+
+    with AVDecoder(path) as decoder:
+      for frame in decoder.frames():
+        ...
+      for block in decoder.audio_blocks():
+        ...
+
+  By default frames are decoded and transformed exactly as by stream_mp4,
+  in process, while an ffmpeg process concurrently decodes (only) the
+  audio, as mp4_to_1d_array does with -vn. Each stream is decoded once
+  either way, but the file is opened and demuxed by both. With
+  `scale_in_ffmpeg` a single ffmpeg process demuxes and decodes both,
+  with `num_threads` decoding threads, converting and downsampling frames
+  before piping them to stdout; this is considerably faster for large
+  frames but its frames differ from those of stream_mp4 by rounding and
+  chroma filtering.
+
+  Frames are decoded without dropping or duplicating any, as by cv2, and
+  the audio is as given by mp4_to_1d_array, so both span the same duration
+  and the alignment that AVSamplable assumes holds.
+
+  Args:
+    input_path(str): The path to a video file.
+    downsample_size(tuple): As with stream_mp4.
+    greyscale(bool): As with stream_mp4.
+    audio_rate(int): The audio sample rate.
+    audio_channels(int): Optionally, the number of channels to mix the
+      audio to; otherwise those of the file are kept.
+    num_threads(int): The number of ffmpeg decoding threads, 0 for auto.
+    batch_size(int): The number of frames read (and transformed) at a time.
+    scale_in_ffmpeg(bool): Whether ffmpeg converts and downsamples the
+      frames, see above.
+    tmp_dir(str): Optionally, where to write the audio.
+
+  """
+
+  def __init__(self,
+               input_path,
+               downsample_size=(96, 96),
+               greyscale=False,
+               audio_rate=44100,
+               audio_channels=None,
+               num_threads=0,
+               batch_size=32,
+               scale_in_ffmpeg=False,
+               tmp_dir=None):
+
+    if isinstance(downsample_size, tuple) and len(downsample_size) != 2:
+      msg = "If downsampling expected size of len 2, saw {}".format(
+          downsample_size)
+      raise ValueError(msg)
+
+    self.input_path = input_path
+    self.downsample_size = downsample_size
+    self.greyscale = greyscale
+    self.audio_rate = audio_rate
+    self.audio_channels = audio_channels
+    self.num_threads = num_threads
+    self.batch_size = batch_size
+    self.scale_in_ffmpeg = scale_in_ffmpeg
+    self.tmp_dir = tmp_dir
+    self._audio_dir = None
+    self._audio_path = None
+    self._started = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _video_output(self):
+    """The ffmpeg args and shape of the frames piped from ffmpeg."""
+
+    if isinstance(self.downsample_size, tuple):
+      width, height = self.downsample_size
+      args = ["-vf", "scale={}:{}:flags=area".format(width, height)]
     else:
-      break
+      width, height = _frame_size(self.input_path)
+      args = []
 
-  # When everything done, release the video capture object
-  cap.release()
+    if self.greyscale:
+      return args + ["-pix_fmt", "gray"], (height, width)
+    return args + ["-pix_fmt", "rgb24"], (height, width, 3)
 
+  def _command(self, audio_path, video_args=None):
+    """The ffmpeg command decoding the audio and frames (if `video_args`)."""
 
-class VideoFrame(object):
+    command = [
+        "ffmpeg", "-loglevel", "error", "-y", "-threads",
+        str(self.num_threads), "-i", self.input_path
+    ]
 
-  def __init__(self, data, next_node=None, previous_node=None):
-    self.data = data
-    self.next_node = next_node
-    self.previous_node = previous_node
+    if video_args is not None:
+      command += ["-map", "0:v:0"] + _passthrough_args() + video_args + [
+          "-f", "rawvideo", "pipe:1"
+      ]
 
-  def set_next(self, node):
-    self.next_node = node
+    command += [
+        "-map", "0:a:0?", "-f", "wav", "-acodec", "pcm_s16le", "-ar",
+        str(self.audio_rate)
+    ]
+    if self.audio_channels:
+      command += ["-ac", str(self.audio_channels)]
 
-  def set_previous(self, node):
-    self.previous_node = node
+    return command + [audio_path]
 
+  def _frame_batches(self, stdout, frame_shape):
 
-class Video(object):
+    frame_bytes = int(np.prod(frame_shape))
+
+    while True:
+
+      # Read straight into the batch rather than copying out of bytes.
+      batch = np.empty((self.batch_size,) + frame_shape, dtype=np.uint8)
+      view = memoryview(batch).cast("B")
+
+      num_bytes = 0
+      while num_bytes < len(view):
+        num_read = stdout.readinto(view[num_bytes:])
+        if not num_read:
+          break
+        num_bytes += num_read
+
+      num_frames = num_bytes // frame_bytes
+      if num_frames:
+        yield batch[:num_frames]
+      if num_bytes < len(view):
+        return
+
+  def frames(self):
+    """Yield the video's frames, as with stream_mp4.
+
+    May only be called once; the audio is available once it's exhausted.
+
+    """
+
+    if self._started:
+      raise ValueError("Frames of an AVDecoder may only be read once.")
+    self._started = True
+
+    self._audio_dir = tempfile.TemporaryDirectory(dir=self.tmp_dir)
+    audio_path = os.path.join(self._audio_dir.name, "audio.wav")
+
+    video_args = None
+    if self.scale_in_ffmpeg:
+      video_args, frame_shape = self._video_output()
+    command = self._command(audio_path, video_args)
+
+    with tempfile.TemporaryFile() as stderr:
 
-  def __init__(self):
-    self.front = None
-    self.tail = None
-    self.length = 0
+      process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+
+      if self.scale_in_ffmpeg:
+        frames = (frame
+                  for batch in self._frame_batches(process.stdout, frame_shape)
+                  for frame in batch)
+      else:
+        frames = stream_mp4(self.input_path,
+                            downsample_size=self.downsample_size,
+                            greyscale=self.greyscale,
+                            batch_size=self.batch_size)
+
+      try:
+        for frame in frames:
+          yield frame
+
+      finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+      if returncode != 0:
+        stderr.seek(0)
+        raise subprocess.CalledProcessError(returncode,
+                                            command,
+                                            output=stderr.read())
+
+    self._audio_path = audio_path
+
+  def _audio_samples(self):
+    """The video's 16 bit PCM audio, memory mapped."""
+    if self._audio_path is None:
+      raise ValueError("Audio is available once frames have been read.")
+    return wavfile.read(self._audio_path, mmap=True)[1]
+
+  def audio_blocks(self, block_size=44100):
+    """Yield the video's audio, as from audio(), in blocks of samples.
+
+    Only one block of `block_size` samples is read into memory at a time.
+
+    """
+    samples = self._audio_samples()
+    for start in range(0, len(samples), block_size):
+      yield audio_utils.int16_to_float32(samples[start:start + block_size])
+
+  def audio(self):
+    """The video's audio, as from mp4_to_1d_array."""
+    return audio_utils.int16_to_float32(self._audio_samples())
+
+  def close(self):
+    """Remove the decoded audio."""
+    if self._audio_dir is not None:
+      self._audio_dir.cleanup()
+      self._audio_dir = None
+      self._audio_path = None
+
+
+def decode_av(input_path, **kwargs):
+  """Decode the frames and audio of a video file, see AVDecoder.
+
+  Args:
+    input_path(str): The path to a video file.
+    **kwargs: Further args of AVDecoder.
+
+  Returns:
+    A tuple of an array of frames, as from stream_mp4, and an array of
+      audio, as from mp4_to_1d_array.
+
+  """
+
+  with AVDecoder(input_path, **kwargs) as decoder:
+    frames = np.asarray(list(decoder.frames()))
+    return frames, decoder.audio()
+
+
+def keyframe_indices(input_path):
+  """The indices of the keyframes of a video, read with ffprobe.
+
+  Only the container's packet flags are read, nothing is decoded.
+
+  Returns:
+    A sorted list of frame indices, or None if ffprobe isn't available.
+
+  """
+
+  try:
+    output = subprocess.check_output([
+        "ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
+        "packet=flags", "-of", "csv=p=0", input_path
+    ])
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+  flags = output.decode().split()
+  return [i for i, flag in enumerate(flags) if "K" in flag]
+
+
+class FrameReader(object):
+  """Random access to the frames of a video file by seeking.
+
+  Frames are read in ascending order from an open capture. A target frame
+  is reached by seeking if a keyframe lies between the current position and
+  the target (decoding then starts from that keyframe) and otherwise by
+  decoding forward, skipping the conversion of intermediate frames. So
+  reading a short window, e.g. the frames of an AVSamplable.sample_av_pair,
+  costs about the group of pictures around it rather than the whole video.
+
+  Without a keyframe index, i.e. without ffprobe, a seek is made whenever
+  the target is more than `max_skip_frames` ahead.
+
+  Args:
+    input_path(str): The path to a video file.
+    max_skip_frames(int): Without a keyframe index, the largest number of
+      frames decoded and skipped in place of a seek.
+
+  """
+
+  def __init__(self, input_path, max_skip_frames=30):
+    self.input_path = input_path
+    self.max_skip_frames = max_skip_frames
+    self.keyframes = keyframe_indices(input_path)
+    self.lock = threading.Lock()
+    self.num_seeks = 0
+    self.num_skipped = 0
+    self.num_decoded = 0
+    self._cap = None
+    self._position = 0
+
+  def _open(self):
+    self._cap = cv2.VideoCapture(self.input_path)
+    if not self._cap.isOpened():
+      raise ValueError("Error opening video file {}".format(self.input_path))
+    self._position = 0
+
+  @property
+  def length(self):
+    """The number of frames reported by the container."""
+    if self._cap is None:
+      self._open()
+    return int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+  def _should_seek(self, target):
+
+    if target < self._position:
+      return True
+
+    if self.keyframes is None:
+      return target - self._position > self.max_skip_frames
+
+    # The last keyframe at or before the target.
+    i = bisect.bisect_right(self.keyframes, target) - 1
+    return i >= 0 and self.keyframes[i] > self._position
+
+  def _read_frame(self, target):
+
+    if self._should_seek(target):
+      self._cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+      self._position = target
+      self.num_seeks += 1
+
+    while self._position < target:
+      if not self._cap.grab():
+        break
+      self._position += 1
+      self.num_skipped += 1
+
+    ret, frame = self._cap.read()
+    if not ret:
+      # The position is no longer known so re-open on the next read.
+      self._cap.release()
+      self._cap = None
+      msg = "Failed to read frame {} of {}.".format(target, self.input_path)
+      raise ValueError(msg)
+
+    self._position += 1
+    self.num_decoded += 1
+
+    return frame
+
+  def read(self, indices, downsample_size=None, greyscale=False):
+    """Read the frames at `indices`, in the order given.
+
+    Returns:
+      An array of frames, transformed as those of stream_mp4.
+
+    """
+
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+    if len(indices) and indices.min() < 0:
+      raise ValueError("Expected non-negative frame indices.")
+
+    unique_indices, inverse = np.unique(indices, return_inverse=True)
+
+    with self.lock:
+
+      if self._cap is None:
+        self._open()
+
+      frames = [self._read_frame(int(target)) for target in unique_indices]
+
+    if not frames:
+      return np.empty((0,), dtype=np.uint8)
+
+    frames = transform_frames(np.stack(frames),
+                              downsample_size=downsample_size,
+                              greyscale=greyscale)
+
+    return frames[inverse]
+
+  def close(self):
+    with self.lock:
+      if self._cap is not None:
+        self._cap.release()
+        self._cap = None
+
+
+# The number of files whose FrameReader is kept open by read_frames.
+MAX_CACHED_FRAME_READERS = 8
+
+_FRAME_READERS = collections.OrderedDict()
+_FRAME_READERS_LOCK = threading.Lock()
+
+
+def get_frame_reader(input_path):
+  """A FrameReader for `input_path`, shared with recent callers.
+
+  The least recently used readers beyond MAX_CACHED_FRAME_READERS are
+  closed.
+
+  """
+
+  with _FRAME_READERS_LOCK:
+
+    reader = _FRAME_READERS.pop(input_path, None)
+    if reader is None:
+      reader = FrameReader(input_path)
+    _FRAME_READERS[input_path] = reader
+
+    while len(_FRAME_READERS) > MAX_CACHED_FRAME_READERS:
+      _, evicted = _FRAME_READERS.popitem(last=False)
+      evicted.close()
+
+  return reader
+
+
+def clear_frame_readers():
+  """Close and forget the readers cached by get_frame_reader."""
+  with _FRAME_READERS_LOCK:
+    for reader in _FRAME_READERS.values():
+      reader.close()
+    _FRAME_READERS.clear()
+
+
+def read_frames(input_path, indices, downsample_size=None, greyscale=False):
+  """Read only the frames at `indices` of a video file, see FrameReader.
+
+  The capture handle and keyframe index of each file are cached across
+  calls, e.g. those sampling windows of the same video.
+
+  Args:
+    input_path(str): The path to a video file.
+    indices(list): Frame indices, in any order and possibly repeated.
+    downsample_size(tuple): As with stream_mp4.
+    greyscale(bool): As with stream_mp4.
+
+  Returns:
+    An array of the frames at `indices`.
+
+  """
+
+  return get_frame_reader(input_path).read(indices,
+                                           downsample_size=downsample_size,
+                                           greyscale=greyscale)
+
+
+class Video(object):
+  """A growable store of equally shaped frames.
+
+  Frames are kept in one contiguous (T, H, W[, C]) array whose capacity
+  doubles whenever it fills, so inserting is amortised O(1) and the frames
+  can be sliced, fancy-indexed, or exported without per-frame objects, e.g.
+
+    video = Video()
+    video.insert(frame)
+    clip = video[10:30]  # A view
+    sample = video[[1, 5, 9]]  # A copy
+
+  Args:
+    capacity(int): The number of frames to initially allocate for.
+    dtype(np.dtype): The dtype of the frames, by default that of the first
+      frame inserted.
+
+  """
+
+  def __init__(self, capacity=16, dtype=None):
+    self._capacity = max(int(capacity), 1)
+    self._dtype = dtype
+    self._buffer = None
+    self._length = 0
+
+  @classmethod
+  def from_frames(cls, frames):
+    """A Video of a (T, H, W[, C]) array of `frames`, without copying."""
+    video = cls()
+    frames = np.asarray(frames)
+    if len(frames):
+      video._buffer = frames
+      video._capacity = len(frames)
+      video._length = len(frames)
+    return video
+
+  @property
+  def length(self):
+    return self._length
+
+  def __len__(self):
+    return self._length
+
+  @property
+  def frames(self):
+    """A view of the array of inserted frames."""
+    if self._buffer is None:
+      return np.empty((0,))
+    return self._buffer[:self._length]
+
+  @property
+  def frame_shape(self):
+    if self._buffer is None:
+      return None
+    return self._buffer.shape[1:]
+
+  def __getitem__(self, key):
+    return self.frames[key]
+
+  def __array__(self, dtype=None, copy=None):
+    if dtype is None:
+      return self.frames
+    return self.frames.astype(dtype)
+
+  def as_memoryview(self):
+    """A memoryview of the frames' bytes, e.g. for writers."""
+    return memoryview(self.frames)
+
+  def _grow(self, min_capacity):
+    capacity = max(self._capacity, 1)
+    while capacity < min_capacity:
+      capacity *= 2
+
+    buffer = np.empty((capacity,) + self._buffer.shape[1:],
+                      dtype=self._buffer.dtype)
+    buffer[:self._length] = self._buffer[:self._length]
+
+    self._buffer = buffer
+    self._capacity = capacity
 
   def insert(self, data):
-    new_node = VideoFrame(data=data)
-    previous_tail = self.tail
 
-    if previous_tail:
-      previous_tail.next_node = new_node
+    data = np.asarray(data, dtype=self._dtype)
+
+    if self._buffer is None:
+      self._buffer = np.empty((self._capacity,) + data.shape, dtype=data.dtype)
 
-    new_node.previous_node = previous_tail
-    self.tail = new_node
+    elif data.shape != self.frame_shape:
+      msg = "Expected frames of shape {}, saw {}.".format(
+          self.frame_shape, data.shape)
+      raise ValueError(msg)
 
-    if not self.front:
-      self.front = new_node
+    if self._length == len(self._buffer):
+      self._grow(self._length + 1)
 
-    self.length += 1
+    self._buffer[self._length] = data
+    self._length += 1
 
   def get_iterator(self):
-    current = self.front
-    while current is not None:
-      yield current.data
-      current = current.next_node
+    for i in range(self._length):
+      yield self._buffer[i]
 
   def load_from_file(self,
                      input_path,
@@ -162,8 +812,20 @@ class Video(object):
 
 
 class AVSamplable(object):
+  """Samples aligned frame and audio indices.
+
+  Args:
+    video_length(int): The number of frames in the video.
+    audio_length(int): The number of audio samples in the video.
+    random_state(np.random.RandomState): Optionally, the source of
+      randomness, e.g. for deterministic sampling; np.random by default.
+
+  """
 
-  def __init__(self, video_length, audio_length):
+  def __init__(self, video_length, audio_length, random_state=None):
+    if random_state is None:
+      random_state = np.random
+    self.random_state = random_state
     self.length = video_length
     self.audio_length = audio_length
     self.audio_steps_per_frame = audio_length / float(video_length)
@@ -185,7 +847,7 @@ class AVSamplable(object):
       tf.logging.info(msg)
       return _get_frame_indices(start_index=0)
 
-    start_index = np.random.randint(0, max_start_index, 1)[0]
+    start_index = self.random_state.randint(0, max_start_index, 1)[0]
     return _get_frame_indices(start_index)
 
   def _audio_given_frame_sample(self, frame_sample):
@@ -221,9 +883,9 @@ class AVSamplable(object):
       msg = "Must sample num_frames >= 0, saw {}".format(num_frames)
       raise ValueError(msg)
 
-    frame_shift = np.random.randint(0, 2 * max_frame_shift + 1)
+    frame_shift = self.random_state.randint(0, 2 * max_frame_shift + 1)
 
-    frame_skip_size = np.random.randint(0, max_frame_skip + 1)
+    frame_skip_size = self.random_state.randint(0, max_frame_skip + 1)
 
     meta = {
         "frame_skip_size": frame_skip_size,
@@ -248,9 +910,9 @@ class AVSamplable(object):
     frame_sample = frame_sample[:num_frames + frame_skip_size]
 
     # Sample frame indices to skip
-    skip = np.random.choice(range(len(frame_sample)),
-                            frame_skip_size,
-                            replace=False)
+    skip = self.random_state.choice(range(len(frame_sample)),
+                                    frame_skip_size,
+                                    replace=False)
     frame_sample = np.delete(frame_sample, skip)
     assert len(frame_sample) == num_frames
 
@@ -12,10 +12,45 @@
 # limitations under the License.
 
 import tensorflow as tf
+import os
+import subprocess
+import tempfile
+import time
 
+from concurrent import futures
+
+import numpy as np
+import cv2
+
+from PIL import Image
+
+from clarify.utils import audio_utils
 from clarify.utils import video_utils
 
 
+def _write_test_video(path, num_frames=100, frame_size=(32, 24)):
+  """Write an mp4 whose frames are distinguishable by their brightness."""
+
+  writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 25,
+                           frame_size)
+  for i in range(num_frames):
+    frame = np.zeros((frame_size[1], frame_size[0], 3), dtype=np.uint8)
+    frame[:, :i % frame_size[0] + 1] = 255
+    writer.write(frame)
+  writer.release()
+
+
+def _write_test_av(path, seconds=2, frame_size=(32, 24), audio_channels=1):
+  """Write an mp4 with a test pattern and a tone, using ffmpeg."""
+  subprocess.check_output([
+      "ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi", "-i",
+      "testsrc=size={}x{}:rate=25".format(*frame_size), "-f", "lavfi", "-i",
+      "sine=frequency=440:sample_rate=44100", "-t",
+      str(seconds), "-pix_fmt", "yuv420p", "-ac",
+      str(audio_channels), path
+  ])
+
+
 class TestVideoUtils(tf.test.TestCase):
 
   def test_av_samplable_combined(self):
@@ -66,6 +101,302 @@ class TestVideoUtils(tf.test.TestCase):
             self.assertEqual(len(f_), (len(f)))
             #self.assertEqual(len(a_), len(a))
 
+  def test_video_frame_buffer(self):
+
+    frames = np.random.randint(0, 255, (37, 4, 4, 3)).astype(np.uint8)
+
+    video = video_utils.Video(capacity=2)
+    self.assertEqual(video.length, 0)
+    self.assertEqual(video.frame_shape, None)
+
+    for frame in frames:
+      video.insert(frame)
+
+    self.assertEqual(video.length, 37)
+    self.assertEqual(len(video), 37)
+    self.assertEqual(video.frame_shape, (4, 4, 3))
+    self.assertAllEqual(np.stack(list(video.get_iterator())), frames)
+    self.assertAllEqual(np.asarray(video), frames)
+
+    # Slices are views of the buffer, fancy indexing gathers frames.
+    clip = video[10:20]
+    self.assertTrue(np.shares_memory(clip, video.frames))
+    self.assertAllEqual(clip, frames[10:20])
+    self.assertAllEqual(video[[3, 1, 30]], frames[[3, 1, 30]])
+
+    view = video.as_memoryview()
+    self.assertEqual(view.nbytes, frames.nbytes)
+    self.assertEqual(bytes(view), frames.tobytes())
+
+    with self.assertRaises(ValueError):
+      video.insert(np.zeros((4, 4, 1), dtype=np.uint8))
+
+    # Wrapping an array doesn't copy it, nor does inserting modify it.
+    wrapped = video_utils.Video.from_frames(frames)
+    self.assertTrue(np.shares_memory(wrapped.frames, frames))
+    wrapped.insert(frames[0])
+    self.assertEqual(wrapped.length, 38)
+    self.assertAllEqual(wrapped[:37], frames)
+
+  def test_read_frames(self):
+
+    path = os.path.join(tempfile.mkdtemp(), "video.mp4")
+    _write_test_video(path, num_frames=100)
+
+    expected = np.stack(list(video_utils.stream_mp4(path,
+                                                    downsample_size=None)))
+    self.assertEqual(len(expected), 100)
+
+    video_utils.clear_frame_readers()
+
+    # Windows, out of order and repeated indices, and backward seeks.
+    for indices in [
+        np.arange(60, 80), [5, 3, 3, 97], [0], [99, 98, 50, 0],
+        np.arange(10, 20)
+    ]:
+      frames = video_utils.read_frames(path, indices)
+      self.assertAllEqual(frames, expected[indices])
+
+    # The reader and its capture are reused across calls.
+    reader = video_utils.get_frame_reader(path)
+    self.assertEqual(reader.length, 100)
+    self.assertTrue(reader.num_seeks > 0)
+    self.assertTrue(reader.num_decoded < 100)
+
+    # A window far into the video is reached without decoding the frames
+    # before it.
+    reader.num_skipped = 0
+    video_utils.read_frames(path, np.arange(85, 90))
+    self.assertTrue(reader.num_skipped < 85)
+
+    greyscale = video_utils.read_frames(path, [7],
+                                        downsample_size=(8, 6),
+                                        greyscale=True)
+    self.assertEqual(greyscale.shape, (1, 6, 8))
+
+    with self.assertRaises(ValueError):
+      video_utils.read_frames(path, [100])
+    with self.assertRaises(ValueError):
+      video_utils.read_frames(path, [-1])
+    self.assertAllEqual(video_utils.read_frames(path, [1])[0], expected[1])
+
+    video_utils.clear_frame_readers()
+
+  def test_transform_frames(self):
+
+    frames = np.random.randint(0, 255, (200, 24, 32, 3)).astype(np.uint8)
+
+    for greyscale, conversion in [(False, cv2.COLOR_BGR2RGB),
+                                  (True, cv2.COLOR_BGR2GRAY)]:
+
+      expected = np.stack([
+          cv2.resize(cv2.cvtColor(frame, conversion), (16, 12),
+                     interpolation=cv2.INTER_AREA) for frame in frames
+      ])
+
+      transformed = video_utils.transform_frames(frames,
+                                                 downsample_size=(16, 12),
+                                                 greyscale=greyscale)
+      self.assertAllEqual(transformed, expected)
+
+    self.assertAllEqual(video_utils.transform_frames(frames[:3]),
+                        frames[:3, :, :, ::-1])
+
+    for size in [(16, 12), (10, 7), (64, 48)]:
+      for batch in [frames, frames[:, :, :, :1], frames[:, :, :, 0]]:
+        expected = np.stack([
+            cv2.resize(
+                frame, size,
+                interpolation=cv2.INTER_AREA).reshape((size[1], size[0]) +
+                                                      batch.shape[3:])
+            for frame in batch
+        ])
+        self.assertAllEqual(video_utils.resize_frames(batch, size), expected)
+
+    with self.assertRaises(ValueError):
+      video_utils.transform_frames(frames, downsample_size=(1, 2, 3))
+
+    resized = np.asarray(video_utils.resize_video(frames[:5], 8))
+    self.assertEqual(resized.shape, (5, 8, 8, 3))
+    self.assertEqual(
+        np.asarray(video_utils.resize_video(frames[0], 8)).shape, (8, 8, 3))
+
+    path = os.path.join(tempfile.mkdtemp(), "video.mp4")
+    _write_test_video(path, num_frames=50)
+    batched = list(video_utils.stream_mp4(path, batch_size=8))
+    threaded = list(video_utils.stream_mp4(path, batch_size=8, num_threads=2))
+    self.assertEqual(len(batched), 50)
+    self.assertAllEqual(np.stack(batched), np.stack(threaded))
+    self.assertEqual(batched[0].shape, (96, 96, 3))
+
+  def test_decode_av(self):
+
+    path = os.path.join(tempfile.mkdtemp(), "av.mp4")
+    _write_test_av(path, seconds=2)
+
+    expected_audio = audio_utils.mp4_to_1d_array(path)
+
+    for greyscale in [False, True]:
+
+      expected_frames = np.stack(
+          list(
+              video_utils.stream_mp4(path,
+                                     downsample_size=(16, 12),
+                                     greyscale=greyscale)))
+
+      # Transformed as by stream_mp4, frames are identical.
+      frames, audio = video_utils.decode_av(path,
+                                            downsample_size=(16, 12),
+                                            greyscale=greyscale,
+                                            batch_size=7)
+      self.assertAllEqual(frames, expected_frames)
+      self.assertAllEqual(audio, expected_audio)
+
+      # Transformed by ffmpeg, frames differ only by filtering and rounding.
+      frames, audio = video_utils.decode_av(path,
+                                            downsample_size=(16, 12),
+                                            greyscale=greyscale,
+                                            scale_in_ffmpeg=True)
+      self.assertEqual(frames.shape, expected_frames.shape)
+      self.assertTrue(np.mean(np.abs(frames.astype(int) - expected_frames)) < 8)
+      self.assertAllEqual(audio, expected_audio)
+
+    # Both cover the clip, as AVSamplable assumes.
+    self.assertEqual(len(frames), 50)
+    self.assertAllClose(len(audio) / float(len(frames)),
+                        44100 / 25.0,
+                        rtol=0.05)
+
+    decoder = video_utils.AVDecoder(path)
+    with self.assertRaises(ValueError):
+      decoder.audio()
+    for _ in decoder.frames():
+      pass
+    with self.assertRaises(ValueError):
+      list(decoder.frames())
+
+    # The audio can also be read in blocks, until the decoder is closed.
+    blocks = list(decoder.audio_blocks(block_size=1000))
+    self.assertEqual(len(blocks[0]), 1000)
+    self.assertAllEqual(np.concatenate(blocks), decoder.audio())
+    decoder.close()
+    with self.assertRaises(ValueError):
+      decoder.audio()
+
+    # The file's audio channels are kept unless mixed down, in either mode.
+    _write_test_av(path, seconds=2, audio_channels=2)
+    expected_audio = audio_utils.mp4_to_1d_array(path)
+    self.assertEqual(expected_audio.shape[1], 2)
+    for scale_in_ffmpeg in [False, True]:
+      _, audio = video_utils.decode_av(path, scale_in_ffmpeg=scale_in_ffmpeg)
+      self.assertAllEqual(audio, expected_audio)
+      _, audio = video_utils.decode_av(path,
+                                       audio_channels=1,
+                                       scale_in_ffmpeg=scale_in_ffmpeg)
+      self.assertEqual(audio.shape, expected_audio.shape[:1])
+
+
+class VideoUtilsBenchmark(tf.test.Benchmark):
+
+  def benchmark_read_frame_window(self):
+
+    path = os.path.join(tempfile.mkdtemp(), "video.mp4")
+    _write_test_video(path, num_frames=2000, frame_size=(128, 96))
+
+    start = time.time()
+    for _ in video_utils.stream_mp4(path, downsample_size=None):
+      pass
+    full_decode_secs = time.time() - start
+
+    video_utils.clear_frame_readers()
+
+    start = time.time()
+    video_utils.read_frames(path, np.arange(1500, 1520))
+    seek_secs = time.time() - start
+
+    self.report_benchmark(name="read_frame_window",
+                          iters=1,
+                          wall_time=seek_secs,
+                          extras={"full_decode_secs": full_decode_secs})
+
+    video_utils.clear_frame_readers()
+
+  def benchmark_transform_frames(self):
+
+    frames = np.random.randint(0, 255, (512, 224, 224, 3)).astype(np.uint8)
+    size = (64, 64)
+
+    def _per_frame(batch):
+      # The previous path, converting and resizing each frame with PIL.
+      return np.stack([
+          np.asarray(
+              Image.fromarray(cv2.cvtColor(frame,
+                                           cv2.COLOR_BGR2RGB)).resize(size))
+          for frame in batch
+      ])
+
+    def _batched(batch):
+      return video_utils.transform_frames(batch, downsample_size=size)
+
+    for name, transform, num_threads in [("per_frame_pil", _per_frame, 0),
+                                         ("batched", _batched, 0),
+                                         ("batched_4_threads", _batched, 4)]:
+
+      batches = [frames[i:i + 32] for i in range(0, len(frames), 32)]
+
+      start = time.time()
+      if num_threads:
+        with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+          list(executor.map(transform, batches))
+      else:
+        for batch in batches:
+          transform(batch)
+      elapsed = time.time() - start
+
+      self.report_benchmark(name="transform_frames_{}".format(name),
+                            iters=len(frames),
+                            wall_time=elapsed / len(frames),
+                            extras={"frames_per_sec": len(frames) / elapsed})
+
+  def benchmark_decode_av(self):
+
+    path = os.path.join(tempfile.mkdtemp(), "av.mp4")
+    _write_test_av(path, seconds=30, frame_size=(640, 360))
+
+    def _sequential(greyscale):
+      # The previous path, decoding the frames and then the audio.
+      def _decode():
+        list(
+            video_utils.stream_mp4(path,
+                                   downsample_size=(64, 64),
+                                   greyscale=greyscale))
+        audio_utils.mp4_to_1d_array(path)
+
+      return _decode
+
+    def _decoder(greyscale, scale_in_ffmpeg):
+      return lambda: video_utils.decode_av(path,
+                                           downsample_size=(64, 64),
+                                           greyscale=greyscale,
+                                           scale_in_ffmpeg=scale_in_ffmpeg)
+
+    # Extraction decodes greyscale frames.
+    for greyscale in [False, True]:
+      for name, decode in [("sequential", _sequential(greyscale)),
+                           ("concurrent", _decoder(greyscale, False)),
+                           ("scale_in_ffmpeg", _decoder(greyscale, True))]:
+
+        if greyscale:
+          name += "_greyscale"
+
+        start = time.time()
+        decode()
+        elapsed = time.time() - start
+
+        self.report_benchmark(name="decode_av_{}".format(name),
+                              iters=1,
+                              wall_time=elapsed)
+
 
 if __name__ == "__main__":
   tf.test.main()